@@ -0,0 +1,97 @@
+#  CSIPBLLM — LAPORAN RECALL@K vs LATENSI (IVF / HNSW vs FLAT)
+#
+#  Contoh:
+#    python bench/bench_ann.py
+#    python bench/bench_ann.py --n 500000 --dim 1024 --nprobe 4,8,16,32,64 --ef 16,32,64,128
+#
+#  Data sintetis dibuat berkelompok (mixture of gaussians) agar mirip embedding teks;
+#  baseline = IndexFlatIP (exact).
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ollamaapi import configure_faiss_search, create_faiss_index, ivf_nlist, load_optional_modules, normalize_rows  # noqa: E402
+
+try:
+    import faiss  # type: ignore
+except ImportError:
+    faiss = None  # type: ignore
+
+
+def clustered_vectors(rng, n: int, dim: int, n_clusters: int) -> np.ndarray:
+    centers = rng.standard_normal((n_clusters, dim), dtype="float32")
+    labels = rng.integers(0, n_clusters, size=n)
+    noise = rng.standard_normal((n, dim), dtype="float32") * 0.6
+    return normalize_rows(centers[labels] + noise)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(index, queries: np.ndarray, k: int):
+    t0 = time.perf_counter()
+    _, I = index.search(queries, k)
+    return I, (time.perf_counter() - t0) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k vs latency untuk index FAISS")
+    parser.add_argument("--n", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nlist", type=int, default=0, help="0 = otomatis (4 * sqrt(n))")
+    parser.add_argument("--nprobe", default="1,4,8,16,32,64")
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef", default="16,32,64,128,256")
+    args = parser.parse_args()
+
+    load_optional_modules()
+    if faiss is None:
+        print("faiss tidak terpasang: pip install faiss-cpu")
+        return
+
+    rng = np.random.default_rng(0)
+    n_clusters = max(16, args.n // 500)
+    data = clustered_vectors(rng, args.n + args.queries, args.dim, n_clusters)
+    corpus, queries = data[: args.n], data[args.n:]
+
+    print(f"n={args.n:,} dim={args.dim} queries={args.queries} k={args.k}")
+    print("| index | parameter | build (detik) | latensi (ms/query) | recall@k |")
+    print("|---|---|---|---|---|")
+
+    t0 = time.perf_counter()
+    flat = create_faiss_index(corpus, "flat")
+    flat_build = time.perf_counter() - t0
+    truth, flat_lat = measure(flat, queries, args.k)
+    print(f"| flat | - | {flat_build:.2f} | {flat_lat * 1000:.3f} | 1.000 |")
+
+    nlist = args.nlist or ivf_nlist(args.n)
+    t0 = time.perf_counter()
+    ivf = create_faiss_index(corpus, "ivf", nlist=nlist)
+    ivf_build = time.perf_counter() - t0
+    for nprobe in [int(x) for x in args.nprobe.split(",")]:
+        configure_faiss_search(ivf, nprobe=nprobe)
+        found, lat = measure(ivf, queries, args.k)
+        print(f"| ivf | nlist={nlist} nprobe={nprobe} | {ivf_build:.2f} | {lat * 1000:.3f} | {recall_at_k(found, truth):.3f} |")
+
+    t0 = time.perf_counter()
+    hnsw = create_faiss_index(corpus, "hnsw", M=args.hnsw_m, efConstruction=args.ef_construction)
+    hnsw_build = time.perf_counter() - t0
+    for ef in [int(x) for x in args.ef.split(",")]:
+        configure_faiss_search(hnsw, ef_search=ef)
+        found, lat = measure(hnsw, queries, args.k)
+        print(f"| hnsw | M={args.hnsw_m} efSearch={ef} | {hnsw_build:.2f} | {lat * 1000:.3f} | {recall_at_k(found, truth):.3f} |")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#  CSIPBLLM — LAPORAN RECALL@K & LATENSI: VEKTOR vs BM25 vs HYBRID (RRF)
+#
+#  Contoh:
+#    python bench/bench_hybrid.py
+#    python bench/bench_hybrid.py --files 300 --queries 500 --k 4
+#    python bench/bench_hybrid.py --ollama http://localhost:11434     # embedding asli (mxbai-embed-large)
+#
+#  Korpus = materi sintetis yang di-chunk dengan chunk_material_text. Sebagian chunk diberi
+#  identifier unik (mis. `hitung_skor_kuis_17`) sebagai jawaban pertanyaan kode; query
+#  parafrase = kata acak dari chunk target. Tanpa --ollama dipakai embedding hashing
+#  trigram karakter (mirip model dense: identifier yang mirip saling tertukar).
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from gen_materials import generate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ollamaapi as api  # noqa: E402
+
+
+class HashingEmbedder:
+    """Embedding trigram karakter yang di-hash ke dim dimensi (deterministik, tanpa model)."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def embed(self, text: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype="float32")
+        padded = f"  {text.lower()}  "
+        for i in range(len(padded) - 2):
+            h = int(hashlib.md5(padded[i:i + 3].encode("utf-8")).hexdigest()[:8], 16)
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        return vec
+
+    def embed_documents(self, texts):
+        return [self.embed(t) for t in texts]
+
+
+def build_queries(chunks, n_queries: int, rng: random.Random):
+    """Setengah query identifier (chunk diberi identifier unik), setengah parafrase kata acak."""
+    targets = rng.sample(range(len(chunks)), min(n_queries, len(chunks)))
+    queries = []
+    for j, idx in enumerate(targets):
+        if j % 2 == 0:
+            ident = f"hitung_skor_kuis_{j}"
+            chunks[idx]["text"] += f"\nContoh fungsi: `{ident}(data)` mengembalikan skor."
+            queries.append(("identifier", f"apa yang dilakukan {ident}?", idx))
+        else:
+            words = [w for w in chunks[idx]["text"].split() if w.isalpha()]
+            sample = rng.sample(words, min(6, len(words)))
+            queries.append(("parafrase", "jelaskan " + " ".join(sample), idx))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k & latensi retrieval vektor vs BM25 vs hybrid")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--kb", type=float, default=8.0)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--dim", type=int, default=256, help="dimensi embedding hashing")
+    parser.add_argument("--ollama", default="", help="URL Ollama untuk embedding asli (opsional)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="csipb-hybrid-")
+    try:
+        generate(os.path.join(work_dir, "materials"), args.files, args.kb)
+        chunks = []
+        for root, _, files in sorted(os.walk(os.path.join(work_dir, "materials"))):
+            for fname in sorted(files):
+                with open(os.path.join(root, fname), "r", encoding="utf-8") as f:
+                    chunks.extend(api.chunk_material_text(f.read(), fname, fname))
+        rng = random.Random(0)
+        queries = build_queries(chunks, args.queries, rng)
+
+        if args.ollama:
+            api.base_ollama_url = args.ollama
+            api.init_langchain_clients()
+            embedder = api.embeddings_model
+        else:
+            embedder = HashingEmbedder(args.dim)
+
+        t0 = time.perf_counter()
+        vectors = api.normalize_rows(np.asarray(embedder.embed_documents([c["text"] for c in chunks]), dtype="float32"))
+        embed_seconds = time.perf_counter() - t0
+        store = api.MaterialStore.from_items([{"embedding": v, **c} for v, c in zip(vectors, chunks)])
+
+        t0 = time.perf_counter()
+        bm25 = api.BM25Index.build(store)
+        bm25_seconds = time.perf_counter() - t0
+
+        api.materials_index, api.bm25_index, api.faiss_index = store, bm25, None
+        api.materials_loaded = True
+
+        q_vecs = api.normalize_rows(np.asarray(embedder.embed_documents([q for _, q, _ in queries]), dtype="float32"))
+        texts = {store.text(i): i for i in range(len(store))}
+
+        print(f"chunk={len(store)} query={len(queries)} k={args.k} embedding={'ollama' if args.ollama else 'hashing'}")
+        print(f"embed korpus {embed_seconds:.2f} detik, build BM25 {bm25_seconds * 1000:.0f} ms ({len(bm25.vocab)} term)")
+        print("| mode | recall@k identifier | recall@k parafrase | latensi p50 (ms/query) | p95 |")
+        print("|---|---|---|---|---|")
+        for mode in ("vector", "lexical", "hybrid"):
+            api.RETRIEVAL_MODE = mode
+            hits = {"identifier": [], "parafrase": []}
+            latencies = []
+            for (kind, query, target), q_vec in zip(queries, q_vecs):
+                t0 = time.perf_counter()
+                results = api.search_materials([query], None if mode == "lexical" else q_vec[None, :], k=args.k)[0]
+                latencies.append(time.perf_counter() - t0)
+                hits[kind].append(any(texts.get(r["text"]) == target for r in results))
+            lat = sorted(latencies)
+            print(
+                f"| {mode} | {statistics.mean(hits['identifier']):.3f} | {statistics.mean(hits['parafrase']):.3f} | "
+                f"{statistics.median(lat) * 1000:.3f} | {lat[int(len(lat) * 0.95)] * 1000:.3f} |"
+            )
+        print("catatan: latensi vektor/hybrid belum termasuk embed query (1 round trip ke Ollama).")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#  CSIPBLLM — MICRO-BENCHMARK FUNGSI INTI
+#
+#  Contoh:
+#    python bench/bench_micro.py
+#    python bench/bench_micro.py --files 500 --kb 8 --repeat 50
+#
+#  Mengukur load_materials_and_build_index (cold/warm), retrieve_relevant_chunks
+#  (cache embedding miss/hit) dan format_history_as_text untuk riwayat panjang.
+
+import argparse
+import importlib
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from gen_materials import TOPICS, generate
+from harness import ROOT_DIR, bench_env, fmt, start_fake_ollama, stop
+
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark fungsi inti ollamaapi")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--kb", type=float, default=8.0)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--ollama-port", type=int, default=11691)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="csipb-micro-")
+    fake = None
+    try:
+        generate(os.path.join(work_dir, "materials"), args.files, args.kb)
+        # embedding dibuat instan: yang diukur overhead aplikasi, bukan model
+        fake = start_fake_ollama(args.ollama_port, latency=0.0)
+        os.environ.update(bench_env(args.ollama_port, work_dir))
+        sys.path.insert(0, ROOT_DIR)
+        api = importlib.import_module("ollamaapi")
+
+        rows = []
+
+        t0 = time.perf_counter()
+        api.load_materials_and_build_index()
+        rows.append(("load_materials_and_build_index (cold, embed semua)", time.perf_counter() - t0))
+
+        def warm_load():
+            api.materials_loaded = False
+            api.load_materials_and_build_index()
+
+        rows.append(("load_materials_and_build_index (warm, mmap + sync)", timed(warm_load, max(1, args.repeat // 4))))
+
+        queries = [f"jelaskan {t} dengan contoh" for t in TOPICS]
+
+        def retrieve_miss():
+            api.query_embedding_cache.clear()
+            for q in queries:
+                api.retrieve_relevant_chunks(q, k=4)
+
+        def retrieve_hit():
+            for q in queries:
+                api.retrieve_relevant_chunks(q, k=4)
+
+        rows.append(("retrieve_relevant_chunks (embed miss, per query)", timed(retrieve_miss, args.repeat) / len(queries)))
+        retrieve_hit()
+        rows.append(("retrieve_relevant_chunks (embed hit, per query)", timed(retrieve_hit, args.repeat) / len(queries)))
+
+        for n_messages in (10, 1000, 10000):
+            history = api.get_session_history(f"bench-{n_messages}")
+            t0 = time.perf_counter()
+            for i in range(n_messages):
+                history.add_user_message(f"pesan nomor {i} " + "x" * 80)
+            if n_messages >= 1000:
+                rows.append((f"add_user_message (rata-rata, {n_messages} pesan)", (time.perf_counter() - t0) / n_messages))
+            rows.append(
+                (f"format_history_as_text ({n_messages} pesan)", timed(lambda: api.format_history_as_text(history), args.repeat * 10))
+            )
+
+        print(f"materi: {args.files} file x ~{args.kb} KB, {len(api.materials_index)} chunk")
+        print("| benchmark | median (µs) |")
+        print("|---|---|")
+        for name, seconds in rows:
+            print(f"| {name} | {fmt(seconds, scale=1e6, digits=1)} |")
+    finally:
+        stop(fake)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#  CSIPBLLM — BENCHMARK RETRIEVAL (NumPy top-k vs FAISS IndexFlatIP)
+#
+#  Contoh:
+#    python bench/bench_retrieval.py
+#    python bench/bench_retrieval.py --sizes 1000,10000,100000,1000000 --dim 1024 --batch 32
+#
+#  Catatan memori: matriks n x dim float32 butuh n * dim * 4 byte
+#  (1M x 1024 = ~4 GB), FAISS menyimpan salinannya sendiri.
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ollamaapi import normalize_rows, top_k_inner_product  # noqa: E402
+
+try:
+    import faiss  # type: ignore
+except ImportError:
+    faiss = None  # type: ignore
+
+
+def timed(fn, repeat: int) -> float:
+    """Median waktu (detik) dari beberapa kali pemanggilan."""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+
+def legacy_loop(matrix: np.ndarray, q: np.ndarray, k: int):
+    """Jalur lama: np.dot per chunk di loop Python + argsort penuh."""
+    scores = [float(np.dot(q, row)) for row in matrix]
+    return np.argsort(scores)[::-1][:k]
+
+
+def fmt_ms(seconds) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark top-k retrieval")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=1024, help="dimensi embedding (mxbai-embed-large = 1024)")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=32, help="jumlah query untuk mode batch")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy-max", type=int, default=100000, help="loop lama hanya diukur sampai n ini")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+
+    print(f"dim={args.dim} k={args.k} batch={args.batch} faiss={'ya' if faiss is not None else 'tidak'}")
+    print("| n | loop lama (ms) | numpy 1 query (ms) | numpy batch (ms/query) | faiss 1 query (ms) | faiss batch (ms/query) | top-k sama |")
+    print("|---|---|---|---|---|---|---|")
+
+    for n in sizes:
+        matrix = normalize_rows(rng.standard_normal((n, args.dim), dtype="float32"))
+        queries = normalize_rows(rng.standard_normal((args.batch, args.dim), dtype="float32"))
+        q1 = queries[:1]
+
+        legacy = None
+        if n <= args.legacy_max:
+            legacy = timed(lambda m=matrix: legacy_loop(m, q1[0], args.k), max(1, args.repeat // 2))
+
+        np_single = timed(lambda m=matrix: top_k_inner_product(m, q1, args.k), args.repeat)
+        np_batch = timed(lambda m=matrix: top_k_inner_product(m, queries, args.k), args.repeat) / args.batch
+
+        fa_single = fa_batch = None
+        same = "-"
+        if faiss is not None:
+            index = faiss.IndexFlatIP(args.dim)
+            index.add(matrix)
+            fa_single = timed(lambda: index.search(q1, args.k), args.repeat)
+            fa_batch = timed(lambda: index.search(queries, args.k), args.repeat) / args.batch
+            _, I_faiss = index.search(queries, args.k)
+            _, I_numpy = top_k_inner_product(matrix, queries, args.k)
+            same = "ya" if np.array_equal(np.sort(I_faiss, axis=1), np.sort(I_numpy, axis=1)) else "tidak"
+            del index
+
+        print(
+            f"| {n:,} | {fmt_ms(legacy)} | {fmt_ms(np_single)} | {fmt_ms(np_batch)} "
+            f"| {fmt_ms(fa_single)} | {fmt_ms(fa_batch)} | {same} |"
+        )
+        del matrix
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#  CSIPBLLM — FAKE OLLAMA SERVER (untuk uji lokal tanpa GPU)
+#
+#  Contoh:
+#    python bench/fake_ollama.py --port 11500 --latency 1.0
+#    python bench/fake_ollama.py --port 11501 --latency 2.0 --fail-rate 0.3
+#    python bench/fake_ollama.py --port 11502 --latency 0.5 --token-rate 30 --tokens 200
+#    OLLAMA_BACKENDS=http://localhost:11500,http://localhost:11501 uvicorn ollamaapi:app
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+
+def fake_embedding(text: str, dim: int) -> list:
+    """Embedding deterministik dari hash teks (teks sama -> vektor sama)."""
+    seed = int(hashlib.md5((text or "").encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype("float32").tolist()
+
+
+def create_app(
+    latency: float = 1.0,
+    fail_rate: float = 0.0,
+    embed_dim: int = 64,
+    token_rate: float = 0.0,
+    tokens: int = 60,
+    drop_after: int = 0,
+) -> FastAPI:
+    """
+    token_rate = 0: seluruh generasi butuh `latency` detik (dibagi rata ke tiap kata).
+    token_rate > 0: `latency` = waktu sampai token pertama, lalu `tokens` token dengan laju token_rate/detik.
+    drop_after > 0: stream diputus (koneksi ditutup) setelah sekian token.
+    """
+    app = FastAPI(title="Fake Ollama")
+    stats = {"generate": 0, "embed": 0, "failed": 0, "loads": 0, "context_reused": 0, "prompt_tokens": 0, "models": {}}
+    app.state.stats = stats   # dibaca langsung oleh test yang menjalankan app di proses yang sama
+
+    def maybe_fail():
+        if fail_rate and random.random() < fail_rate:
+            stats["failed"] += 1
+            return JSONResponse({"error": "fake failure"}, status_code=500)
+        return None
+
+    @app.get("/")
+    async def root():
+        return PlainTextResponse("Ollama is running")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": []}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        stats["embed"] += 1
+        inputs = body.get("input")
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        return {"model": body.get("model"), "embeddings": [fake_embedding(t, embed_dim) for t in inputs]}
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats["embed"] += 1
+        return {"embedding": fake_embedding(body.get("prompt"), embed_dim)}
+
+    async def generate_like(request: Request, chat: bool):
+        body = await request.json()
+        stats["generate"] += 1
+        failure = maybe_fail()
+        if failure is not None:
+            return failure
+
+        if not chat and not body.get("prompt") and not body.get("context"):
+            # generate tanpa prompt = hanya memuat model (pre-warm)
+            stats["loads"] += 1
+            return {"model": body.get("model"), "response": "", "done": True, "done_reason": "load"}
+
+        prompt = body.get("prompt") or json.dumps(body.get("messages"), ensure_ascii=False)
+        stats["models"][body.get("model")] = stats["models"].get(body.get("model"), 0) + 1
+        # context = token percakapan sebelumnya; hanya prompt baru yang "di-encode"
+        context = list(body.get("context") or [])
+        if context:
+            stats["context_reused"] += 1
+        prompt_tokens = max(1, len(prompt) // 4)
+        stats["prompt_tokens"] += prompt_tokens
+        digest = hashlib.md5(prompt.encode("utf-8")).hexdigest()[:8]
+        words = f"Jawaban fake {digest}: penjelasan konsep ini sudah benar.".split(" ")
+        if token_rate > 0:
+            words += ["konsep"] * max(0, tokens - len(words))
+        if body.get("format"):
+            # structured output (format json/schema): jawaban dibungkus objek JSON evaluasi
+            verdict = int(digest, 16) % 2 == 0
+            words = json.dumps({"umpan_balik": " ".join(words), "benar": verdict}, ensure_ascii=False).split(" ")
+        if token_rate > 0:
+            first_delay, token_delay = latency, 1.0 / token_rate
+            eval_seconds = len(words) / token_rate
+        else:
+            first_delay, token_delay = 0.0, latency / len(words)
+            eval_seconds = latency
+        text = " ".join(words)
+        final = {
+            "model": body.get("model"),
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(first_delay * 1e9),
+            "eval_count": len(words),
+            "eval_duration": int(eval_seconds * 1e9),
+            "total_duration": int((first_delay + eval_seconds) * 1e9),
+        }
+        if not chat:
+            final["context"] = context + [len(w) for w in prompt.split()[:prompt_tokens]] + [len(w) for w in words]
+
+        if body.get("stream", True):
+            async def token_stream():
+                await asyncio.sleep(first_delay)
+                for i, word in enumerate(words):
+                    if drop_after and i >= drop_after:
+                        raise ConnectionAbortedError("fake stream terputus")
+                    await asyncio.sleep(token_delay)
+                    piece = word if i == 0 else " " + word
+                    if chat:
+                        chunk = {"message": {"role": "assistant", "content": piece}, "done": False}
+                    else:
+                        chunk = {"response": piece, "done": False}
+                    yield json.dumps(chunk) + "\n"
+                if chat:
+                    final["message"] = {"role": "assistant", "content": ""}
+                else:
+                    final["response"] = ""
+                yield json.dumps(final) + "\n"
+
+            return StreamingResponse(token_stream(), media_type="application/x-ndjson")
+
+        await asyncio.sleep(first_delay + eval_seconds)
+        if chat:
+            return {**final, "message": {"role": "assistant", "content": text}}
+        return {**final, "response": text}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        return await generate_like(request, chat=False)
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        return await generate_like(request, chat=True)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama HTTP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=1.0, help="detik per generasi")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="peluang HTTP 500 per generasi")
+    parser.add_argument("--embed-dim", type=int, default=64)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="token/detik; 0 = latency total per generasi")
+    parser.add_argument("--tokens", type=int, default=60, help="panjang jawaban jika --token-rate dipakai")
+    parser.add_argument("--drop-after", type=int, default=0, help="putus stream setelah sekian token (0 = tidak)")
+    args = parser.parse_args()
+
+    print(f"[FAKE] 🤖 Fake Ollama di http://{args.host}:{args.port} (latency={args.latency}s)")
+    uvicorn.run(
+        create_app(args.latency, args.fail_rate, args.embed_dim, args.token_rate, args.tokens, args.drop_after),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+        backlog=4096,
+    )
@@ -0,0 +1,81 @@
+#  CSIPBLLM — GENERATOR MATERI SINTETIS (korpus RAG untuk benchmark)
+#
+#  Contoh:
+#    python bench/gen_materials.py --out /tmp/materials --files 200 --kb 8
+#
+#  Menghasilkan file markdown per minggu (heading, paragraf, blok kode) yang
+#  deterministik untuk seed yang sama.
+
+import argparse
+import os
+import random
+
+TOPICS = [
+    "algoritma", "dekomposisi", "abstraksi", "pengenalan pola", "perulangan", "percabangan",
+    "rekursi", "variabel", "array", "fungsi", "pencarian biner", "pengurutan", "graf",
+    "pohon", "stack", "queue", "kompleksitas waktu", "pseudocode", "flowchart", "debugging",
+]
+WORDS = (
+    "siswa langkah data masalah solusi urutan kondisi nilai hasil contoh proses input output "
+    "program logika konsep struktur elemen indeks iterasi kasus dasar pola aturan model"
+).split()
+CODE_SNIPPETS = [
+    "def jumlah(data):\n    total = 0\n    for x in data:\n        total += x\n    return total",
+    "def faktorial(n):\n    if n <= 1:\n        return 1\n    return n * faktorial(n - 1)",
+    "def cari(data, target):\n    for i, x in enumerate(data):\n        if x == target:\n            return i\n    return -1",
+    "i = 0\nwhile i < 10:\n    print(i)\n    i += 1",
+]
+
+
+def paragraph(rng: random.Random, topic: str) -> str:
+    sentences = []
+    for _ in range(rng.randint(3, 6)):
+        words = rng.choices(WORDS, k=rng.randint(8, 16))
+        words.insert(rng.randrange(len(words)), topic)
+        sentences.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def material_text(rng: random.Random, topic: str, target_chars: int) -> str:
+    parts = [f"# {topic.title()}\n"]
+    section = 1
+    while sum(len(p) for p in parts) < target_chars:
+        parts.append(f"## {section}. {rng.choice(TOPICS).title()} dan {topic}\n")
+        for _ in range(rng.randint(1, 3)):
+            parts.append(paragraph(rng, topic) + "\n")
+        if rng.random() < 0.3:
+            parts.append("```python\n" + rng.choice(CODE_SNIPPETS) + "\n```\n")
+        section += 1
+    return "\n".join(parts)
+
+
+def generate(out_dir: str, files: int = 50, kb: float = 8.0, seed: int = 0) -> int:
+    """Tulis `files` file materi (~kb KB per file) ke out_dir; kembalikan total byte."""
+    rng = random.Random(seed)
+    total = 0
+    for i in range(files):
+        week_dir = os.path.join(out_dir, f"week{i // 10 + 1}")
+        os.makedirs(week_dir, exist_ok=True)
+        topic = TOPICS[i % len(TOPICS)]
+        text = material_text(rng, topic, int(kb * 1024))
+        path = os.path.join(week_dir, f"materi_{i:04d}.md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        total += len(text.encode("utf-8"))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generator materi sintetis untuk RAG")
+    parser.add_argument("--out", default="materials")
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--kb", type=float, default=8.0, help="ukuran kira-kira per file (KB)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    total = generate(args.out, args.files, args.kb, args.seed)
+    print(f"{args.files} file ({total / 1024:.0f} KB) ditulis ke {args.out}")
+
+
+if __name__ == "__main__":
+    main()
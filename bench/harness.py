@@ -0,0 +1,128 @@
+#  CSIPBLLM — HELPER BERSAMA UNTUK SKRIP BENCHMARK
+#
+#  Menjalankan fake Ollama / server aplikasi sebagai subprocess dan
+#  menghitung statistik latensi.
+
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def wait_for_http(url: str, timeout: float = 60.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server tidak merespons: {url}")
+
+
+def start_fake_ollama(
+    port: int, latency: float, token_rate: float = 0.0, tokens: int = 60, embed_dim: int = 64
+) -> subprocess.Popen:
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.join(BENCH_DIR, "fake_ollama.py"),
+            "--port", str(port),
+            "--latency", str(latency),
+            "--token-rate", str(token_rate),
+            "--tokens", str(tokens),
+            "--embed-dim", str(embed_dim),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_http(f"http://127.0.0.1:{port}/")
+    return proc
+
+
+def bench_env(ollama_port: int, work_dir: str, extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """Environment aplikasi yang menunjuk ke fake Ollama dan direktori kerja sementara."""
+    env = dict(os.environ)
+    env.update(
+        {
+            "OLLAMA_PORTS": str(ollama_port),
+            "OLLAMA_BACKENDS": f"http://127.0.0.1:{ollama_port}",
+            "MATERIALS_DIR": os.path.join(work_dir, "materials"),
+            "INDEX_DIR": os.path.join(work_dir, "materials_index"),
+            "RESPONSE_CACHE_PATH": os.path.join(work_dir, "cache", "responses.jsonl"),
+            "SESSION_DB_PATH": os.path.join(work_dir, "cache", "sessions.sqlite3"),
+            "CONVERSATION_DB_PATH": os.path.join(work_dir, "cache", "conversations.sqlite3"),
+        }
+    )
+    env.update(extra or {})
+    return env
+
+
+def start_app(port: int, env: Dict[str, str], workers: int = 1) -> subprocess.Popen:
+    # WORKERS memberi tahu aplikasi bahwa state dibagi antar proses
+    env = dict(env, WORKERS=str(workers))
+    proc = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "ollamaapi:app",
+            "--port", str(port),
+            "--workers", str(workers),
+            "--log-level", "warning",
+        ],
+        cwd=ROOT_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_http(f"http://127.0.0.1:{port}/", timeout=120)
+    return proc
+
+
+def stop(proc: Optional[subprocess.Popen]):
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    """RSS proses (dan anak-anaknya, mis. worker uvicorn) dalam MB; None jika /proc tidak ada."""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            pids += [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return total / 1024
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    arr = np.asarray(samples)
+    return {
+        "p50": float(np.percentile(arr, 50)),
+        "p95": float(np.percentile(arr, 95)),
+        "p99": float(np.percentile(arr, 99)),
+        "mean": float(arr.mean()),
+    }
+
+
+def fmt(value: Optional[float], scale: float = 1000.0, digits: int = 0) -> str:
+    return "-" if value is None else f"{value * scale:.{digits}f}"
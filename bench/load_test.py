@@ -0,0 +1,148 @@
+#  CSIPBLLM — LOAD TEST /chat & /evaluate DENGAN FAKE OLLAMA
+#
+#  Contoh:
+#    python bench/load_test.py
+#    python bench/load_test.py --students 100 --rounds 3 --latency 0.5 --token-rate 40 --tokens 120
+#    python bench/load_test.py --stream --questions 5      # banyak pertanyaan identik (cache/coalescing)
+#
+#  Menjalankan fake Ollama + server aplikasi (uvicorn) di direktori kerja sementara,
+#  lalu mensimulasikan siswa yang bertanya (/chat) dan menjawab (/evaluate).
+
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+import os
+
+import httpx
+
+from gen_materials import TOPICS, generate
+from harness import bench_env, fmt, latency_summary, rss_mb, start_app, start_fake_ollama, stop
+
+
+async def student(client: httpx.AsyncClient, sid: int, args, results: dict, rng: random.Random):
+    session_id = f"siswa-{sid}"
+    for _ in range(args.rounds):
+        topic = TOPICS[rng.randrange(len(TOPICS))]
+        question = f"Jelaskan {topic} nomor {rng.randrange(args.questions)}"
+        for endpoint, body in (
+            ("/chat", {"message": question, "session_id": session_id, "stream": args.stream}),
+            ("/evaluate", {
+                "answer": f"{topic} adalah langkah-langkah terurut",
+                "correct_answer": f"Penjelasan {topic}",
+                "session_id": session_id,
+                "wrong_count": rng.randrange(3),
+                "stream": args.stream,
+            }),
+        ):
+            started = time.perf_counter()
+            ttft = None
+            try:
+                if args.stream:
+                    async with client.stream("POST", endpoint, json=body) as r:
+                        status = r.status_code
+                        async for line in r.aiter_lines():
+                            if ttft is None and line and json.loads(line).get("event") == "token":
+                                ttft = time.perf_counter() - started
+                else:
+                    r = await client.post(endpoint, json=body)
+                    status = r.status_code
+            except httpx.HTTPError:
+                status = "error"
+            elapsed = time.perf_counter() - started
+            bucket = results.setdefault(endpoint, {"latency": [], "ttft": [], "status": {}})
+            bucket["status"][status] = bucket["status"].get(status, 0) + 1
+            if status == 200:
+                bucket["latency"].append(elapsed)
+                if ttft is not None:
+                    bucket["ttft"].append(ttft)
+            if args.think_time:
+                await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test aplikasi dengan fake Ollama")
+    parser.add_argument("--students", type=int, default=50, help="siswa yang berjalan bersamaan")
+    parser.add_argument("--rounds", type=int, default=2, help="pasangan chat+evaluate per siswa")
+    parser.add_argument("--questions", type=int, default=1000, help="variasi pertanyaan (kecil = banyak duplikat)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="jeda acak maks. antar request (detik)")
+    parser.add_argument("--stream", action="store_true", help="pakai stream=true (NDJSON) dan ukur TTFT")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake Ollama: detik sampai token pertama")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="fake Ollama: token/detik")
+    parser.add_argument("--tokens", type=int, default=60, help="fake Ollama: token per jawaban")
+    parser.add_argument("--files", type=int, default=50, help="file materi sintetis")
+    parser.add_argument("--kb", type=float, default=8.0, help="ukuran per file materi (KB)")
+    parser.add_argument("--workers", type=int, default=1, help="worker uvicorn")
+    parser.add_argument("--cache", action="store_true", help="aktifkan response cache (default dimatikan)")
+    parser.add_argument("--app-port", type=int, default=8790)
+    parser.add_argument("--ollama-port", type=int, default=11690)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="csipb-load-")
+    fake = app = None
+    try:
+        generate(os.path.join(work_dir, "materials"), args.files, args.kb)
+        fake = start_fake_ollama(args.ollama_port, args.latency, args.token_rate, args.tokens)
+        extra = {"RESPONSE_CACHE_SIZE": "0"} if not args.cache else {}
+        app = start_app(args.app_port, bench_env(args.ollama_port, work_dir, extra), args.workers)
+        base_url = f"http://127.0.0.1:{args.app_port}"
+
+        started = time.perf_counter()
+        httpx.post(f"{base_url}/materials/reindex", timeout=600)
+        index_seconds = time.perf_counter() - started
+
+        peak = {"rss": rss_mb(app.pid)}
+        stop_sampling = threading.Event()
+
+        def sample_memory():
+            while not stop_sampling.wait(0.2):
+                current = rss_mb(app.pid)
+                if current is not None:
+                    peak["rss"] = max(peak["rss"] or 0.0, current)
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+
+        async def run():
+            limits = httpx.Limits(max_connections=args.students, max_keepalive_connections=args.students)
+            async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+                results: dict = {}
+                t0 = time.perf_counter()
+                await asyncio.gather(
+                    *(student(client, i, args, results, random.Random(i)) for i in range(args.students))
+                )
+                return results, time.perf_counter() - t0
+
+        results, wall = asyncio.run(run())
+        stop_sampling.set()
+        sampler.join()
+
+        total_ok = sum(len(b["latency"]) for b in results.values())
+        print(
+            f"siswa={args.students} rounds={args.rounds} stream={args.stream} workers={args.workers} "
+            f"fake: ttft={args.latency}s {args.token_rate} token/s x {args.tokens} token"
+        )
+        print(f"index {args.files} file: {index_seconds:.2f} detik")
+        print("| endpoint | ok | status | p50 (ms) | p95 (ms) | p99 (ms) | TTFT p50 (ms) | TTFT p95 (ms) |")
+        print("|---|---|---|---|---|---|---|---|")
+        for endpoint, bucket in sorted(results.items()):
+            lat = latency_summary(bucket["latency"])
+            ttft = latency_summary(bucket["ttft"])
+            print(
+                f"| {endpoint} | {len(bucket['latency'])} | {bucket['status']} | {fmt(lat['p50'])} | "
+                f"{fmt(lat['p95'])} | {fmt(lat['p99'])} | {fmt(ttft['p50'])} | {fmt(ttft['p95'])} |"
+            )
+        print(f"throughput: {total_ok / wall:.2f} req/detik ({total_ok} request dalam {wall:.1f} detik)")
+        print(f"memori server (RSS puncak): {fmt(peak['rss'], 1.0)} MB")
+    finally:
+        stop(app)
+        stop(fake)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
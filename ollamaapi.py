@@ -1,35 +1,85 @@
 #  CSIPBLLM PERSONALIZED LEARNING SYSTEM — BACKEND (OLLAMA GPT-OSS)
 
-from fastapi import FastAPI
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
-import requests
+from typing import List, Dict, Optional, Any, AsyncContextManager, AsyncIterator, Callable, Tuple
+import httpx
+import argparse
+import asyncio
+import base64
+import contextlib
+import contextvars
+import hashlib
+import functools
 import json
 import os
 import time
 import re
 import random
+import shutil
+import sqlite3
+import threading
+import uuid
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+# numpy tetap di-import langsung: dipakai di anotasi tingkat modul & inti index, dan hanya ~80 ms
+# (jauh di bawah FastAPI sendiri); yang ditunda hanya modul yang benar-benar berat di bawah ini
 import numpy as np
 
-# import langchain_ollama jika tersedia
 try:
-    from langchain_ollama import ChatOllama, OllamaEmbeddings
-    from langchain_community.chat_message_histories import ChatMessageHistory
-except ImportError:
-    ChatOllama = None          # type: ignore
-    OllamaEmbeddings = None    # type: ignore
-    ChatMessageHistory = None  # type: ignore
-
-# faiss
-try:
-    import faiss  # type: ignore
-except ImportError:
-    faiss = None  # type: ignore
+    import fcntl
+except ImportError:   # Windows: lock antar proses tidak tersedia
+    fcntl = None
+
+# langchain_ollama & faiss berat di-import (~1 detik), jadi ditunda sampai startup di background
+ChatOllama = None          # type: ignore
+OllamaEmbeddings = None    # type: ignore
+faiss = None               # type: ignore
+_optional_modules_loaded = False
+_optional_modules_lock = threading.Lock()
+
+
+def load_optional_modules():
+    """Import langchain_ollama dan faiss jika tersedia (sekali saja)."""
+    global ChatOllama, OllamaEmbeddings, faiss, _optional_modules_loaded
+    with _optional_modules_lock:
+        if _optional_modules_loaded:
+            return
+        try:
+            from langchain_ollama import ChatOllama as _ChatOllama, OllamaEmbeddings as _OllamaEmbeddings
+            ChatOllama, OllamaEmbeddings = _ChatOllama, _OllamaEmbeddings
+        except ImportError:
+            pass
+        try:
+            import faiss as _faiss  # type: ignore
+            faiss = _faiss
+        except ImportError:
+            pass
+        _optional_modules_loaded = True
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup tidak memblokir: deteksi Ollama, inisialisasi LangChain dan pembangunan
+    index berjalan di background; request sebelum index siap dijawab tanpa RAG.
+    """
+    warmup_task = asyncio.create_task(warm_up())
+    health_task = asyncio.create_task(backend_pool.health_loop())
+    try:
+        yield
+    finally:
+        for task in (warmup_task, health_task):
+            task.cancel()
+        await close_ollama_clients()
+
 
 # config fastapi dan file static
-app = FastAPI(title="CSIPBLLM - Kognitif + RAG (FastAPI)")
+app = FastAPI(title="CSIPBLLM - Kognitif + RAG (FastAPI)", lifespan=lifespan)
 
 BASE_DIR = os.path.dirname(__file__)
 STATIC_DIR = os.path.join(BASE_DIR, "static")
@@ -37,6 +87,178 @@ STATIC_DIR = os.path.join(BASE_DIR, "static")
 if os.path.isdir(STATIC_DIR):
     app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+# logging per request & metrics (format teks Prometheus, tanpa dependensi tambahan)
+request_id_var: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("request_id", default=None)
+request_timings_var: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar(
+    "request_timings", default=None
+)
+generation_label_var: "contextvars.ContextVar[str]" = contextvars.ContextVar("generation_label", default="other")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1500)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+TOKEN_COUNT_BUCKETS = (32, 64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192)
+
+
+def log(message: str):
+    """print dengan request id (jika ada) agar log satu request bisa ditelusuri."""
+    rid = request_id_var.get()
+    print(f"[req {rid}] {message}" if rid else message)
+
+
+class Histogram:
+    """Histogram Prometheus sederhana (thread-safe) dengan label."""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(float(b) for b in buckets)
+        self._series: Dict[tuple, List[float]] = {}   # label values -> [count per bucket..., +Inf, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for key, series in items:
+            base = [f'{n}="{v}"' for n, v in zip(self.labelnames, key)]
+            for bound, count in zip(self.buckets, series):
+                labels = ",".join(base + [f'le="{bound:g}"'])
+                lines.append(f"{self.name}_bucket{{{labels}}} {count:g}")
+            labels = ",".join(base + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{{{labels}}} {series[-2]:g}")
+            suffix = "{" + ",".join(base) + "}" if base else ""
+            lines.append(f"{self.name}_count{suffix} {series[-2]:g}")
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:.6f}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("csipb_request_seconds", "Durasi request HTTP", ("method", "path", "status"))
+STAGE_SECONDS = Histogram(
+    "csipb_stage_seconds", "Durasi tahap request (index_load, query_embed, retrieval, prompt_build)", ("stage",)
+)
+LLM_QUEUE_WAIT_SECONDS = Histogram("csipb_llm_queue_wait_seconds", "Waktu tunggu antrean scheduler", ("priority",))
+LLM_TTFT_SECONDS = Histogram("csipb_llm_ttft_seconds", "Waktu sampai token pertama", ("label",))
+LLM_SECONDS = Histogram("csipb_llm_seconds", "Durasi total satu generasi", ("label",))
+LLM_TOKENS_PER_SECOND = Histogram(
+    "csipb_llm_tokens_per_second", "Kecepatan generasi dari eval_count/eval_duration", ("label",), TOKEN_RATE_BUCKETS
+)
+PROMPT_TOKENS = Histogram(
+    "csipb_prompt_tokens", "Perkiraan token prompt per jenis panggilan dan bagian", ("kind", "section"), TOKEN_COUNT_BUCKETS
+)
+LLM_PROMPT_EVAL_TOKENS = Histogram(
+    "csipb_llm_prompt_eval_tokens", "Token prompt yang benar-benar dievaluasi Ollama (prompt_eval_count)", ("label",),
+    TOKEN_COUNT_BUCKETS,
+)
+HISTOGRAMS = [
+    REQUEST_SECONDS, STAGE_SECONDS, LLM_QUEUE_WAIT_SECONDS, LLM_TTFT_SECONDS, LLM_SECONDS, LLM_TOKENS_PER_SECOND,
+    PROMPT_TOKENS, LLM_PROMPT_EVAL_TOKENS,
+]
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_generation(total: float, ttft: Optional[float] = None, data: Optional[Dict[str, Any]] = None):
+    """Catat metrik satu generasi; data = respons akhir Ollama (eval_count, eval_duration, ...)."""
+    label = generation_label_var.get()
+    LLM_SECONDS.observe(total, label=label)
+    if ttft is None and data and data.get("prompt_eval_duration") is not None:
+        # non-streaming: perkiraan TTFT = load + evaluasi prompt
+        ttft = (data.get("load_duration", 0) + data["prompt_eval_duration"]) / 1e9
+    if ttft is not None:
+        LLM_TTFT_SECONDS.observe(ttft, label=label)
+    if data and data.get("prompt_eval_count") is not None:
+        LLM_PROMPT_EVAL_TOKENS.observe(data["prompt_eval_count"], label=label)
+    tokens_per_second = None
+    if data and data.get("eval_count") and data.get("eval_duration"):
+        tokens_per_second = data["eval_count"] / (data["eval_duration"] / 1e9)
+        LLM_TOKENS_PER_SECOND.observe(tokens_per_second, label=label)
+    timings = request_timings_var.get()
+    if timings is not None:
+        timings[f"llm_{label}"] = total
+    rate = f", {tokens_per_second:.1f} token/detik" if tokens_per_second else ""
+    log(f"[LLM] ⏱️ {label}: {total:.2f} detik{rate}")
+
+
+class RequestContextMiddleware:
+    """
+    Middleware ASGI: request id (header X-Request-ID), durasi per tahap, dan histogram
+    durasi request. Dicatat saat body terakhir terkirim sehingga stream ikut terukur.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        rid = headers.get(b"x-request-id", b"").decode("latin-1")[:64] or uuid.uuid4().hex[:12]
+        request_id_var.set(rid)
+        timings: Dict[str, float] = {}
+        request_timings_var.set(timings)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_context(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+
+        finished = False
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            path = getattr(route, "path", None) or scope.get("path", "")
+            REQUEST_SECONDS.observe(elapsed, method=scope.get("method", ""), path=path, status=str(status["code"]))
+            if timings:
+                stages = " ".join(f"{k}={v * 1000:.0f}ms" for k, v in timings.items())
+                log(f"[Timing] {scope.get('method')} {path} {status['code']} total={elapsed * 1000:.0f}ms {stages}")
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        finally:
+            finish()
+
+
+app.add_middleware(RequestContextMiddleware)
+
 
 @app.get("/")
 def serve_index():
@@ -46,343 +268,3128 @@ def serve_index():
     return JSONResponse({"error": "index.html tidak ditemukan"}, status_code=404)
 
 # config ollama
-OLLAMA_PORTS = [11435, 11434]
+OLLAMA_PORTS = [int(p) for p in os.getenv("OLLAMA_PORTS", "11435,11434").split(",") if p.strip()]
 MODEL_NAME = "deepseek-r1:8b"  # model utama untuk chat & evaluasi
+FOLLOWUP_MODEL_NAME = os.getenv("FOLLOWUP_MODEL_NAME", "") or MODEL_NAME   # model kecil untuk pertanyaan lanjutan, mis. qwen2.5:1.5b
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "mxbai-embed-large")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")   # model tetap dimuat selama ini setelah request terakhir (-1 = selamanya)
+OLLAMA_PREWARM = os.getenv("OLLAMA_PREWARM", "1") != "0"    # muat model ke tiap backend saat startup & saat backend pulih
 
-OLLAMA_API_URL = None
 
-for port in OLLAMA_PORTS:
-    try:
-        r = requests.get(f"http://localhost:{port}", timeout=2)
-        if r.status_code in (200, 404):
+def keep_alive_seconds(value: str) -> int:
+    """keep_alive ("30m", "1h", "90s", "-1") dalam detik, untuk client yang hanya menerima angka."""
+    match = re.fullmatch(r"\s*(-?\d+)\s*([smh]?)\s*", value)
+    if match is None:
+        return 300  # default Ollama (5m)
+    return int(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+
+# default port terakhir; diperbarui oleh discover_ollama() saat startup
+OLLAMA_API_URL = f"http://localhost:{OLLAMA_PORTS[-1]}/api/generate"
+base_ollama_url = OLLAMA_API_URL.rsplit("/api/generate", 1)[0]
+ollama_discovered = False
+
+
+async def discover_ollama():
+    """Cek semua port Ollama sekaligus (async); port pertama di OLLAMA_PORTS yang merespons dipakai."""
+    global OLLAMA_API_URL, base_ollama_url, ollama_discovered
+
+    async def probe(client: httpx.AsyncClient, port: int) -> bool:
+        try:
+            r = await client.get(f"http://localhost:{port}")
+            return r.status_code in (200, 404)
+        except Exception:
+            return False
+
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        alive = await asyncio.gather(*(probe(client, port) for port in OLLAMA_PORTS))
+    for port, ok in zip(OLLAMA_PORTS, alive):
+        if ok:
             OLLAMA_API_URL = f"http://localhost:{port}/api/generate"
+            base_ollama_url = f"http://localhost:{port}"
             print(f"[SYSTEM] ✅ Ollama terdeteksi di port {port}")
             break
-    except Exception:
-        continue
-
-if not OLLAMA_API_URL:
-    print("[SYSTEM] ⚠️ Tidak menemukan Ollama di port 11435/11434, asumsi 11434.")
-    OLLAMA_API_URL = "http://localhost:11434/api/generate"
+    else:
+        print(f"[SYSTEM] ⚠️ Tidak menemukan Ollama di port {OLLAMA_PORTS}, asumsi {OLLAMA_PORTS[-1]}.")
+    ollama_discovered = True
 
 # config langchain
 llm = None
-base_ollama_url = OLLAMA_API_URL.rsplit("/api/generate", 1)[0] if OLLAMA_API_URL else None
 
-if ChatOllama is not None and base_ollama_url:
-    try:
-        llm = ChatOllama(
-            model=MODEL_NAME,
-            temperature=0.7,
-            base_url=base_ollama_url,
-        )
-        print("[SYSTEM] ✅ ChatOllama (LangChain) siap.")
-    except Exception as e:
-        llm = None
-        print(f"[SYSTEM] ⚠️ Gagal inisialisasi ChatOllama: {e}")
-else:
-    print("[SYSTEM] ℹ️ LangChain ChatOllama tidak aktif, akan pakai HTTP langsung.")
+# multi-worker: beberapa proses uvicorn berbagi index (mmap) dan state (SQLite WAL) lewat disk
+WORKERS = max(1, int(os.getenv("WORKERS", os.getenv("WEB_CONCURRENCY", "1"))))   # WEB_CONCURRENCY juga dibaca uvicorn
+SQLITE_TIMEOUT = float(os.getenv("SQLITE_TIMEOUT", "30"))   # detik menunggu lock tulis dari worker lain
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Lock eksklusif antar proses (flock); tanpa fcntl hanya lock di dalam proses yang berlaku."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 # rag globals
-MATERIALS_DIR = os.path.join(BASE_DIR, "materials")
-EMBED_CACHE_PATH = os.path.join(BASE_DIR, "materials_index_cache.npy")
-RAG_CHUNK_MAX_CHARS = 400
+MATERIALS_DIR = os.getenv("MATERIALS_DIR", os.path.join(BASE_DIR, "materials"))
+INDEX_DIR = os.getenv("INDEX_DIR", os.path.join(BASE_DIR, "materials_index"))
+MANIFEST_PATH = os.path.join(INDEX_DIR, "manifest.json")
+INDEX_LOCK_PATH = os.path.join(INDEX_DIR, ".lock")   # hanya satu proses yang membangun/menulis index
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "5"))   # detik antar cek index baru dari proses lain
+RAG_CHUNK_TOKENS = int(os.getenv("RAG_CHUNK_TOKENS", "120"))                 # ukuran chunk = yang disisipkan ke prompt
+RAG_CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", "30"))  # kalimat terakhir chunk sebelumnya diulang
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.9"))         # estimasi Jaccard; 0 = dedup nonaktif
 MAX_HISTORY_CHARS = 1200
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))    # chunk per request /api/embed
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))           # batch yang di-embed paralel
+EMBED_BATCH_RETRIES = int(os.getenv("EMBED_BATCH_RETRIES", "3"))
+
+# tipe index FAISS: flat (exact), ivf (centroid terlatih), hnsw (graf)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat").lower()
+FAISS_INDEX_PATH = os.path.join(INDEX_DIR, "faiss.index")
+FAISS_META_PATH = os.path.join(INDEX_DIR, "faiss_meta.json")
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "0"))         # 0 = otomatis (4 * sqrt(n))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+
+# retrieval hybrid: BM25 (inverted index) + vektor, digabung dengan reciprocal rank fusion
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid").lower()     # hybrid | vector | lexical
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+BM25_CODE_WEIGHT = float(os.getenv("BM25_CODE_WEIGHT", "2.0"))     # bobot BM25 di fusi untuk pertanyaan kode
+RRF_K = int(os.getenv("RRF_K", "60"))
+RRF_CANDIDATES = int(os.getenv("RRF_CANDIDATES", "20"))            # kandidat per retriever sebelum fusi
+RAG_EMBED_TIMEOUT = float(os.getenv("RAG_EMBED_TIMEOUT", "3"))     # detik; lebih lambat = BM25 saja (0 = tunggu)
+RAG_EMBED_BACKOFF = float(os.getenv("RAG_EMBED_BACKOFF", "30"))    # detik embedding query dilewati setelah gagal/lambat
 
-materials_index: List[Dict] = []
+# cache embedding query (LRU + TTL)
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "2048"))     # 0 = nonaktif
+QUERY_EMBED_CACHE_TTL = float(os.getenv("QUERY_EMBED_CACHE_TTL", "3600"))     # detik, 0 = tanpa kedaluwarsa
+
+
+def write_file_atomic(path: str, writer):
+    """Tulis ke .tmp lalu os.replace, sehingga pembaca tidak pernah melihat file setengah jadi."""
+    with open(path + ".tmp", "wb") as f:
+        writer(f)
+    os.replace(path + ".tmp", path)
+
+
+# file index berformat lama, langsung di INDEX_DIR (sebelum ada direktori per generasi)
+LEGACY_INDEX_FILES = (
+    "vectors.npy", "chunks.npy", "texts.bin", "meta.json",
+    "bm25_offsets.npy", "bm25_docs.npy", "bm25_weights.npy", "bm25_meta.json",
+)
+
+
+def index_data_dir(generation: str) -> str:
+    """
+    Direktori data (store + BM25) satu generasi index. Generasi baru selalu ditulis ke direktori
+    baru: file yang masih di-mmap tidak pernah ditimpa (os.replace ke file ter-mmap gagal di Windows).
+    """
+    return os.path.join(INDEX_DIR, f"gen-{generation}")
+
+
+class MaterialStore:
+    """
+    Index materi dalam format kolom:
+    - vectors: matriks float32 (n, dim) yang sudah dinormalisasi
+    - chunks: tabel ringkas (offset teks, panjang baris heading, chunk_id, path_id) per baris
+    - texts: blob UTF-8 berisi semua teks chunk
+    Di disk tanpa pickle; dimuat dengan mmap agar beberapa worker berbagi halaman memori.
+    """
+
+    CHUNK_DTYPE = np.dtype(
+        [("text_start", "<i8"), ("text_end", "<i8"), ("header_len", "<i4"), ("chunk_id", "<i4"), ("path_id", "<i4")]
+    )
+
+    def __init__(self, vectors: np.ndarray, chunks: np.ndarray, texts: Any, paths: List[str]):
+        self.vectors = vectors
+        self.chunks = chunks
+        self.texts = texts
+        self.paths = paths
+
+    @classmethod
+    def empty(cls) -> "MaterialStore":
+        return cls(
+            np.zeros((0, 0), dtype="float32"),
+            np.zeros(0, dtype=cls.CHUNK_DTYPE),
+            b"",
+            [],
+        )
+
+    @classmethod
+    def from_items(cls, items: List[Dict]) -> "MaterialStore":
+        """Bangun store dari list dict {embedding, text, source, chunk_id, path, header (opsional)}."""
+        if not items:
+            return cls.empty()
+        paths: List[str] = []
+        path_ids: Dict[str, int] = {}
+        chunks = np.zeros(len(items), dtype=cls.CHUNK_DTYPE)
+        blob = bytearray()
+        for i, item in enumerate(items):
+            path = item.get("path") or item["source"]
+            if path not in path_ids:
+                path_ids[path] = len(paths)
+                paths.append(path)
+            encoded = item["text"].encode("utf-8")
+            header_len = len((item.get("header") or "").encode("utf-8"))
+            chunks[i] = (len(blob), len(blob) + len(encoded), header_len, item["chunk_id"], path_ids[path])
+            blob.extend(encoded)
+        vectors = np.ascontiguousarray(np.stack([item["embedding"] for item in items]), dtype="float32")
+        return cls(vectors, chunks, bytes(blob), paths)
+
+    def __len__(self) -> int:
+        return int(self.chunks.shape[0])
+
+    @property
+    def dim(self) -> int:
+        return int(self.vectors.shape[1]) if len(self) else 0
+
+    def text(self, i: int) -> str:
+        row = self.chunks[i]
+        return bytes(self.texts[int(row["text_start"]):int(row["text_end"])]).decode("utf-8")
+
+    def header(self, i: int) -> str:
+        """Baris jalur heading di awal teks chunk ("" jika chunk tanpa heading)."""
+        row = self.chunks[i]
+        start = int(row["text_start"])
+        return bytes(self.texts[start:start + int(row["header_len"])]).decode("utf-8")
+
+    def path(self, i: int) -> str:
+        return self.paths[int(self.chunks[i]["path_id"])]
+
+    def source(self, i: int) -> str:
+        return os.path.basename(self.path(i))
+
+    def __getitem__(self, i: int) -> Dict:
+        return {
+            "embedding": self.vectors[i],
+            "text": self.text(i),
+            "header": self.header(i),
+            "source": self.source(i),
+            "chunk_id": int(self.chunks[i]["chunk_id"]),
+            "path": self.path(i),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def path_mask(self, paths: set) -> np.ndarray:
+        """Mask baris yang berasal dari salah satu path."""
+        ids = [i for i, p in enumerate(self.paths) if p in paths]
+        return np.isin(self.chunks["path_id"], ids)
+
+    def select(self, mask: np.ndarray) -> "MaterialStore":
+        """Store baru (di RAM) yang hanya berisi baris dengan mask True."""
+        if mask.all():
+            return self
+        if not mask.any():
+            return MaterialStore.empty()
+        chunks = np.asarray(self.chunks)[mask].copy()
+        pieces = [bytes(self.texts[int(a):int(b)]) for a, b in zip(chunks["text_start"], chunks["text_end"])]
+        lengths = np.array([len(piece) for piece in pieces], dtype="int64")
+        chunks["text_end"] = np.cumsum(lengths)
+        chunks["text_start"] = chunks["text_end"] - lengths
+        return MaterialStore(np.asarray(self.vectors)[mask], chunks, b"".join(pieces), list(self.paths))
+
+    def concat(self, other: "MaterialStore") -> "MaterialStore":
+        if not len(self):
+            return other
+        if not len(other):
+            return self
+        offset = len(self.texts)
+        path_ids = {p: i for i, p in enumerate(self.paths)}
+        paths = list(self.paths)
+        remap = np.zeros(len(other.paths), dtype="int32")
+        for j, p in enumerate(other.paths):
+            if p not in path_ids:
+                path_ids[p] = len(paths)
+                paths.append(p)
+            remap[j] = path_ids[p]
+        extra = other.chunks.copy()
+        extra["text_start"] += offset
+        extra["text_end"] += offset
+        extra["path_id"] = remap[extra["path_id"]]
+        return MaterialStore(
+            np.concatenate([np.asarray(self.vectors), np.asarray(other.vectors)]).astype("float32", copy=False),
+            np.concatenate([np.asarray(self.chunks), extra]),
+            bytes(self.texts) + bytes(other.texts),
+            paths,
+        )
+
+    def save(self, directory: str):
+        """Tulis ke direktori generasi baru (index_data_dir); meta.json terakhir sebagai penanda lengkap."""
+        os.makedirs(directory, exist_ok=True)
+
+        def write(name: str, writer):
+            write_file_atomic(os.path.join(directory, name), writer)
+
+        write("vectors.npy", lambda f: np.save(f, np.asarray(self.vectors, dtype="float32")))
+        write("chunks.npy", lambda f: np.save(f, np.asarray(self.chunks)))
+        write("texts.bin", lambda f: f.write(bytes(self.texts)))
+        meta = {"count": len(self), "dim": self.dim, "paths": self.paths}
+        write("meta.json", lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8")))
+
+    @classmethod
+    def load(cls, directory: str) -> "MaterialStore":
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if not meta["count"]:
+            return cls.empty()
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r", allow_pickle=False)
+        chunks = np.load(os.path.join(directory, "chunks.npy"), mmap_mode="r", allow_pickle=False)
+        texts = np.memmap(os.path.join(directory, "texts.bin"), dtype="uint8", mode="r")
+        if vectors.shape[0] != meta["count"] or chunks.shape[0] != meta["count"]:
+            raise ValueError("jumlah baris vectors/chunks tidak cocok dengan meta.json")
+        return cls(vectors, chunks, texts, list(meta["paths"]))
+
+
+materials_index: MaterialStore = MaterialStore.empty()
 materials_loaded = False
 embeddings_model = None
 faiss_index: Any = None
+faiss_index_meta: Dict[str, Any] = {}
+bm25_index: Optional["BM25Index"] = None
+index_generation: Optional[str] = None   # manifest["generation"] dari index di disk yang sedang dipakai
+index_lock = threading.Lock()    # lindungi materials_index & faiss_index saat diganti/di-search
+sync_lock = threading.RLock()    # hanya satu sinkronisasi index pada satu waktu
+_langchain_ready = False
+
+# progres pembangunan index untuk /ready
+index_status: Dict[str, Any] = {
+    "state": "pending",          # pending | loading | embedding | ready | disabled | error
+    "chunks_total": 0,
+    "chunks_embedded": 0,
+    "started_at": None,
+    "finished_at": None,
+    "error": None,
+}
+
+
+def init_langchain_clients():
+    """Buat ChatOllama & OllamaEmbeddings sekali, setelah port Ollama diketahui."""
+    global llm, embeddings_model, _langchain_ready
+    with sync_lock:
+        if _langchain_ready:
+            return
+        load_optional_modules()
+
+        if ChatOllama is not None:
+            try:
+                llm = ChatOllama(
+                    model=MODEL_NAME,
+                    temperature=0.7,
+                    base_url=base_ollama_url,
+                    keep_alive=OLLAMA_KEEP_ALIVE,
+                )
+                print("[SYSTEM] ✅ ChatOllama (LangChain) siap.")
+            except Exception as e:
+                llm = None
+                print(f"[SYSTEM] ⚠️ Gagal inisialisasi ChatOllama: {e}")
+        else:
+            print("[SYSTEM] ℹ️ LangChain ChatOllama tidak aktif, akan pakai HTTP langsung.")
+
+        if OllamaEmbeddings is not None:
+            try:
+                embeddings_model = OllamaEmbeddings(
+                    model=EMBEDDING_MODEL_NAME,
+                    base_url=base_ollama_url,
+                    keep_alive=keep_alive_seconds(OLLAMA_KEEP_ALIVE),
+                )
+                print(f"[RAG] ✅ Embedding model: {EMBEDDING_MODEL_NAME}")
+            except Exception as e:
+                embeddings_model = None
+                print(f"[RAG] ⚠️ Gagal inisialisasi embeddings: {e}")
+        else:
+            print("[RAG] ℹ️ Embeddings Ollama tidak tersedia; RAG terbatas atau nonaktif.")
+        _langchain_ready = True
+
+
+def ivf_nlist(n: int) -> int:
+    return FAISS_IVF_NLIST or max(1, int(4 * np.sqrt(max(n, 1))))
+
+
+def resolve_faiss_index_type(n: int) -> str:
+    """Tipe index efektif; IVF butuh cukup titik untuk melatih centroid, jika kurang pakai flat."""
+    index_type = FAISS_INDEX_TYPE if FAISS_INDEX_TYPE in ("flat", "ivf", "hnsw") else "flat"
+    if index_type == "ivf" and n < 39 * ivf_nlist(n):
+        return "flat"
+    return index_type
+
+
+def skip_faiss_for_workers(n: int) -> bool:
+    """
+    Multi-worker + index flat: FAISS flat = brute force yang sama dengan NumPy atas matriks mmap,
+    jadi FAISS dilewati agar vektor tidak disalin ke RAM di setiap worker.
+    """
+    return WORKERS > 1 and resolve_faiss_index_type(n) == "flat"
+
+
+def faiss_index_params(index_type: str, n: int) -> Dict[str, Any]:
+    if index_type == "ivf":
+        return {"nlist": ivf_nlist(n)}
+    if index_type == "hnsw":
+        return {"M": FAISS_HNSW_M, "efConstruction": FAISS_HNSW_EF_CONSTRUCTION}
+    return {}
+
+
+def create_faiss_index(mat: np.ndarray, index_type: str = "flat", **params: Any):
+    """Bangun index inner-product: flat (exact), ivf (centroid terlatih) atau hnsw (graf)."""
+    dim = mat.shape[1]
+    if index_type == "ivf":
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, int(params["nlist"]), faiss.METRIC_INNER_PRODUCT)
+        index.train(mat)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, int(params["M"]), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = int(params["efConstruction"])
+    else:
+        index = faiss.IndexFlatIP(dim)
+    index.add(mat)
+    return index
 
-if OllamaEmbeddings is not None and base_ollama_url:
+
+def faiss_index_kind(index: Any) -> str:
+    if hasattr(index, "nprobe"):
+        return "ivf"
+    if hasattr(index, "hnsw"):
+        return "hnsw"
+    return "flat"
+
+
+def configure_faiss_search(index: Any, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Set parameter pencarian: nprobe untuk IVF, efSearch untuk HNSW."""
+    kind = faiss_index_kind(index)
+    if kind == "ivf":
+        index.nprobe = int(nprobe or FAISS_NPROBE)
+    elif kind == "hnsw":
+        index.hnsw.efSearch = int(ef_search or FAISS_HNSW_EF_SEARCH)
+    return index
+
+
+def save_faiss_index():
+    """Simpan index terlatih di samping cache embedding agar tidak dilatih ulang saat startup."""
+    if faiss_index is None:
+        # tanpa FAISS (tidak terpasang / multi-worker flat): file lama tidak lagi sejajar dengan store
+        with contextlib.suppress(OSError):
+            os.remove(FAISS_INDEX_PATH)
+        return
     try:
-        embeddings_model = OllamaEmbeddings(
-            model=EMBEDDING_MODEL_NAME,
-            base_url=base_ollama_url,
-        )
-        print(f"[RAG] ✅ Embedding model: {EMBEDDING_MODEL_NAME}")
+        faiss.write_index(faiss_index, FAISS_INDEX_PATH + ".tmp")
+        os.replace(FAISS_INDEX_PATH + ".tmp", FAISS_INDEX_PATH)
+        meta = dict(faiss_index_meta, count=int(faiss_index.ntotal))
+        with open(FAISS_META_PATH, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+    except Exception as e:
+        print(f"[RAG] ⚠️ Gagal simpan FAISS index: {e}")
+
+
+def load_faiss_index() -> bool:
+    """Muat index dari disk jika tipe, parameter dan jumlah baris masih cocok dengan store."""
+    global faiss_index, faiss_index_meta
+    if faiss is None or not materials_index or not os.path.exists(FAISS_INDEX_PATH):
+        return False
+    if skip_faiss_for_workers(len(materials_index)):
+        faiss_index = None
+        return True
+    try:
+        with open(FAISS_META_PATH, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        n = len(materials_index)
+        index_type = resolve_faiss_index_type(n)
+        if meta.get("type") != index_type or meta.get("count") != n:
+            return False
+        # nlist otomatis boleh berbeda sedikit karena n bertambah; yang eksplisit harus sama
+        expected = faiss_index_params(index_type, n)
+        if index_type == "hnsw" and meta.get("params") != expected:
+            return False
+        if index_type == "ivf" and FAISS_IVF_NLIST and meta.get("params") != expected:
+            return False
+        index = faiss.read_index(FAISS_INDEX_PATH)
+        if index.ntotal != n or index.d != materials_index.dim:
+            return False
+        faiss_index = configure_faiss_search(index)
+        faiss_index_meta = meta
+        print(f"[RAG] ✅ FAISS index {index_type} dimuat dari disk (n={n}).")
+        return True
     except Exception as e:
-        embeddings_model = None
-        print(f"[RAG] ⚠️ Gagal inisialisasi embeddings: {e}")
-else:
-    print("[RAG] ℹ️ Embeddings Ollama tidak tersedia; RAG terbatas atau nonaktif.")
+        print(f"[RAG] ⚠️ Gagal memuat FAISS index dari disk: {e}")
+        return False
 
 
 def build_faiss_index():
     """Bangun FAISS index dari materials_index (jika faiss tersedia)."""
-    global faiss_index
-    if faiss is None or not materials_index:
+    global faiss_index, faiss_index_meta
+    if faiss is None or not materials_index or skip_faiss_for_workers(len(materials_index)):
+        faiss_index = None
         return
     try:
-        vecs = [item["embedding"] for item in materials_index]
-        mat = np.stack(vecs).astype("float32")
-        dim = mat.shape[1]
-        index = faiss.IndexFlatIP(dim)
-        index.add(mat)
-        faiss_index = index
-        print(f"[RAG] ✅ FAISS index dibangun (dim={dim}, n={mat.shape[0]}).")
+        mat = np.ascontiguousarray(materials_index.vectors, dtype="float32")
+        n, dim = mat.shape
+        index_type = resolve_faiss_index_type(n)
+        params = faiss_index_params(index_type, n)
+        started = time.perf_counter()
+        faiss_index = configure_faiss_search(create_faiss_index(mat, index_type, **params))
+        faiss_index_meta = {"type": index_type, "params": params, "count": n}
+        print(
+            f"[RAG] ✅ FAISS index {index_type} dibangun (dim={dim}, n={n}, "
+            f"{time.perf_counter() - started:.1f} detik)."
+        )
     except Exception as e:
         faiss_index = None
         print(f"[RAG] ⚠️ Gagal membangun FAISS index: {e}")
 
 
-def load_materials_and_build_index():
+def remove_from_faiss_index(positions: np.ndarray):
     """
-    Memuat materi dari ./materials (txt/md) dan membangun index embedding.
-    Menggunakan cache .npy jika tersedia.
+    Hapus baris FAISS in-place. IndexFlat memadatkan id sehingga tetap sejajar dengan
+    materials_index; IVF diisi ulang memakai centroid yang sudah terlatih; HNSW dibangun ulang.
     """
-    global materials_loaded, materials_index
-
-    if materials_loaded:
+    if faiss_index is None or not len(positions):
         return
+    try:
+        kind = faiss_index_kind(faiss_index)
+        if kind == "flat":
+            faiss_index.remove_ids(np.asarray(positions, dtype="int64"))
+        elif kind == "ivf" and len(materials_index):
+            faiss_index.reset()
+            faiss_index.add(np.ascontiguousarray(materials_index.vectors, dtype="float32"))
+        else:
+            build_faiss_index()
+    except Exception as e:
+        print(f"[RAG] ⚠️ Gagal update FAISS in-place, bangun ulang: {e}")
+        build_faiss_index()
 
-    if embeddings_model is None:
-        print("[RAG] ❌ Embeddings tidak tersedia; RAG dimatikan.")
-        materials_loaded = True
-        return
 
-    if not os.path.isdir(MATERIALS_DIR):
-        print("[RAG] ℹ️ Folder materials tidak ditemukan.")
-        materials_loaded = True
+def add_to_faiss_index(vectors: np.ndarray):
+    if not len(vectors):
+        return
+    if faiss_index is None:
+        build_faiss_index()
         return
+    try:
+        faiss_index.add(np.ascontiguousarray(vectors, dtype="float32"))
+    except Exception as e:
+        print(f"[RAG] ⚠️ Gagal update FAISS in-place, bangun ulang: {e}")
+        build_faiss_index()
 
-    # coba load cache
-    if os.path.exists(EMBED_CACHE_PATH):
-        try:
-            print(f"[RAG] 🔄 Memuat index dari cache: {EMBED_CACHE_PATH}")
-            loaded = np.load(EMBED_CACHE_PATH, allow_pickle=True)
-            materials_index = loaded.tolist()
-            for item in materials_index:
-                v = np.array(item["embedding"], dtype="float32")
-                norm = np.linalg.norm(v)
-                if norm != 0:
-                    item["embedding"] = v / norm
-            build_faiss_index()
-            materials_loaded = True
-            print(f"[RAG] ✅ Index dimuat dari cache ({len(materials_index)} chunk).")
-            return
-        except Exception as e:
-            print(f"[RAG] ⚠️ Gagal load cache, rebuild index: {e}")
 
-    print(f"[RAG] 🔍 Membangun index RAG dari folder: {MATERIALS_DIR}")
+def list_material_files() -> Dict[str, str]:
+    """Semua file txt/md di ./materials: path relatif -> path absolut (urutan os.walk)."""
+    files_found: Dict[str, str] = {}
     for root, _, files in os.walk(MATERIALS_DIR):
         for fname in files:
             if not fname.lower().endswith((".txt", ".md")):
                 continue
             path = os.path.join(root, fname)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    text = f.read().strip()
-            except Exception as e:
-                print(f"[RAG] ⚠️ Gagal baca {path}: {e}")
-                continue
+            files_found[os.path.relpath(path, MATERIALS_DIR)] = path
+    return files_found
 
-            if not text:
-                continue
 
-            chunks = [text[i:i + 800] for i in range(0, len(text), 800)]
-            for idx, chunk in enumerate(chunks):
-                try:
-                    emb = np.array(embeddings_model.embed_query(chunk), dtype="float32")
-                except Exception as e:
-                    print(f"[RAG] ⚠️ Gagal embed chunk {fname}#{idx}: {e}")
-                    continue
+# chunking
+CHUNKER_SIGNATURE = {
+    "version": 3,
+    "tokens": RAG_CHUNK_TOKENS,
+    "overlap": RAG_CHUNK_OVERLAP_TOKENS,
+    "dedup": RAG_DEDUP_THRESHOLD,
+}
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
 
-                norm = np.linalg.norm(emb)
-                if norm != 0:
-                    emb = emb / norm
-
-                materials_index.append(
-                    {
-                        "embedding": emb,
-                        "text": chunk,
-                        "source": fname,
-                        "chunk_id": idx,
-                    }
-                )
 
-    # save cache
-    try:
-        np.save(EMBED_CACHE_PATH, np.array(materials_index, dtype=object))
-        print(f"[RAG] 💾 Cache index disimpan: {EMBED_CACHE_PATH}")
-    except Exception as e:
-        print(f"[RAG] ⚠️ Gagal simpan cache index: {e}")
+def count_tokens(text: str) -> int:
+    """
+    Perkiraan jumlah token tanpa tokenizer model: tiap tanda baca 1 token,
+    tiap kata ~4 karakter per token (mendekati tokenizer BPE untuk teks Indonesia & kode).
+    """
+    return sum((len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1 for piece in _TOKEN_RE.findall(text))
 
-    build_faiss_index()
-    materials_loaded = True
-    print(f"[RAG] ✅ Index RAG selesai ({len(materials_index)} chunk).")
 
+def split_material_blocks(text: str) -> List[Dict[str, Any]]:
+    """
+    Pecah markdown/teks menjadi blok: paragraf (dipisah baris kosong) dan blok kode
+    berpagar (``` / ~~~) yang utuh, masing-masing dengan jalur heading di atasnya.
+    """
+    blocks: List[Dict[str, Any]] = []
+    headings: List[str] = []
+    lines: List[str] = []
+    fence: Optional[str] = None
 
-def retrieve_relevant_chunks(query: str, k: int = 4) -> List[Dict]:
-    """Ambil k chunk paling relevan via cosine similarity (FAISS jika ada)."""
-    if embeddings_model is None or not materials_loaded or not materials_index:
-        return []
+    def flush(kind: str = "text"):
+        body = "\n".join(lines).strip("\n")
+        if body.strip():
+            blocks.append({"headings": tuple(headings), "kind": kind, "text": body})
+        lines.clear()
 
-    try:
-        q_emb = np.array(embeddings_model.embed_query(query), dtype="float32")
-    except Exception as e:
-        print(f"[RAG] ⚠️ Gagal embed query RAG: {e}")
-        return []
+    for line in text.splitlines():
+        if fence is not None:
+            lines.append(line)
+            if line.strip().startswith(fence):
+                flush("code")
+                fence = None
+            continue
+        fence_match = _FENCE_RE.match(line)
+        if fence_match:
+            flush()
+            fence = fence_match.group(1)
+            lines.append(line)
+            continue
+        heading = _HEADING_RE.match(line)
+        if heading:
+            flush()
+            del headings[len(heading.group(1)) - 1:]
+            headings.append(heading.group(2))
+            continue
+        if not line.strip():
+            flush()
+            continue
+        lines.append(line)
+    flush("code" if fence is not None else "text")
+    return blocks
 
-    norm = np.linalg.norm(q_emb)
-    if norm != 0:
-        q_emb = q_emb / norm
 
-    results: List[Dict] = []
+def _split_chars(text: str, budget: int) -> List[str]:
+    """Potong per karakter teks tanpa spasi (URL, base64, kode minified) yang lebih besar dari budget."""
+    pieces: List[str] = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + budget * 4)
+        tokens = count_tokens(text[start:end])
+        while tokens > budget and end - start > 1:
+            end = start + max(1, (end - start) * budget // tokens)
+            tokens = count_tokens(text[start:end])
+        pieces.append(text[start:end])
+        start = end
+    return pieces
 
-    # faiss
-    if faiss_index is not None:
-        try:
-            D, I = faiss_index.search(q_emb.reshape(1, -1).astype("float32"), k)
-            idxs = I[0]
-            scores = D[0]
-            for idx, score in zip(idxs, scores):
-                if idx < 0 or score <= 0:
+
+def _split_words(text: str, budget: int) -> List[str]:
+    """
+    Potong teks panjang tanpa tanda kalimat per kata hingga muat budget token;
+    kata yang sendirian melebihi budget dipotong per karakter.
+    """
+    pieces: List[str] = []
+    current: List[str] = []
+    used = 0
+    for word in text.split():
+        parts = [word] if count_tokens(word) <= budget else _split_chars(word, budget)
+        for j, part in enumerate(parts):
+            cost = count_tokens(part)
+            if current and used + cost > budget:
+                pieces.append(" ".join(current))
+                current, used = [], 0
+            current.append(part)
+            used += cost
+            if j < len(parts) - 1:
+                # potongan kata tidak boleh disambung spasi dengan potongan berikutnya
+                pieces.append(" ".join(current))
+                current, used = [], 0
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def _block_units(block: Dict[str, Any], budget: int) -> List[Dict[str, Any]]:
+    """
+    Satuan terkecil untuk packing: blok utuh jika muat; paragraf panjang dipecah per kalimat,
+    blok kode panjang per baris (tiap potongan tetap berpagar).
+    """
+    text = block["text"]
+    tokens = count_tokens(text)
+    if tokens <= budget:
+        return [{"text": text, "tokens": tokens, "sep": "\n\n", "kind": block["kind"]}]
+
+    units: List[Dict[str, Any]] = []
+    if block["kind"] == "code":
+        code_lines = text.split("\n")
+        opening = code_lines[0]
+        closing = code_lines[-1] if len(code_lines) > 1 and _FENCE_RE.match(code_lines[-1]) else opening.strip()[:3]
+        body = code_lines[1:-1] if len(code_lines) > 1 and _FENCE_RE.match(code_lines[-1]) else code_lines[1:]
+        frame = count_tokens(opening) + count_tokens(closing)
+        room = max(1, budget - frame)
+        fitted: List[str] = []
+        for line in body:
+            # baris yang sendirian melebihi budget (mis. kode minified) dipotong per karakter
+            fitted.extend([line] if count_tokens(line) <= room else _split_chars(line, room))
+        current: List[str] = []
+        used = frame
+        for line in fitted:
+            cost = count_tokens(line)
+            if current and used + cost > budget:
+                piece = "\n".join([opening, *current, closing])
+                units.append({"text": piece, "tokens": used, "sep": "\n\n", "kind": "code"})
+                current, used = [], frame
+            current.append(line)
+            used += cost
+        if current:
+            piece = "\n".join([opening, *current, closing])
+            units.append({"text": piece, "tokens": used, "sep": "\n\n", "kind": "code"})
+        return units
+
+    for sentence in _SENTENCE_RE.split(text):
+        pieces = [sentence] if count_tokens(sentence) <= budget else _split_words(sentence, budget)
+        for piece in pieces:
+            units.append({"text": piece, "tokens": count_tokens(piece), "sep": " " if units else "\n\n", "kind": "text"})
+    return units
+
+
+def chunk_material_text(text: str, source: str, rel_path: str) -> List[Dict]:
+    """
+    Chunking sadar struktur: chunk tidak melewati batas heading, paragraf dan blok kode
+    tidak dipotong kecuali lebih besar dari RAG_CHUNK_TOKENS, dan tiap chunk diawali jalur
+    heading-nya. Chunk lanjutan dalam satu bagian mengulang kalimat terakhir chunk sebelumnya
+    (maks. RAG_CHUNK_OVERLAP_TOKENS). Ukuran chunk = teks yang disisipkan ke prompt.
+    """
+    chunks: List[Dict] = []
+
+    def emit(header: str, units: List[Dict[str, Any]]):
+        body = "".join((u["sep"] if i else "") + u["text"] for i, u in enumerate(units))
+        chunk_text = f"{header}\n{body}" if header else body
+        chunks.append({"text": chunk_text, "header": header, "source": source, "chunk_id": len(chunks), "path": rel_path})
+
+    sections: List[Tuple[Tuple[str, ...], List[Dict[str, Any]]]] = []
+    for block in split_material_blocks(text):
+        if not sections or sections[-1][0] != block["headings"]:
+            sections.append((block["headings"], []))
+        sections[-1][1].append(block)
+
+    for headings, blocks in sections:
+        header = " > ".join(headings)
+        if count_tokens(header) > RAG_CHUNK_TOKENS // 3:
+            header = headings[-1] if headings else ""
+        budget = max(16, RAG_CHUNK_TOKENS - count_tokens(header))
+
+        current: List[Dict[str, Any]] = []
+        used = 0
+        for block in blocks:
+            for unit in _block_units(block, budget):
+                if current and used + unit["tokens"] > budget:
+                    emit(header, current)
+                    # overlap: bawa kalimat teks terakhir yang muat ke chunk berikutnya
+                    carried: List[Dict[str, Any]] = []
+                    carried_tokens = 0
+                    for prev in reversed(current):
+                        if prev["kind"] != "text" or carried_tokens + prev["tokens"] > RAG_CHUNK_OVERLAP_TOKENS:
+                            break
+                        carried.insert(0, prev)
+                        carried_tokens += prev["tokens"]
+                    if carried_tokens + unit["tokens"] > budget:
+                        carried, carried_tokens = [], 0
+                    current, used = carried, carried_tokens
+                current.append(unit)
+                used += unit["tokens"]
+        if current:
+            emit(header, current)
+    return chunks
+
+
+class NearDuplicateIndex:
+    """
+    Deteksi chunk yang hampir sama: MinHash atas shingle 3 kata + LSH (band 2 baris).
+    Chunk dianggap duplikat jika estimasi Jaccard >= threshold terhadap chunk yang sudah ada.
+    """
+
+    NUM_PERM = 32
+    ROWS_PER_BAND = 2
+    _PRIME = (1 << 31) - 1
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        rng = np.random.default_rng(7)
+        self._a = rng.integers(1, self._PRIME, self.NUM_PERM, dtype=np.uint64)
+        self._b = rng.integers(0, self._PRIME, self.NUM_PERM, dtype=np.uint64)
+        self._signatures: List[np.ndarray] = []
+        self._keys: List[str] = []
+        self._buckets: Dict[Tuple[int, bytes], List[int]] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = np.fromiter(
+            (zlib.crc32(sh.encode("utf-8")) & self._PRIME for sh in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % self._PRIME).min(axis=1)
+
+    def _bands(self, signature: np.ndarray):
+        for band in range(self.NUM_PERM // self.ROWS_PER_BAND):
+            yield band, signature[band * self.ROWS_PER_BAND:(band + 1) * self.ROWS_PER_BAND].tobytes()
+
+    def find(self, signature: np.ndarray) -> Optional[str]:
+        """Key chunk yang hampir sama dengan signature ini, atau None."""
+        seen = set()
+        for bucket in self._bands(signature):
+            for i in self._buckets.get(bucket, ()):
+                if i in seen:
                     continue
-                item = materials_index[int(idx)]
-                results.append(
-                    {
-                        "text": item["text"],
-                        "source": item["source"],
-                        "score": float(score),
-                    }
-                )
-            return results
+                seen.add(i)
+                if float(np.mean(self._signatures[i] == signature)) >= self.threshold:
+                    return self._keys[i]
+        return None
+
+    def add(self, key: str, signature: np.ndarray):
+        i = len(self._signatures)
+        self._signatures.append(signature)
+        self._keys.append(key)
+        for bucket in self._bands(signature):
+            self._buckets.setdefault(bucket, []).append(i)
+
+
+def collect_material_chunks() -> List[Dict]:
+    """Baca semua file txt/md di ./materials dan potong dengan chunk_material_text (urutan os.walk)."""
+    chunks: List[Dict] = []
+    for rel_path, path in list_material_files().items():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read().strip()
+        except Exception as e:
+            print(f"[RAG] ⚠️ Gagal baca {path}: {e}")
+            continue
+        if text:
+            chunks.extend(chunk_material_text(text, os.path.basename(path), rel_path))
+    return chunks
+
+
+def _embed_batch(batch: List[Dict], retries: int = EMBED_BATCH_RETRIES, delay: float = 2.0) -> List[Optional[np.ndarray]]:
+    """
+    Embed satu batch lewat embed_documents (satu request /api/embed).
+    Jika batch tetap gagal setelah retry, embed per chunk agar hanya chunk rusak yang terlewat.
+    """
+    texts = [c["text"] for c in batch]
+    for attempt in range(retries):
+        try:
+            vectors = embeddings_model.embed_documents(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"jumlah embedding {len(vectors)} != {len(texts)}")
+            return [np.array(v, dtype="float32") for v in vectors]
+        except Exception as e:
+            print(f"[RAG] ⚠️ Batch embed gagal (attempt {attempt + 1}/{retries}): {e}")
+            if attempt < retries - 1:
+                time.sleep(delay * (2 ** attempt))
+
+    results: List[Optional[np.ndarray]] = []
+    for c in batch:
+        try:
+            results.append(np.array(embeddings_model.embed_query(c["text"]), dtype="float32"))
         except Exception as e:
-            print(f"[RAG] ⚠️ FAISS error, fallback NumPy: {e}")
+            print(f"[RAG] ⚠️ Gagal embed chunk {c['source']}#{c['chunk_id']}: {e}")
+            results.append(None)
+    return results
 
-    # numpy fallback
-    scores = []
-    for item in materials_index:
-        score = float(np.dot(q_emb, item["embedding"]))
-        scores.append(score)
 
-    if not scores:
+def embed_chunks_batched(chunks: List[Dict]) -> List[Dict]:
+    """
+    Embed chunk secara batch (EMBED_BATCH_SIZE) dengan beberapa worker paralel (EMBED_WORKERS).
+    Urutan hasil sama dengan urutan chunk; vektor dinormalisasi seperti sebelumnya.
+    """
+    if not chunks:
         return []
 
-    idxs = np.argsort(scores)[::-1][:k]
-    for i in idxs:
-        score = scores[i]
-        if score <= 0:
+    batch_size = max(1, EMBED_BATCH_SIZE)
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+    vectors: List[Optional[np.ndarray]] = [None] * len(chunks)
+    done_chunks = 0
+    started = time.perf_counter()
+    index_status.update(chunks_total=len(chunks), chunks_embedded=0)
+
+    with ThreadPoolExecutor(max_workers=max(1, EMBED_WORKERS), thread_name_prefix="embed") as pool:
+        futures = {pool.submit(_embed_batch, batch): b for b, batch in enumerate(batches)}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            b = futures[future]
+            offset = b * batch_size
+            for j, emb in enumerate(future.result()):
+                vectors[offset + j] = emb
+            done_chunks += len(batches[b])
+            index_status["chunks_embedded"] = done_chunks
+            elapsed = time.perf_counter() - started
+            print(
+                f"[RAG] 📦 Batch {n_done}/{len(batches)} selesai "
+                f"({done_chunks}/{len(chunks)} chunk, {elapsed:.1f} detik)"
+            )
+
+    items: List[Dict] = []
+    for chunk, emb in zip(chunks, vectors):
+        if emb is None:
             continue
-        item = materials_index[i]
-        results.append(
-            {
-                "text": item["text"],
-                "source": item["source"],
-                "score": float(score),
-            }
-        )
-    return results
+        norm = np.linalg.norm(emb)
+        if norm != 0:
+            emb = emb / norm
+        items.append({"embedding": emb, **chunk})
+    return items
 
-# memory per session
-session_histories: Dict[str, Any] = {}
-conversation_history: List[Dict] = []
 
+def empty_manifest() -> Dict[str, Any]:
+    return {"embedding_model": EMBEDDING_MODEL_NAME, "chunker": CHUNKER_SIGNATURE, "files": {}}
+
+
+def load_manifest() -> Dict[str, Any]:
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("embedding_model") != EMBEDDING_MODEL_NAME:
+            print("[RAG] ℹ️ Model embedding berubah, index dibangun ulang.")
+        elif manifest.get("chunker") != CHUNKER_SIGNATURE:
+            print("[RAG] ℹ️ Pengaturan chunking berubah, index dibangun ulang.")
+        else:
+            return manifest
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[RAG] ⚠️ Manifest tidak valid, index dibangun ulang: {e}")
+    return empty_manifest()
+
+
+def save_index_cache(manifest: Dict[str, Any]) -> bool:
+    """
+    Tulis store (dan BM25 jika masih sejajar) ke direktori generasi baru, FAISS, lalu manifest
+    yang menunjuk generasi itu; generation baru menandai worker lain untuk memuat ulang.
+    """
+    global index_generation
+    generation = uuid.uuid4().hex
+    with index_lock:
+        store, lexical = materials_index, bm25_index
+    try:
+        directory = index_data_dir(generation)
+        store.save(directory)
+        if lexical is not None and lexical.store is store:
+            lexical.save(directory, generation)
+        save_faiss_index()
+        manifest["generation"] = generation
+        tmp_path = MANIFEST_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, MANIFEST_PATH)
+    except Exception as e:
+        print(f"[RAG] ⚠️ Gagal simpan cache index: {e!r}")
+        with contextlib.suppress(OSError):
+            shutil.rmtree(index_data_dir(generation))
+        return False
+    index_generation = generation
+    print(f"[RAG] 💾 Cache index disimpan: {directory}")
+    return True
+
+
+def remove_stale_index_data():
+    """
+    Hapus direktori generasi lama dan file berformat lama. File yang masih di-mmap (Windows)
+    belum bisa dihapus; dicoba lagi setelah penyimpanan berikutnya.
+    """
+    current = f"gen-{index_generation}"
+    try:
+        names = os.listdir(INDEX_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(INDEX_DIR, name)
+        try:
+            if name.startswith("gen-") and name != current:
+                shutil.rmtree(path)
+            elif name in LEGACY_INDEX_FILES:
+                os.remove(path)
+        except OSError as e:
+            print(f"[RAG] ℹ️ Index lama {name} belum bisa dihapus (masih dipakai?): {e}")
+
+
+def load_index_from_disk(generation: str) -> bool:
+    """
+    Pakai index di disk (mmap) yang ditulis proses ini saat startup sebelumnya atau oleh worker lain.
+    True jika index masih berformat lama (langsung di INDEX_DIR) dan perlu disimpan ulang.
+    """
+    global materials_index, index_generation
+    directory = index_data_dir(generation)
+    legacy = not os.path.exists(os.path.join(directory, "meta.json"))
+    store = MaterialStore.load(INDEX_DIR if legacy else directory)
+    with index_lock:
+        materials_index = store
+        if not load_faiss_index():
+            build_faiss_index()
+            save_faiss_index()
+        index_generation = generation
+    return legacy
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def sync_materials_index() -> Dict[str, int]:
+    """
+    Sinkronkan index dengan isi ./materials berdasarkan manifest (path, mtime, size, sha256).
+    Hanya file baru/berubah yang di-embed ulang; vektor file yang dihapus/berubah dibuang
+    dari materials_index dan FAISS index secara in-place.
+    Antar proses dijaga INDEX_LOCK_PATH: index dibangun sekali, worker lain memuat hasilnya (mmap).
+    """
+    global materials_index, index_manifest_mtime
+
+    with sync_lock, file_lock(INDEX_LOCK_PATH):
+        manifest = load_manifest()
+        generation = manifest.get("generation", "")
+        legacy = False
+        if manifest["files"] and generation != index_generation:
+            # index di disk lebih baru dari yang dipakai proses ini (startup / ditulis worker lain)
+            try:
+                print(f"[RAG] 🔄 Memuat index dari cache: {INDEX_DIR}")
+                legacy = load_index_from_disk(generation)
+                print(f"[RAG] ✅ Index dimuat dari cache ({len(materials_index)} chunk).")
+            except Exception as e:
+                print(f"[RAG] ⚠️ Gagal load cache, rebuild index: {e}")
+                manifest = empty_manifest()
+                with index_lock:
+                    materials_index = MaterialStore.empty()
+                    build_faiss_index()
+        known: Dict[str, Dict[str, Any]] = manifest["files"]
+        if not known and materials_index:
+            # cache tanpa manifest: tidak bisa dipetakan per file
+            with index_lock:
+                materials_index = MaterialStore.empty()
+                build_faiss_index()
+
+        current = list_material_files()
+        removed = [p for p in known if p not in current]
+        changed: List[str] = []
+        added: List[str] = []
+        new_entries: Dict[str, Dict[str, Any]] = {}
+        new_chunks: List[Dict] = []
+        pending: Dict[str, str] = {}     # path relatif -> isi file yang perlu di-chunk & embed ulang
+        touched = False
+
+        for rel_path, path in current.items():
+            try:
+                st = os.stat(path)
+            except OSError as e:
+                print(f"[RAG] ⚠️ Gagal baca {path}: {e}")
+                continue
+            entry = known.get(rel_path)
+            complete = entry is not None and not entry.get("incomplete")
+            if complete and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+                continue
+            try:
+                digest = _file_sha256(path)
+                if complete and entry["sha256"] == digest:
+                    entry["mtime"] = st.st_mtime  # hanya di-touch, isi sama
+                    touched = True
+                    continue
+                with open(path, "r", encoding="utf-8") as f:
+                    text = f.read().strip()
+            except Exception as e:
+                print(f"[RAG] ⚠️ Gagal baca {path}: {e}")
+                continue
+            (changed if entry else added).append(rel_path)
+            pending[rel_path] = text
+            new_entries[rel_path] = {"mtime": st.st_mtime, "size": st.st_size, "sha256": digest}
+
+        # file yang chunk-nya dibuang sebagai duplikat dari file yang kini dihapus/berubah
+        # harus di-chunk ulang, jika tidak isinya hilang dari index
+        while True:
+            invalid = set(removed) | set(pending)
+            dependents = [
+                p for p, e in known.items()
+                if p in current and p not in pending and invalid.intersection(e.get("dedup_against", ()))
+            ]
+            if not dependents:
+                break
+            for rel_path in dependents:
+                try:
+                    with open(current[rel_path], "r", encoding="utf-8") as f:
+                        pending[rel_path] = f.read().strip()
+                except Exception as e:
+                    print(f"[RAG] ⚠️ Gagal baca {current[rel_path]}: {e}")
+                    pending[rel_path] = ""
+                changed.append(rel_path)
+                new_entries[rel_path] = {k: v for k, v in known[rel_path].items() if k in ("mtime", "size", "sha256")}
+
+        dedup: Optional[NearDuplicateIndex] = None
+        if pending and RAG_DEDUP_THRESHOLD > 0:
+            dedup = NearDuplicateIndex(RAG_DEDUP_THRESHOLD)
+            with index_lock:
+                store = materials_index
+            for i in range(len(store)):
+                if store.path(i) not in pending and store.path(i) not in removed:
+                    dedup.add(store.path(i), dedup.signature(store.text(i)))
+        n_duplicates = 0
+        for rel_path, text in pending.items():
+            chunks = chunk_material_text(text, os.path.basename(rel_path), rel_path) if text else []
+            dedup_against = set()
+            if dedup is not None:
+                kept = []
+                for chunk in chunks:
+                    signature = dedup.signature(chunk["text"])
+                    original = dedup.find(signature)
+                    if original is None:
+                        dedup.add(rel_path, signature)
+                        kept.append(chunk)
+                    elif original != rel_path:
+                        dedup_against.add(original)
+                n_duplicates += len(chunks) - len(kept)
+                chunks = kept
+            new_chunks.extend(chunks)
+            new_entries[rel_path]["n_chunks"] = len(chunks)
+            if dedup_against:
+                new_entries[rel_path]["dedup_against"] = sorted(dedup_against)
+        if n_duplicates:
+            print(f"[RAG] ♻️ {n_duplicates} chunk hampir duplikat dibuang.")
+
+        # embed hanya chunk baru (di luar index_lock agar retrieval tetap jalan)
+        new_items: List[Dict] = []
+        if new_chunks:
+            print(f"[RAG] 🔍 Embed {len(new_chunks)} chunk dari {len(added) + len(changed)} file baru/berubah.")
+            if index_status["state"] == "loading":
+                index_status["state"] = "embedding"
+            new_items = embed_chunks_batched(new_chunks)
+            # file dengan chunk yang gagal di-embed ditandai agar di-embed ulang pada sync berikutnya
+            embedded = Counter(item["path"] for item in new_items)
+            for rel_path, entry in new_entries.items():
+                if embedded[rel_path] < entry["n_chunks"]:
+                    entry["incomplete"] = True
+                    print(
+                        f"[RAG] ⚠️ {entry['n_chunks'] - embedded[rel_path]} chunk {rel_path} gagal di-embed, "
+                        "dicoba lagi pada sync berikutnya."
+                    )
+
+        # buang vektor file yang dihapus / berubah, lalu tambahkan yang baru
+        dropped = set(removed) | set(changed)
+        with index_lock:
+            if dropped:
+                mask = materials_index.path_mask(dropped)
+                materials_index = materials_index.select(~mask)
+                remove_from_faiss_index(np.flatnonzero(mask))
+            if new_items:
+                added_store = MaterialStore.from_items(new_items)
+                materials_index = materials_index.concat(added_store)
+                add_to_faiss_index(added_store.vectors)
+        for rel_path in removed:
+            known.pop(rel_path, None)
+        known.update(new_entries)
+
+        summary = {
+            "added": len(added),
+            "changed": len(changed),
+            "removed": len(removed),
+            "chunks": len(materials_index),
+        }
+        saved = False
+        if added or changed or removed or touched or legacy or not os.path.exists(MANIFEST_PATH):
+            saved = save_index_cache(manifest)
+            if saved:
+                # tukar ke mmap generasi baru: RAM hasil rebuild dilepas, halaman dibagi antar worker,
+                # dan file generasi lama tidak lagi dipegang sehingga bisa dihapus
+                try:
+                    reloaded = MaterialStore.load(index_data_dir(index_generation))
+                    with index_lock:
+                        materials_index = reloaded
+                except Exception as e:
+                    print(f"[RAG] ⚠️ Gagal memuat ulang index mmap: {e}")
+        build_bm25_index()
+        if saved:
+            remove_stale_index_data()
+        with contextlib.suppress(OSError):
+            index_manifest_mtime = os.stat(MANIFEST_PATH).st_mtime
+        print(
+            f"[RAG] ✅ Index sinkron: +{summary['added']} baru, ~{summary['changed']} berubah, "
+            f"-{summary['removed']} dihapus ({summary['chunks']} chunk)."
+        )
+        return summary
+
+
+def load_materials_and_build_index():
+    """
+    Memuat materi dari ./materials (txt/md) dan membangun index embedding.
+    Cache .npy + manifest dipakai ulang; hanya file yang berubah di-embed ulang.
+    """
+    global materials_loaded
+
+    if materials_loaded:
+        return
+
+    with sync_lock:
+        if materials_loaded:
+            return
+
+        load_optional_modules()
+        init_langchain_clients()
+        started = time.perf_counter()
+        index_status.update(state="loading", started_at=time.time(), finished_at=None, error=None)
+
+        if embeddings_model is None:
+            print("[RAG] ❌ Embeddings tidak tersedia; RAG dimatikan.")
+            index_status.update(state="disabled", finished_at=time.time())
+            materials_loaded = True
+            return
+
+        if not os.path.isdir(MATERIALS_DIR):
+            print("[RAG] ℹ️ Folder materials tidak ditemukan.")
+            index_status.update(state="disabled", finished_at=time.time())
+            materials_loaded = True
+            return
+
+        # cache (mmap, tanpa pickle & tanpa normalisasi ulang) dimuat oleh sync_materials_index
+        if not os.path.exists(MANIFEST_PATH):
+            print(f"[RAG] 🔍 Membangun index RAG dari folder: {MATERIALS_DIR}")
+
+        try:
+            sync_materials_index()
+        except Exception as e:
+            index_status.update(state="error", error=str(e), finished_at=time.time())
+            print(f"[RAG] ❌ Gagal membangun index: {e}")
+            return
+        materials_loaded = True
+        index_status.update(state="ready", finished_at=time.time())
+        observe_stage("index_load", time.perf_counter() - started)
+
+
+_warmup_thread: Optional[threading.Thread] = None
+_reload_thread: Optional[threading.Thread] = None
+_warmup_lock = threading.Lock()
+index_manifest_mtime: Optional[float] = None   # mtime manifest saat sinkronisasi terakhir proses ini
+_index_checked_at = 0.0
+
+
+def start_index_warmup():
+    """Muat/bangun index di thread background (sekali); request tidak ikut menunggu."""
+    global _warmup_thread
+    with _warmup_lock:
+        if materials_loaded or (_warmup_thread is not None and _warmup_thread.is_alive()):
+            return
+        _warmup_thread = threading.Thread(target=load_materials_and_build_index, name="index-warmup", daemon=True)
+        _warmup_thread.start()
+
+
+def _reload_index():
+    try:
+        sync_materials_index()
+    except Exception as e:
+        print(f"[RAG] ⚠️ Gagal memuat ulang index: {e}")
+
+
+def maybe_reload_index():
+    """
+    Multi-worker/proses: jika manifest di disk berubah sejak sinkronisasi terakhir proses ini
+    (mis. /materials/reindex di worker lain), muat index baru di background. Dicek paling
+    sering tiap INDEX_RELOAD_INTERVAL detik.
+    """
+    global _index_checked_at, _reload_thread
+    now = time.monotonic()
+    if now - _index_checked_at < INDEX_RELOAD_INTERVAL:
+        return
+    _index_checked_at = now
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime
+    except OSError:
+        return
+    if mtime == index_manifest_mtime:
+        return
+    with _warmup_lock:
+        if _reload_thread is not None and _reload_thread.is_alive():
+            return
+        _reload_thread = threading.Thread(target=_reload_index, name="index-reload", daemon=True)
+        _reload_thread.start()
+
+
+async def warm_up():
+    """Tugas background saat startup: deteksi Ollama, LangChain, index RAG, lalu pre-warm model."""
+    await asyncio.gather(discover_ollama(), run_in_threadpool(response_cache.load))
+    await run_in_threadpool(init_langchain_clients)
+    start_index_warmup()
+    if OLLAMA_PREWARM:
+        await asyncio.gather(*(prewarm_backend(b) for b in backend_pool.backends), prewarm_embedding_model())
+
+
+@app.get("/ready")
+def get_ready():
+    """Kesiapan server: 200 jika index RAG siap (atau nonaktif), 503 selama masih dibangun."""
+    status = dict(index_status)
+    if status["chunks_total"]:
+        status["percent"] = round(100 * status["chunks_embedded"] / status["chunks_total"], 1)
+    status["chunks_indexed"] = len(materials_index)
+    ready = status["state"] in ("ready", "disabled")
+    body = {"ready": ready, "ollama_discovered": ollama_discovered, "ollama_url": base_ollama_url, "index": status}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+
+@app.post("/materials/reindex")
+async def reindex_materials():
+    """Sinkronkan ulang index RAG setelah file di ./materials ditambah/diubah/dihapus."""
+    if not materials_loaded:
+        await run_in_threadpool(load_materials_and_build_index)
+        return {"status": "ok" if materials_loaded else "error", "chunks": len(materials_index)}
+    if embeddings_model is None or not os.path.isdir(MATERIALS_DIR):
+        return {"status": "disabled"}
+    summary = await run_in_threadpool(sync_materials_index)
+    return {"status": "ok", **summary}
+
+
+def normalize_rows(mat: np.ndarray) -> np.ndarray:
+    mat = np.atleast_2d(np.asarray(mat, dtype="float32"))
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def top_k_inner_product(matrix: np.ndarray, queries: np.ndarray, k: int):
+    """
+    Top-k inner product untuk batch query: satu perkalian matriks + argpartition.
+    Mengembalikan (scores, idxs) berbentuk (n_query, k) terurut menurun.
+    """
+    n = matrix.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        empty = np.zeros((queries.shape[0], 0))
+        return empty.astype("float32"), empty.astype("int64")
+    scores = queries @ matrix.T
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape).copy()
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+_WORD_RE = re.compile(r"\w+")
+_SUBWORD_RE = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+_IDENTIFIER_RE = re.compile(r"\b(?:[A-Za-z]\w*_\w+|_\w+|[a-z]+[A-Z]\w*)\b")    # snake_case / camelCase
+
+
+def lexical_terms(text: str) -> List[str]:
+    """
+    Term BM25: kata/identifier utuh (lowercase) agar nama persis seperti `hitung_total`
+    tetap cocok, ditambah potongan snake_case/camelCase-nya.
+    """
+    terms: List[str] = []
+    for word in _WORD_RE.findall(text):
+        terms.append(word.lower())
+        if "_" in word or not (word.islower() or word.isupper()):
+            parts = _SUBWORD_RE.findall(word)
+            if len(parts) > 1:
+                terms.extend(part.lower() for part in parts)
+    return terms
+
+
+class BM25Index:
+    """
+    Inverted index BM25 atas teks chunk sebuah MaterialStore.
+    Posting disimpan sebagai array CSR NumPy (term -> dokumen) dengan bobot BM25 per posting
+    yang sudah dihitung, jadi skor query = penjumlahan beberapa irisan array.
+    """
+
+    def __init__(self, store: MaterialStore, vocab: Dict[str, int], offsets: np.ndarray, docs: np.ndarray, weights: np.ndarray):
+        self.store = store
+        self.vocab = vocab
+        self.offsets = offsets
+        self.docs = docs
+        self.weights = weights
+
+    @classmethod
+    def build(cls, store: MaterialStore, k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        n = len(store)
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        doc_len = np.zeros(n, dtype="float32")
+        for i in range(n):
+            counts: Dict[str, int] = {}
+            for term in lexical_terms(store.text(i)):
+                counts[term] = counts.get(term, 0) + 1
+            doc_len[i] = sum(counts.values())
+            for term, tf in counts.items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(i)
+                tfs.append(tf)
+
+        term_arr = np.asarray(term_ids, dtype="int64")
+        order = np.argsort(term_arr, kind="stable")
+        docs = np.asarray(doc_ids, dtype="int32")[order]
+        tf = np.asarray(tfs, dtype="float32")[order]
+        df = np.bincount(term_arr, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype="int64")
+        np.cumsum(df, out=offsets[1:])
+
+        idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5)).astype("float32")
+        avg_len = float(doc_len.mean()) if n else 1.0
+        norm = k1 * (1.0 - b + b * doc_len[docs] / max(avg_len, 1e-6))
+        weights = np.repeat(idf, df) * tf * (k1 + 1.0) / (tf + norm)
+        return cls(store, vocab, offsets, docs, weights.astype("float32"))
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def save(self, directory: str, generation: str):
+        """Simpan array posting (.npy, bisa di-mmap worker lain); meta ditulis terakhir sebagai penanda lengkap."""
+        write_file_atomic(os.path.join(directory, "bm25_offsets.npy"), lambda f: np.save(f, self.offsets))
+        write_file_atomic(os.path.join(directory, "bm25_docs.npy"), lambda f: np.save(f, self.docs))
+        write_file_atomic(os.path.join(directory, "bm25_weights.npy"), lambda f: np.save(f, self.weights))
+        meta = {"generation": generation, "count": len(self.store), "terms": list(self.vocab)}
+        write_file_atomic(
+            os.path.join(directory, "bm25_meta.json"), lambda f: f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        )
+
+    @classmethod
+    def load(cls, directory: str, store: MaterialStore, generation: str) -> Optional["BM25Index"]:
+        """Index BM25 di disk (mmap) jika dibangun untuk generasi index yang sama; None jika tidak ada/usang."""
+        try:
+            with open(os.path.join(directory, "bm25_meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("generation") != generation or meta.get("count") != len(store):
+                return None
+            arrays = [
+                np.load(os.path.join(directory, f"bm25_{name}.npy"), mmap_mode="r", allow_pickle=False)
+                for name in ("offsets", "docs", "weights")
+            ]
+        except (OSError, ValueError):
+            return None
+        vocab = {term: i for i, term in enumerate(meta["terms"])}
+        if len(arrays[0]) != len(vocab) + 1:
+            return None
+        return cls(store, vocab, *arrays)
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """k pasangan (baris, skor BM25) teratas; kosong jika tidak ada term yang cocok."""
+        term_ids = {self.vocab[t] for t in lexical_terms(query) if t in self.vocab}
+        if not term_ids:
+            return []
+        scores = np.zeros(len(self), dtype="float32")
+        for tid in term_ids:
+            start, end = self.offsets[tid], self.offsets[tid + 1]
+            scores[self.docs[start:end]] += self.weights[start:end]
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return [(int(i), float(scores[i])) for i in hits]
+
+    def identifier_matches(self, query: str) -> set:
+        """Baris yang memuat persis salah satu identifier (snake_case/camelCase) di query."""
+        rows: set = set()
+        for ident in _IDENTIFIER_RE.findall(query):
+            tid = self.vocab.get(ident.lower())
+            if tid is not None:
+                rows.update(self.docs[self.offsets[tid]:self.offsets[tid + 1]].tolist())
+        return rows
+
+
+def build_bm25_index():
+    """
+    Index BM25 untuk materials_index saat ini (dipanggil setiap sinkronisasi, di bawah INDEX_LOCK_PATH).
+    Versi di disk untuk generasi index yang sama dipakai ulang (mmap); jika tidak ada, dibangun lalu disimpan.
+    """
+    global bm25_index
+    with index_lock:
+        store, generation = materials_index, index_generation
+    if bm25_index is not None and bm25_index.store is store:
+        return
+    started = time.perf_counter()
+    built = BM25Index.load(index_data_dir(generation), store, generation) if generation else None
+    action = "dimuat dari disk"
+    if built is None:
+        built = BM25Index.build(store)
+        action = "dibangun"
+        if generation:
+            try:
+                built.save(index_data_dir(generation), generation)
+            except Exception as e:
+                print(f"[RAG] ⚠️ Gagal simpan index BM25: {e}")
+    with index_lock:
+        if materials_index is store:
+            bm25_index = built
+    print(f"[RAG] ✅ Index BM25 {action} ({len(built.vocab)} term, {len(store)} chunk, {time.perf_counter() - started:.2f} detik).")
+
+
+def fuse_rrf(rankings: List[Tuple[List[int], float]], k: int) -> List[Tuple[int, float]]:
+    """Reciprocal rank fusion: skor = sum(bobot / (RRF_K + peringkat)) dari tiap daftar."""
+    fused: Dict[int, float] = {}
+    for ids, weight in rankings:
+        for rank, idx in enumerate(ids, start=1):
+            fused[idx] = fused.get(idx, 0.0) + weight / (RRF_K + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])[:k]
+
+
+@timed_stage("retrieval")
+def search_materials(queries: List[str], q_embs: Optional[np.ndarray], k: int = 4) -> List[List[Dict]]:
+    """
+    Cari k chunk teratas untuk setiap query. q_embs (sudah dinormalisasi) boleh None:
+    pencarian hanya BM25 (fast path saat embedding lambat/mati atau RETRIEVAL_MODE=lexical).
+    Mode hybrid menggabungkan kandidat vektor & BM25 dengan reciprocal rank fusion.
+    Skor per chunk: "score" = cosine (None jika hanya ditemukan BM25), "bm25" dan "rrf" jika ada.
+    """
+    with index_lock:
+        store = materials_index
+        index = faiss_index
+        lexical = bm25_index if bm25_index is not None and bm25_index.store is store else None
+        hybrid = q_embs is not None and lexical is not None and RETRIEVAL_MODE == "hybrid"
+        depth = max(k, RRF_CANDIDATES) if hybrid else k
+        D = I = None
+        # faiss
+        if q_embs is not None and index is not None:
+            try:
+                D, I = index.search(np.ascontiguousarray(q_embs, dtype="float32"), depth)
+            except Exception as e:
+                log(f"[RAG] ⚠️ FAISS error, fallback NumPy: {e}")
+    if not len(store):
+        return [[] for _ in queries]
+
+    # numpy fallback: matriks embedding kontigu, satu GEMV/GEMM + argpartition
+    if q_embs is not None and I is None:
+        D, I = top_k_inner_product(store.vectors, q_embs, depth)
+
+    all_results: List[List[Dict]] = []
+    for qi, query in enumerate(queries):
+        dense: List[Tuple[int, float]] = []
+        if q_embs is not None:
+            dense = [(int(idx), float(score)) for idx, score in zip(I[qi], D[qi]) if idx >= 0 and score > 0]
+        sparse: List[Tuple[int, float]] = []
+        if lexical is not None and (hybrid or q_embs is None):
+            sparse = lexical.search(query, depth)
+
+        if dense and sparse:
+            weight = BM25_CODE_WEIGHT if is_code_like(query) else 1.0
+            ranked = fuse_rrf([([i for i, _ in dense], 1.0), ([i for i, _ in sparse], weight)], len(dense) + len(sparse))
+            # chunk yang memuat identifier persis dari query selalu didahulukan
+            exact = lexical.identifier_matches(query)
+            if exact:
+                ranked.sort(key=lambda item: item[0] not in exact)
+            ranked = ranked[:k]
+            retriever = "hybrid"
+        elif dense:
+            ranked, retriever = dense[:k], "vector"
+        else:
+            ranked, retriever = sparse[:k], "bm25"
+        cosine, bm25 = dict(dense), dict(sparse)
+        results = []
+        for idx, score in ranked:
+            chunk = {
+                "text": store.text(idx),
+                "header": store.header(idx),
+                "source": store.source(idx),
+                "score": cosine.get(idx),
+                "retriever": retriever,
+            }
+            if idx in bm25:
+                chunk["bm25"] = bm25[idx]
+            if retriever == "hybrid":
+                chunk["rrf"] = score
+            results.append(chunk)
+        all_results.append(results)
+    return all_results
+
+
+class EmbeddingCache:
+    """LRU + TTL thread-safe untuk embedding query; kunci = (model, teks yang dinormalisasi)."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str, model: str = EMBEDDING_MODEL_NAME) -> tuple:
+        return (model, " ".join((text or "").lower().split()))
+
+    def get(self, key: tuple) -> Optional[np.ndarray]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl and time.monotonic() - item[1] > self.ttl:
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: tuple, vec: np.ndarray):
+        if self.max_size <= 0:
+            return
+        vec.setflags(write=False)
+        with self._lock:
+            self._data[key] = (vec, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+
+query_embedding_cache = EmbeddingCache(QUERY_EMBED_CACHE_SIZE, QUERY_EMBED_CACHE_TTL)
+
+
+@timed_stage("query_embed")
+def embed_queries(queries: List[str]) -> np.ndarray:
+    """
+    Embedding query (sudah dinormalisasi) lewat cache; hanya query yang miss
+    dikirim ke Ollama, sekaligus dalam satu batch.
+    """
+    keys = [EmbeddingCache.key(q) for q in queries]
+    vecs: List[Optional[np.ndarray]] = [query_embedding_cache.get(key) for key in keys]
+    missing: Dict[tuple, List[int]] = {}
+    for i, (key, vec) in enumerate(zip(keys, vecs)):
+        if vec is None:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        texts = [queries[idxs[0]] for idxs in missing.values()]
+        if len(texts) == 1:
+            raw = np.array([embeddings_model.embed_query(texts[0])], dtype="float32")
+        else:
+            raw = np.array(embeddings_model.embed_documents(texts), dtype="float32")
+        for (key, idxs), row in zip(missing.items(), normalize_rows(raw)):
+            query_embedding_cache.put(key, row)
+            for i in idxs:
+                vecs[i] = row
+    return np.vstack(vecs)
+
+
+_query_embed_executor = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="query-embed")
+_embed_skip_until = 0.0
+
+
+def embed_queries_or_none(queries: List[str], timeout: Optional[float] = None) -> Optional[np.ndarray]:
+    """
+    embed_queries dengan batas waktu (default RAG_EMBED_TIMEOUT, 0 = tunggu). Jika gagal atau terlalu
+    lambat, kembalikan None (retrieval memakai BM25 saja) dan lewati embedding selama RAG_EMBED_BACKOFF.
+    Embedding yang terlambat tetap selesai di background dan mengisi cache.
+    """
+    global _embed_skip_until
+    if embeddings_model is None or RETRIEVAL_MODE == "lexical" or time.monotonic() < _embed_skip_until:
+        return None
+    timeout = RAG_EMBED_TIMEOUT if timeout is None else timeout
+    future = _query_embed_executor.submit(contextvars.copy_context().run, embed_queries, list(queries))
+    try:
+        return future.result(timeout=timeout or None)
+    except FutureTimeoutError:
+        log(f"[RAG] ⚠️ Embed query > {timeout:.1f} detik, pakai BM25 saja selama {RAG_EMBED_BACKOFF:.0f} detik.")
+    except Exception as e:
+        log(f"[RAG] ⚠️ Gagal embed query RAG, pakai BM25 saja: {e}")
+    _embed_skip_until = time.monotonic() + RAG_EMBED_BACKOFF
+    return None
+
+
+def retrieve_relevant_chunks(query: str, k: int = 4) -> List[Dict]:
+    """Ambil k chunk paling relevan: vektor (FAISS jika ada) + BM25, atau BM25 saja jika embedding tidak tersedia."""
+    return retrieve_relevant_chunks_batch([query], k=k)[0]
+
+
+def retrieve_relevant_chunks_batch(queries: List[str], k: int = 4, embed_timeout: Optional[float] = None) -> List[List[Dict]]:
+    """Versi batch: semua query di-embed dalam satu request lalu dicari sekaligus."""
+    if not queries:
+        return []
+    if not materials_loaded or not materials_index:
+        return [[] for _ in queries]
+    return search_materials(list(queries), embed_queries_or_none(queries, embed_timeout), k=k)
+
+
+@app.get("/cache")
+def get_cache_stats():
+    """Statistik cache (hit/miss) untuk embedding query RAG dan jawaban LLM."""
+    return {"query_embeddings": query_embedding_cache.stats(), "responses": response_cache.stats()}
+
+# memory per session
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))        # sesi aktif di memori
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "1800"))   # sesi idle dikeluarkan dari memori
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(BASE_DIR, "cache", "sessions.sqlite3"))
+
+
+class SessionHistory:
+    """
+    Riwayat satu sesi dalam bentuk teks ringkas yang terus dipotong.
+    Hanya ekor max_chars yang disimpan, jadi menambah pesan & memformat riwayat
+    tidak bergantung pada jumlah pesan sebelumnya.
+    """
+
+    def __init__(self, session_id: str, tail: str = "", total_chars: int = 0, message_count: int = 0):
+        self.session_id = session_id
+        self.tail = tail
+        self.total_chars = total_chars
+        self.message_count = message_count
+        self.last_used = time.monotonic()
+
+    def _append(self, *lines: str):
+        """Tambahkan baris riwayat dalam satu penulisan SQLite."""
+        with session_store.updating(self):
+            for line in lines:
+                if self.message_count:
+                    self.total_chars += 1 + len(line)
+                    self.tail = (self.tail + "\n" + line)[-MAX_HISTORY_CHARS:]
+                else:
+                    self.total_chars = len(line)
+                    self.tail = line[-MAX_HISTORY_CHARS:]
+                self.message_count += 1
+
+    def add_user_message(self, content: str):
+        self._append(f"[Siswa] {content}")
+
+    def add_ai_message(self, content: str):
+        self._append(f"[Tutor] {content}")
+
+    def add_exchange(self, user_content: str, ai_content: str):
+        """Satu giliran siswa + tutor; blocking (SQLite), jadi dari event loop panggil lewat threadpool."""
+        self._append(f"[Siswa] {user_content}", f"[Tutor] {ai_content}")
+
+    def as_text(self, max_chars: int = MAX_HISTORY_CHARS) -> str:
+        if not self.message_count:
+            return "Tidak ada riwayat sebelumnya."
+        if self.total_chars <= max_chars:
+            return self.tail
+        return "...\n" + self.tail[-max_chars:]
+
+
+class SessionStore:
+    """
+    LRU sesi di memori; SQLite menjadi sumber kebenaran. Sesi dibaca ulang setiap get() dan
+    diubah dalam satu transaksi, sehingga worker mana pun bisa melayani sesi mana pun, juga
+    saat jumlah worker tidak diberitahukan lewat WORKERS (mis. uvicorn --workers N saja).
+    Database baru dibuka saat pertama dipakai, bukan saat modul di-import.
+    """
+
+    def __init__(self, db_path: str, max_size: int, idle_seconds: float):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.evictions = 0
+        self._sessions: "OrderedDict[str, SessionHistory]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Buka database sekali; dipanggil dengan self._lock dipegang."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=SQLITE_TIMEOUT)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, tail TEXT NOT NULL, total_chars INTEGER NOT NULL,"
+                " message_count INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_size and now - oldest.last_used <= self.idle_seconds:
+                break
+            del self._sessions[oldest.session_id]
+            self.evictions += 1
+
+    def _read(self, session_id: str) -> Optional[Tuple[str, int, int]]:
+        return self._connect().execute(
+            "SELECT tail, total_chars, message_count FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+
+    def _refresh(self, session: SessionHistory):
+        """Ambil versi terbaru dari SQLite (bisa saja baru ditulis worker lain)."""
+        session.tail, session.total_chars, session.message_count = self._read(session.session_id) or ("", 0, 0)
+
+    def get(self, session_id: str) -> SessionHistory:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                row = self._read(session_id)
+                session = SessionHistory(session_id, *row) if row else SessionHistory(session_id)
+                self._sessions[session_id] = session
+            else:
+                self._refresh(session)
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self._evict_idle()
+            return session
+
+    @contextlib.contextmanager
+    def updating(self, session: SessionHistory):
+        """
+        Ubah sesi di dalam blok lalu tulis ke SQLite. Baca ulang dan tulis dalam satu
+        transaksi BEGIN IMMEDIATE agar perubahan worker lain tidak tertimpa.
+        """
+        with self._lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                self._refresh(session)
+                yield
+                db.execute(
+                    "INSERT INTO sessions (session_id, tail, total_chars, message_count, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT(session_id) DO UPDATE SET tail = excluded.tail,"
+                    " total_chars = excluded.total_chars, message_count = excluded.message_count,"
+                    " updated_at = excluded.updated_at",
+                    (session.session_id, session.tail, session.total_chars, session.message_count, time.time()),
+                )
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            session.last_used = time.monotonic()
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            self._evict_idle()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stored = self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            return {"in_memory": len(self._sessions), "stored": stored, "evictions": self.evictions}
+
+
+session_store = SessionStore(SESSION_DB_PATH, SESSION_CACHE_SIZE, SESSION_IDLE_SECONDS)
+
+
+def get_session_history(session_id: str) -> SessionHistory:
+    return session_store.get(session_id)
+
+
+def format_history_as_text(history: Optional[SessionHistory], max_chars: int = MAX_HISTORY_CHARS) -> str:
+    if history is None:
+        return "Tidak ada riwayat sebelumnya."
+    return history.as_text(max_chars)
+
+# context token ollama per sesi (KV cache thread tutor utama dipakai ulang)
+SESSION_CONTEXT_REUSE = os.getenv("SESSION_CONTEXT_REUSE", "1") != "0"
+SESSION_CONTEXT_MAX_TOKENS = int(os.getenv("SESSION_CONTEXT_MAX_TOKENS", "3000"))   # di atas ini thread dimulai ulang; < num_ctx model
+SESSION_CONTEXT_CACHE_SIZE = int(os.getenv("SESSION_CONTEXT_CACHE_SIZE", "500"))   # sesi yang context-nya disimpan di memori
+
+
+class SessionContext:
+    """
+    Token `context` yang dikembalikan Ollama untuk thread tutor utama satu sesi.
+    Context hanya dipakai ulang jika profil sama dan riwayat sesi tidak berubah di
+    luar thread ini (mis. oleh /evaluate atau giliran yang tidak selesai).
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.tokens: Optional[np.ndarray] = None   # int32, ringkas dibanding list Python
+        self.backend_url: Optional[str] = None     # backend yang KV cache-nya masih memuat context ini
+        self.profile: Optional[str] = None
+        self.message_count = -1                    # panjang riwayat saat context terakhir di-commit
+
+    def usable(self, profile: str, history: SessionHistory) -> bool:
+        return self.tokens is not None and self.profile == profile and self.message_count == history.message_count
+
+    def reset(self):
+        self.tokens, self.backend_url, self.profile, self.message_count = None, None, None, -1
+
+
+class ContextTurn:
+    """
+    Satu giliran thread utama: snapshot context sesi + prompt inkremental (turn_prompt).
+    Dengan context, Ollama hanya meng-encode prompt giliran ini; percakapan sebelumnya
+    tidak dikirim ulang. turn_prompt None = prompt penuh (thread dimulai/dimulai ulang).
+    """
+
+    def __init__(self, session: SessionContext, profile: str, turn_prompt: Optional[str]):
+        self.session = session
+        self.profile = profile
+        self.turn_prompt = turn_prompt
+        self.tokens = session.tokens if turn_prompt is not None else None
+        self.backend_url = session.backend_url
+        self.result: Optional[Tuple[np.ndarray, str]] = None
+
+    def record(self, context: Optional[List[int]], backend_url: str):
+        """Dipanggil setelah generasi berhasil; context baru berlaku setelah commit()."""
+        if context and len(context) > SESSION_CONTEXT_MAX_TOKENS:
+            log(f"[Context] ♻️ Context sesi {self.session.session_id} ({len(context)} token) melebihi batas, thread dimulai ulang.")
+            context = None
+        self.result = (np.asarray(context, dtype="int32"), backend_url) if context else None
+
+    def commit(self, history: Optional[SessionHistory]):
+        """Simpan context giliran ini setelah riwayat diperbarui; tanpa context baru thread di-reset."""
+        if self.result is None or history is None:
+            self.session.reset()
+            return
+        self.session.tokens, self.session.backend_url = self.result
+        self.session.profile = self.profile
+        self.session.message_count = history.message_count
+
+
+class SessionContextStore:
+    """LRU SessionContext di memori saja: context hanya berguna selama model masih dimuat."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._contexts: "OrderedDict[str, SessionContext]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = {"reused": 0, "full": 0}
+
+    def get(self, session_id: str) -> SessionContext:
+        with self._lock:
+            context = self._contexts.get(session_id)
+            if context is None:
+                context = self._contexts[session_id] = SessionContext(session_id)
+            self._contexts.move_to_end(session_id)
+            while len(self._contexts) > self.max_size:
+                self._contexts.popitem(last=False)
+            return context
+
+    def count(self, reused: bool):
+        with self._lock:
+            self.counts["reused" if reused else "full"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens = sum(len(c.tokens) for c in self._contexts.values() if c.tokens is not None)
+            return {"sessions": len(self._contexts), "context_tokens": tokens, "turns": dict(self.counts)}
+
+
+session_contexts = SessionContextStore(SESSION_CONTEXT_CACHE_SIZE)
+
+# log percakapan (append-only, SQLite)
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH", os.path.join(BASE_DIR, "cache", "conversations.sqlite3"))
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+
+
+class ConversationLog:
+    """
+    Log percakapan append-only di SQLite: tahan restart, bisa dibaca per halaman (keyset id).
+    Database baru dibuka saat pertama dipakai, bukan saat modul di-import.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Buka database sekali; dipanggil dengan self._lock dipegang."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=SQLITE_TIMEOUT)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,"
+                " created_at REAL NOT NULL, data TEXT NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS idx_conv_session ON conversations (session_id, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_conv_created ON conversations (created_at)")
+            db.commit()
+            self._db = db
+        return self._db
+
+    def append(self, entry: Dict[str, Any]) -> int:
+        with self._lock:
+            db = self._connect()
+            cur = db.execute(
+                "INSERT INTO conversations (session_id, created_at, data) VALUES (?, ?, ?)",
+                (entry.get("session_id") or "default", time.time(), json.dumps(entry, ensure_ascii=False)),
+            )
+            db.commit()
+            return int(cur.lastrowid)
+
+    def page(
+        self,
+        after_id: int = 0,
+        limit: int = HISTORY_PAGE_SIZE,
+        session_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        sql = "SELECT id, created_at, data FROM conversations WHERE id > ?"
+        args: List[Any] = [after_id]
+        if session_id:
+            sql += " AND session_id = ?"
+            args.append(session_id)
+        if since is not None:
+            sql += " AND created_at >= ?"
+            args.append(since)
+        if until is not None:
+            sql += " AND created_at < ?"
+            args.append(until)
+        sql += " ORDER BY id LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._connect().execute(sql, args).fetchall()
+        return [{"id": row[0], "created_at": row[1], **json.loads(row[2])} for row in rows]
+
+    def iter_all(self, batch_size: int = 500, **filters: Any):
+        """Iterasi semua entri per batch; lock hanya dipegang selama satu query."""
+        after_id = 0
+        while True:
+            rows = self.page(after_id=after_id, limit=batch_size, **filters)
+            if not rows:
+                return
+            yield from rows
+            after_id = rows[-1]["id"]
+
+
+conversation_log = ConversationLog(CONVERSATION_DB_PATH)
+
+# data models
+class ChatRequest(BaseModel):
+    message: str
+    cognitive: Optional[str] = "par"  # "par" atau "tar"
+    cq1: Optional[str] = "t"          # "p", "t", "a"
+    cq2: Optional[str] = "a"          # "p", "t", "a"
+    session_id: Optional[str] = "default"
+    stream: Optional[bool] = False    # True: respons NDJSON bertahap
+
+
+class EvalRequest(BaseModel):
+    answer: str
+    correct_answer: str
+    wrong_count: Optional[int] = 0
+    session_id: Optional[str] = "default"
+    stream: Optional[bool] = False
+
+# async ollama client (pooled keep-alive per base url)
+# env = total per backend untuk semua worker; tiap proses mendapat bagiannya
+OLLAMA_MAX_CONCURRENCY = max(1, -(-int(os.getenv("OLLAMA_MAX_CONCURRENCY", "4")) // WORKERS))
+OLLAMA_POOL_MAX_CONNECTIONS = int(os.getenv("OLLAMA_POOL_MAX_CONNECTIONS", "100"))
+OLLAMA_POOL_MAX_KEEPALIVE = int(os.getenv("OLLAMA_POOL_MAX_KEEPALIVE", "20"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "1500"))
+
+_async_clients: Dict[str, httpx.AsyncClient] = {}
+_backend_slots: Dict[str, asyncio.Semaphore] = {}
+_clients_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _bind_event_loop():
+    """Client & semaphore terikat ke event loop; buat ulang jika loop berganti (mis. TestClient)."""
+    global _clients_loop
+    loop = asyncio.get_running_loop()
+    if loop is not _clients_loop:
+        _async_clients.clear()
+        _backend_slots.clear()
+        _clients_loop = loop
+
+
+def get_async_client(base_url: Optional[str]) -> httpx.AsyncClient:
+    """Satu AsyncClient (koneksi keep-alive dipakai ulang) untuk setiap base URL Ollama."""
+    _bind_event_loop()
+    key = base_url or "http://localhost:11434"
+    client = _async_clients.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=key,
+            timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=OLLAMA_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=OLLAMA_POOL_MAX_KEEPALIVE,
+            ),
+        )
+        _async_clients[key] = client
+    return client
+
+
+def backend_slot(base_url: Optional[str]) -> asyncio.Semaphore:
+    """Semaphore pembatas jumlah generasi paralel untuk satu backend Ollama."""
+    _bind_event_loop()
+    key = base_url or "default"
+    slot = _backend_slots.get(key)
+    if slot is None:
+        slot = asyncio.Semaphore(max(1, OLLAMA_MAX_CONCURRENCY))
+        _backend_slots[key] = slot
+    return slot
+
+
+async def close_ollama_clients():
+    for client in list(_async_clients.values()):
+        await client.aclose()
+    _async_clients.clear()
+
+# backend pool (load balancing + health check + circuit breaker)
+OLLAMA_BACKENDS = [
+    u.strip().rstrip("/")
+    for u in os.getenv("OLLAMA_BACKENDS", "").split(",")
+    if u.strip()
+] or [f"http://localhost:{port}" for port in OLLAMA_PORTS]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_CB_FAILURES = int(os.getenv("OLLAMA_CB_FAILURES", "3"))        # gagal beruntun sebelum circuit terbuka
+OLLAMA_CB_RESET_SECONDS = float(os.getenv("OLLAMA_CB_RESET_SECONDS", "30"))
+
+
+class OllamaBackend:
+    """Status satu instance Ollama: antrean, latensi, kesehatan dan circuit breaker."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy: Optional[bool] = None   # None = belum pernah dicek
+        self.queued = 0                       # menunggu slot konkurensi
+        self.active = 0                       # sedang generate
+        self.requests_total = 0
+        self.failures_total = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+        self.latency_ewma: Optional[float] = None
+        self.last_latency: Optional[float] = None
+
+    @property
+    def outstanding(self) -> int:
+        return self.queued + self.active
+
+    def circuit_state(self) -> str:
+        if self.consecutive_failures < OLLAMA_CB_FAILURES:
+            return "closed"
+        if time.monotonic() < self.circuit_open_until:
+            return "open"
+        return "half-open"
+
+    def available(self) -> bool:
+        return self.healthy is not False and self.circuit_state() != "open"
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Ambil slot konkurensi backend ini sambil mencatat antrean & request aktif."""
+        self.queued += 1
+        queued = True
+        try:
+            async with backend_slot(self.url):
+                self.queued -= 1
+                queued = False
+                self.active += 1
+                try:
+                    yield
+                finally:
+                    self.active -= 1
+        finally:
+            if queued:
+                self.queued -= 1
+
+    def record_success(self, latency: float):
+        self.requests_total += 1
+        self.consecutive_failures = 0
+        self.last_latency = latency
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+
+    def record_failure(self):
+        self.requests_total += 1
+        self.failures_total += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= OLLAMA_CB_FAILURES:
+            if self.circuit_state() != "open":
+                print(f"[Pool] 🔌 Circuit terbuka untuk {self.url} ({OLLAMA_CB_RESET_SECONDS:.0f} detik).")
+            self.circuit_open_until = time.monotonic() + OLLAMA_CB_RESET_SECONDS
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "circuit": self.circuit_state(),
+            "queued": self.queued,
+            "active": self.active,
+            "requests_total": self.requests_total,
+            "failures_total": self.failures_total,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "last_latency_ms": round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+        }
+
+
+class OllamaBackendPool:
+    """Routing least-outstanding-requests ke semua backend Ollama yang dikonfigurasi."""
+
+    def __init__(self, urls: List[str]):
+        self.backends = [OllamaBackend(u) for u in urls]
+
+    def pick(self, exclude: Optional[set] = None, prefer: Optional[str] = None) -> OllamaBackend:
+        """prefer = backend yang KV cache-nya masih memuat context sesi; dipakai selama ada slot kosong."""
+        exclude = exclude or set()
+        candidates = [b for b in self.backends if b.available() and b.url not in exclude]
+        for b in candidates:
+            if b.url == prefer and b.consecutive_failures == 0 and b.outstanding < OLLAMA_MAX_CONCURRENCY:
+                return b
+        if not candidates:
+            # semua sedang bermasalah: tetap coba yang belum dipakai, lalu siapa saja
+            candidates = [b for b in self.backends if b.url not in exclude] or self.backends
+        # backend yang baru saja gagal cepat kosong antreannya; jangan sampai ia menyedot trafik
+        return min(
+            candidates,
+            key=lambda b: (
+                b.consecutive_failures > 0,
+                b.outstanding,
+                b.latency_ewma if b.latency_ewma is not None else 0.0,
+            ),
+        )
+
+    async def check_health(self, backend: OllamaBackend):
+        try:
+            r = await get_async_client(backend.url).get("/", timeout=2.0)
+            healthy = r.status_code in (200, 404)
+        except Exception:
+            healthy = False
+        if healthy != backend.healthy:
+            status = "✅ sehat" if healthy else "❌ tidak merespons"
+            print(f"[Pool] {status}: {backend.url}")
+            if healthy and backend.healthy is False and OLLAMA_PREWARM:
+                # backend pulih (mis. restart): model belum dimuat, muat sebelum trafik pertama
+                task = asyncio.create_task(prewarm_backend(backend))
+                _prewarm_tasks.add(task)
+                task.add_done_callback(_prewarm_tasks.discard)
+        backend.healthy = healthy
+
+    async def health_loop(self, interval: float = OLLAMA_HEALTH_INTERVAL):
+        while True:
+            await asyncio.gather(*(self.check_health(b) for b in self.backends))
+            await asyncio.sleep(interval)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [b.stats() for b in self.backends]
+
+
+backend_pool = OllamaBackendPool(OLLAMA_BACKENDS)
+
+# pre-warm: model dimuat sebelum request pertama, bukan saat siswa menunggu
+_prewarm_tasks: set = set()
+
+
+async def prewarm_backend(backend: OllamaBackend):
+    """Muat model utama & follow-up di satu backend (generate tanpa prompt = hanya load) dengan keep_alive."""
+    for model in dict.fromkeys([MODEL_NAME, FOLLOWUP_MODEL_NAME]):
+        started = time.perf_counter()
+        try:
+            r = await get_async_client(backend.url).post(
+                "/api/generate", json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}
+            )
+            if r.status_code == 200:
+                print(f"[Pool] 🔥 {model} dimuat di {backend.url} ({time.perf_counter() - started:.1f} detik).")
+            else:
+                print(f"[Pool] ⚠️ Pre-warm {model} di {backend.url} gagal: HTTP {r.status_code}")
+        except Exception as e:
+            print(f"[Pool] ⚠️ Pre-warm {model} di {backend.url} gagal: {e}")
+
+
+async def prewarm_embedding_model():
+    """Muat model embedding lewat satu embed kecil (keep_alive ikut dari OllamaEmbeddings)."""
+    if embeddings_model is None:
+        return
+    try:
+        await run_in_threadpool(embeddings_model.embed_query, "pemanasan")
+        print(f"[RAG] 🔥 Embedding model {EMBEDDING_MODEL_NAME} dimuat.")
+    except Exception as e:
+        print(f"[RAG] ⚠️ Pre-warm embedding gagal: {e}")
+
+
+@app.get("/backends")
+def get_backends():
+    """Kedalaman antrean, latensi dan status circuit tiap backend Ollama, generasi yang digabung & context sesi."""
+    saved = coalescing_stats["joined"] + coalescing_stats["stream_joined"]
+    return {
+        "backends": backend_pool.stats(),
+        "scheduler": generation_scheduler.stats(),
+        "coalescing": {**coalescing_stats, "generations_saved": saved},
+        "session_context": session_contexts.stats(),
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    """Metrics format teks Prometheus: histogram per tahap & per generasi, antrean, cache."""
+    lines: List[str] = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    sched = generation_scheduler.stats()
+    embed_stats = query_embedding_cache.stats()
+    resp_stats = response_cache.stats()
+    values = [
+        ("csipb_scheduler_active", "gauge", sched["active"]),
+        ("csipb_scheduler_waiting", "gauge", sched["waiting"]),
+        ("csipb_scheduler_rejected_total", "counter", sched["rejected_total"]),
+        ("csipb_coalesced_generations_total", "counter", coalescing_stats["joined"] + coalescing_stats["stream_joined"]),
+        ("csipb_query_embedding_cache_hits_total", "counter", embed_stats["hits"]),
+        ("csipb_query_embedding_cache_misses_total", "counter", embed_stats["misses"]),
+        ("csipb_response_cache_hits_total", "counter", resp_stats["hits"]),
+        ("csipb_response_cache_misses_total", "counter", resp_stats["misses"]),
+        ("csipb_session_context_reused_total", "counter", session_contexts.counts["reused"]),
+        ("csipb_session_context_full_total", "counter", session_contexts.counts["full"]),
+        ("csipb_materials_chunks", "gauge", len(materials_index)),
+    ]
+    for name, kind, value in values:
+        lines.extend([f"# TYPE {name} {kind}", f"{name} {value}"])
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+# scheduler generasi (admission control + antrean prioritas yang adil per sesi)
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))   # request baru ditolak (429) di atas ini, 0 = tanpa batas
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+GENERATION_PRIORITIES = {
+    "feedback": PRIORITY_HIGH,     # umpan balik /evaluate
+    "main": PRIORITY_NORMAL,
+    "compare": PRIORITY_LOW,
+    "followup": PRIORITY_LOW,
+}
+
+# field payload tambahan per label: model kecil untuk follow-up, output JSON terstruktur untuk evaluasi
+EVAL_OUTPUT_FORMAT = os.getenv("EVAL_OUTPUT_FORMAT", "schema").lower()   # schema (Ollama >= 0.5) | json
+EVALUATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "umpan_balik": {"type": "string"},
+        "benar": {"type": "boolean"},
+    },
+    "required": ["umpan_balik", "benar"],
+}
+GENERATION_OVERRIDES: Dict[str, Dict[str, Any]] = {
+    "followup": {"model": FOLLOWUP_MODEL_NAME},
+    "feedback": {"format": EVALUATION_SCHEMA if EVAL_OUTPUT_FORMAT == "schema" else "json"},
+}
+
+
+class SchedulerQueueFull(Exception):
+    def __init__(self, position: int, retry_after: int):
+        super().__init__(f"Antrean penuh (posisi {position})")
+        self.position = position
+        self.retry_after = retry_after
+
+
+class GenerationScheduler:
+    """
+    Batasi generasi yang berjalan bersamaan ke kapasitas total backend. Sisanya
+    menunggu di antrean per prioritas; dalam satu prioritas, sesi dilayani
+    bergiliran (round-robin) agar satu sesi tidak memonopoli antrean.
+    """
+
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = max(1, capacity)
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits: "deque[float]" = deque(maxlen=1000)
+        self.hold_ewma: Optional[float] = None
+        self._queues: Dict[int, "OrderedDict[str, deque]"] = {}
+
+    def retry_after(self) -> int:
+        """Perkiraan detik sampai ada slot untuk request di ujung antrean."""
+        per_generation = self.hold_ewma or 10.0
+        return max(1, int(np.ceil(per_generation * (self.waiting + 1) / self.capacity)))
+
+    def check_admission(self):
+        if self.max_queue and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerQueueFull(self.waiting + 1, self.retry_after())
+
+    def _dispatch(self):
+        while self.active < self.capacity and self.waiting:
+            for priority in sorted(self._queues):
+                sessions = self._queues[priority]
+                if sessions:
+                    break
+            else:
+                return
+            session_id, waiters = next(iter(sessions.items()))
+            fut = waiters.popleft()
+            if waiters:
+                sessions.move_to_end(session_id)
+            else:
+                del sessions[session_id]
+            self.waiting -= 1
+            if fut.done():
+                continue
+            self.active += 1
+            fut.set_result(None)
+
+    def _remove(self, priority: int, session_id: str, fut: "asyncio.Future[None]"):
+        waiters = self._queues.get(priority, {}).get(session_id)
+        if waiters is not None and fut in waiters:
+            waiters.remove(fut)
+            self.waiting -= 1
+            if not waiters:
+                del self._queues[priority][session_id]
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_NORMAL, session_id: Optional[str] = None):
+        queued_at = time.perf_counter()
+        session_id = session_id or "default"
+        if self.active < self.capacity and not self.waiting:
+            self.active += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(priority, OrderedDict()).setdefault(session_id, deque()).append(fut)
+            self.waiting += 1
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._release()   # slot sudah diberikan tepat saat dibatalkan
+                else:
+                    self._remove(priority, session_id, fut)
+                raise
+        waited = time.perf_counter() - queued_at
+        LLM_QUEUE_WAIT_SECONDS.observe(waited, priority=PRIORITY_NAMES.get(priority, str(priority)))
+        timings = request_timings_var.get()
+        if timings is not None:
+            timings[f"queue_{generation_label_var.get()}"] = waited
+        self.wait_count += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.recent_waits.append(waited)
+        started = time.perf_counter()
+        try:
+            yield waited
+        finally:
+            held = time.perf_counter() - started
+            self.hold_ewma = held if self.hold_ewma is None else 0.8 * self.hold_ewma + 0.2 * held
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        recent = np.array(self.recent_waits) if self.recent_waits else None
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "rejected_total": self.rejected,
+            "queue_wait": {
+                "count": self.wait_count,
+                "avg_ms": round(self.wait_total / self.wait_count * 1000, 1) if self.wait_count else None,
+                "p50_ms": round(float(np.percentile(recent, 50)) * 1000, 1) if recent is not None else None,
+                "p95_ms": round(float(np.percentile(recent, 95)) * 1000, 1) if recent is not None else None,
+                "max_ms": round(self.wait_max * 1000, 1),
+            },
+        }
+
+
+generation_scheduler = GenerationScheduler(
+    OLLAMA_MAX_CONCURRENCY * len(backend_pool.backends), SCHEDULER_MAX_QUEUE
+)
+
+
+def admission_rejection() -> Optional[JSONResponse]:
+    """429 + Retry-After jika antrean generasi sudah melewati batas."""
+    try:
+        generation_scheduler.check_admission()
+    except SchedulerQueueFull as e:
+        log(f"[Scheduler] 🚦 Antrean penuh, request ditolak (posisi {e.position}).")
+        return JSONResponse(
+            status_code=429,
+            content={
+                "error": "Server sedang sibuk, coba lagi sebentar lagi.",
+                "queue_position": e.position,
+                "retry_after": e.retry_after,
+            },
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    return None
+
+
+# ollama wrapper
+GenerationSlot = Callable[[], AsyncContextManager[Any]]
+
+
+@contextlib.asynccontextmanager
+async def no_slot():
+    yield None
+
+
+def generation_payload(
+    prompt: str, stream: bool, thread: Optional[ContextTurn] = None, overrides: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Payload /api/generate; dengan context sesi hanya prompt giliran ini yang dikirim.
+    overrides = field tambahan (model, format) dari GENERATION_OVERRIDES.
+    """
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        **(overrides or {}),
+    }
+    if thread is not None and thread.turn_prompt is not None and thread.tokens is not None:
+        payload["prompt"] = thread.turn_prompt
+        payload["context"] = thread.tokens.tolist()
+    return payload
+
+
+async def _query_ollama_http(
+    prompt: str, retries: int = 3, delay: int = 5, thread: Optional[ContextTurn] = None,
+    overrides: Optional[Dict[str, Any]] = None, slot: GenerationSlot = no_slot,
+) -> str:
+    """slot: slot scheduler yang dipegang per percobaan, dilepas selama backoff antar retry."""
+    payload = generation_payload(prompt, False, thread, overrides)
+    tried: set = set()
+    for attempt in range(retries):
+        backend = backend_pool.pick(exclude=tried, prefer=thread.backend_url if thread is not None else None)
+        tried.add(backend.url)
+        client = get_async_client(backend.url)
+        started = time.perf_counter()
+        try:
+            async with slot():
+                log(f"[OllamaHTTP] 🚀 Kirim prompt ke {backend.url} (attempt {attempt + 1}/{retries})")
+                async with backend.acquire():
+                    started = time.perf_counter()
+                    r = await client.post("/api/generate", json=payload)
+            if r.status_code == 200:
+                backend.record_success(time.perf_counter() - started)
+                try:
+                    data = r.json()
+                    observe_generation(time.perf_counter() - started, data=data)
+                    if thread is not None:
+                        thread.record(data.get("context"), backend.url)
+                    text = (data.get("response") or "").strip()
+                    return text or "[Error] Model tidak mengembalikan jawaban."
+                except json.JSONDecodeError:
+                    return "[Error] Respons JSON tidak valid."
+            elif r.status_code == 500:
+                log(f"[OllamaHTTP] ⚠️ Model belum siap di {backend.url}, retry...")
+                backend.record_failure()
+            else:
+                log(f"[OllamaHTTP] ⚠️ HTTP {r.status_code}: {r.text[:200]}")
+                return f"[Error Ollama API] {r.text[:200]}"
+        except httpx.ConnectError:
+            log(f"[OllamaHTTP] ❌ Tidak dapat terhubung ke {backend.url}, retry...")
+            backend.record_failure()
+        except httpx.ReadTimeout:
+            log(f"[OllamaHTTP] ⏱️ Timeout ({OLLAMA_TIMEOUT:.0f} detik).")
+            backend.record_failure()
+            return "[Error Ollama API] Timeout."
+        except Exception as e:
+            log(f"[OllamaHTTP] ❌ Exception: {e}")
+            backend.record_failure()
+        # failover langsung ke backend lain; tunggu (backoff) hanya jika semua sudah dicoba
+        if len(tried) >= len(backend_pool.backends):
+            tried.clear()
+            await asyncio.sleep(delay * (2 ** attempt))
+    return "[Error Ollama API] Gagal menghubungi Ollama setelah beberapa percobaan."
+
+
+async def _query_ollama_once(
+    prompt: str, retries: int = 3, delay: int = 5, thread: Optional[ContextTurn] = None,
+    overrides: Optional[Dict[str, Any]] = None, slot: GenerationSlot = no_slot,
+) -> str:
+    """
+    Generasi non-streaming lewat client HTTP async (pool keep-alive).
+    ChatOllama (LangChain) hanya dipakai sebagai fallback bila HTTP gagal
+    (selalu dengan prompt penuh & model utama; context sesi tidak diperbarui).
+    """
+    text = await _query_ollama_http(
+        prompt, retries=retries, delay=delay, thread=thread, overrides=overrides, slot=slot
+    )
+    if llm is None or not text.startswith("[Error Ollama API] Gagal menghubungi"):
+        return text
+
+    log("[OllamaHTTP] ⚠️ Gagal lewat HTTP, fallback LangChain.")
+    try:
+        async with slot(), backend_slot(base_ollama_url):
+            result = await llm.ainvoke(prompt)
+        content = getattr(result, "content", None)
+        if not content:
+            content = str(result)
+        content = (content or "").strip()
+        return content or "[Error] Model tidak mengembalikan jawaban."
+    except Exception as e:
+        log(f"[OllamaLC] ❌ Exception: {e}")
+        return text
+
+# streaming ollama
+class StreamError(str):
+    """
+    Potongan stream berisi pesan error (gagal, terputus setelah token pertama, dibatalkan).
+    Pemanggil memeriksa isinstance, bukan prefix teks, untuk tahu jawabannya tidak lengkap.
+    """
+
+
+async def stream_ollama_http(
+    prompt: str, retries: int = 3, delay: int = 5, thread: Optional[ContextTurn] = None,
+    overrides: Optional[Dict[str, Any]] = None, slot: GenerationSlot = no_slot,
+) -> AsyncIterator[str]:
+    """
+    Async generator token dari /api/generate dengan stream=True.
+    Retry/failover hanya dilakukan sebelum token pertama terkirim; slot scheduler
+    dipegang per percobaan sehingga tidak terpakai selama backoff.
+    """
+    payload = generation_payload(prompt, True, thread, overrides)
+    tried: set = set()
+    for attempt in range(retries):
+        backend = backend_pool.pick(exclude=tried, prefer=thread.backend_url if thread is not None else None)
+        tried.add(backend.url)
+        client = get_async_client(backend.url)
+        sent_any = False
+        try:
+            async with slot():
+                log(f"[OllamaStream] 🚀 Kirim prompt ke {backend.url} (attempt {attempt + 1}/{retries})")
+                async with backend.acquire():
+                    started = time.perf_counter()
+                    async with client.stream("POST", "/api/generate", json=payload) as r:
+                        not_ready = r.status_code == 500
+                        if not_ready:
+                            log(f"[OllamaStream] ⚠️ Model belum siap di {backend.url}, retry...")
+                            backend.record_failure()
+                        elif r.status_code != 200:
+                            body = (await r.aread()).decode("utf-8", "replace")
+                            log(f"[OllamaStream] ⚠️ HTTP {r.status_code}: {body[:200]}")
+                            yield StreamError(f"[Error Ollama API] {body[:200]}")
+                            return
+                        else:
+                            ttft = None
+                            data = {}
+                            async for line in r.aiter_lines():
+                                if not line:
+                                    continue
+                                data = json.loads(line)
+                                if data.get("error"):
+                                    yield StreamError(f"[Error Ollama API] {data['error']}")
+                                    return
+                                piece = data.get("response") or ""
+                                if piece:
+                                    if ttft is None:
+                                        ttft = time.perf_counter() - started
+                                    sent_any = True
+                                    yield piece
+                                if data.get("done"):
+                                    break
+                            backend.record_success(time.perf_counter() - started)
+                            observe_generation(time.perf_counter() - started, ttft=ttft, data=data)
+                            if thread is not None:
+                                thread.record(data.get("context"), backend.url)
+                            return
+        except httpx.ReadTimeout:
+            log("[OllamaStream] ⏱️ Timeout.")
+            backend.record_failure()
+            yield StreamError("[Error Ollama API] Timeout.")
+            return
+        except Exception as e:
+            log(f"[OllamaStream] ❌ Exception dari {backend.url}: {e}")
+            backend.record_failure()
+            if sent_any:
+                yield StreamError(f"\n[Error Ollama API] Stream terputus: {e}")
+                return
+        if len(tried) >= len(backend_pool.backends):
+            tried.clear()
+            await asyncio.sleep(delay * (2 ** attempt))
+    yield StreamError("[Error Ollama API] Gagal menghubungi Ollama setelah beberapa percobaan.")
+
+# single-flight: prompt identik yang sedang diproses berbagi satu generasi upstream
+inflight_generations: Dict[str, "asyncio.Task[str]"] = {}
+inflight_streams: Dict[str, "SharedStream"] = {}
+coalescing_stats = {"generations": 0, "joined": 0, "streams": 0, "stream_joined": 0}
+
+
+def generation_key(prompt: str, overrides: Optional[Dict[str, Any]] = None) -> str:
+    fields = json.dumps(overrides or {}, sort_keys=True)
+    return hashlib.sha256(f"{MODEL_NAME}\0{fields}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+async def _query_ollama_scheduled(
+    prompt: str, retries: int, delay: int, priority: int, session_id: Optional[str],
+    thread: Optional[ContextTurn] = None, overrides: Optional[Dict[str, Any]] = None,
+) -> str:
+    return await _query_ollama_once(
+        prompt, retries=retries, delay=delay, thread=thread, overrides=overrides,
+        slot=functools.partial(generation_scheduler.slot, priority, session_id),
+    )
+
+
+async def query_ollama(
+    prompt: str,
+    retries: int = 3,
+    delay: int = 5,
+    priority: int = PRIORITY_NORMAL,
+    session_id: Optional[str] = None,
+    thread: Optional[ContextTurn] = None,
+    overrides: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Generasi non-streaming lewat scheduler. Pemanggilan bersamaan dengan prompt &
+    model identik menunggu satu generasi yang sama; klien yang putus tidak membatalkannya.
+    prompt = prompt penuh (kunci single-flight); thread = context sesi thread utama, jika ada.
+    Pemanggil yang ikut menunggu tidak mendapat context baru (thread-nya di-reset saat commit).
+    """
+    key = generation_key(prompt, overrides)
+    task = inflight_generations.get(key)
+    if task is None:
+        coalescing_stats["generations"] += 1
+        task = asyncio.create_task(
+            _query_ollama_scheduled(prompt, retries, delay, priority, session_id, thread, overrides)
+        )
+        inflight_generations[key] = task
+        task.add_done_callback(
+            lambda t: inflight_generations.pop(key, None) if inflight_generations.get(key) is t else None
+        )
+    else:
+        coalescing_stats["joined"] += 1
+        log("[Coalesce] 🔗 Prompt identik sedang diproses, ikut menunggu hasilnya.")
+    return await asyncio.shield(task)
+
+
+class SharedStream:
+    """
+    Satu stream token upstream yang dibagikan ke banyak pelanggan. Token yang sudah
+    keluar disimpan sehingga pelanggan yang bergabung belakangan tetap menerima
+    teks lengkap; generasi dibatalkan jika semua pelanggan putus. Error dan pembatalan
+    berakhir sebagai StreamError yang diterima semua pelanggan (failed = True).
+    """
+
+    def __init__(
+        self, key: str, prompt: str, priority: int = PRIORITY_NORMAL, session_id: Optional[str] = None,
+        thread: Optional[ContextTurn] = None, overrides: Optional[Dict[str, Any]] = None,
+    ):
+        self.key = key
+        self.pieces: List[str] = []
+        self.done = False
+        self.failed = False
+        self.cancelled = False   # pelanggan baru tidak boleh bergabung lagi
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(prompt, priority, session_id, thread, overrides))
+        self.task.add_done_callback(self._finish)
+
+    async def _run(
+        self, prompt: str, priority: int, session_id: Optional[str], thread: Optional[ContextTurn],
+        overrides: Optional[Dict[str, Any]],
+    ):
+        slot = functools.partial(generation_scheduler.slot, priority, session_id)
+        async for piece in stream_ollama_http(prompt, thread=thread, overrides=overrides, slot=slot):
+            self.failed = self.failed or isinstance(piece, StreamError)
+            self.pieces.append(piece)
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _finish(self, task: "asyncio.Task[None]"):
+        if task.cancelled():
+            self.pieces.append(StreamError("\n[Error Ollama API] Generasi dibatalkan."))
+            self.failed = True
+        elif task.exception() is not None:
+            self.pieces.append(StreamError(f"[Error Ollama API] {task.exception()}"))
+            self.failed = True
+        self.done = True
+        if inflight_streams.get(self.key) is self:
+            del inflight_streams[self.key]
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        i = 0
+        try:
+            while True:
+                while i < len(self.pieces):
+                    i += 1
+                    yield self.pieces[i - 1]
+                if self.done:
+                    return
+                changed = self._changed
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.cancelled = True
+                self.task.cancel()
+
+
+async def stream_ollama(
+    prompt: str, priority: int = PRIORITY_NORMAL, session_id: Optional[str] = None,
+    thread: Optional[ContextTurn] = None, overrides: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[str]:
+    """
+    stream_ollama_http lewat scheduler, dengan single-flight: prompt identik berbagi satu stream upstream.
+    Stream yang gagal/terpotong diakhiri StreamError.
+    """
+    key = generation_key(prompt, overrides)
+    shared = inflight_streams.get(key)
+    if shared is None or shared.cancelled:
+        coalescing_stats["streams"] += 1
+        shared = SharedStream(key, prompt, priority, session_id, thread, overrides)
+        inflight_streams[key] = shared
+    else:
+        coalescing_stats["stream_joined"] += 1
+        log("[Coalesce] 🔗 Prompt identik sedang di-stream, bergabung ke stream yang sama.")
+    subscription = shared.subscribe()
+    try:
+        async for piece in subscription:
+            yield piece
+    finally:
+        # klien memutus stream: lepas langsung, jangan tunggu GC, agar pembatalan segera berlaku
+        await subscription.aclose()
+
+
+# response cache (exact + semantik opsional)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))            # 0 = nonaktif
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))           # detik, 0 = tanpa kedaluwarsa
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))  # ambang cosine, 0 = exact saja
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", os.path.join(BASE_DIR, "cache", "responses.jsonl"))
+
+
+class ResponseCache:
+    """
+    Cache jawaban LLM, disimpan append-only (JSONL) di disk.
+    - Exact: kunci = hash(model + prompt lengkap), jadi profil, konteks RAG, riwayat
+      dan pesan ikut menentukan kunci; prompt yang bergantung riwayat tetap benar.
+    - Semantik (opsional): embedding pesan dibandingkan hanya dengan entri dalam
+      scope yang sama (template + profil + riwayat identik), konteks RAG tidak ikut
+      karena ditentukan oleh pesan itu sendiri.
+    """
+
+    def __init__(self, path: str, max_size: int, ttl: float, similarity: float):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._scopes: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    @staticmethod
+    def digest(text: str, model: Optional[str] = None) -> str:
+        normalized = "\n".join(line.rstrip() for line in (text or "").strip().splitlines())
+        return hashlib.sha256(f"{model or MODEL_NAME}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _expired(self, entry: Dict[str, Any]) -> bool:
+        return bool(self.ttl) and time.time() - entry["created"] > self.ttl
+
+    def _insert(self, entry: Dict[str, Any]):
+        self._drop(entry["key"])
+        self._data[entry["key"]] = entry
+        if entry.get("scope"):
+            self._scopes.setdefault(entry["scope"], set()).add(entry["key"])
+        while len(self._data) > self.max_size:
+            self._drop(next(iter(self._data)))
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is not None and entry.get("scope"):
+            keys = self._scopes.get(entry["scope"])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._scopes[entry["scope"]]
+
+    def load(self):
+        """
+        Muat entri yang belum kedaluwarsa lalu tulis ulang file agar ringkas (di bawah lock antar worker).
+        Dipanggil sekali dari startup di background, bukan saat import; jawaban yang sudah
+        di-put sebelum itu tetap dipertahankan.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.max_size <= 0 or not os.path.exists(self.path):
+            return
+        try:
+            with file_lock(self.path + ".lock"):
+                stored: List[Dict[str, Any]] = []
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if entry.get("vec"):
+                            entry["vec"] = np.frombuffer(base64.b64decode(entry["vec"]), dtype="float32")
+                        if not self._expired(entry):
+                            stored.append(entry)
+                with self._lock:
+                    recent = list(self._data.values())
+                    for entry in stored + recent:
+                        self._insert(entry)
+                    self.evictions = 0
+                    snapshot = list(self._data.values())
+                tmp = self.path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as out:
+                    for entry in snapshot:
+                        out.write(self._dump(entry))
+                os.replace(tmp, self.path)
+            print(f"[Cache] ✅ {len(snapshot)} jawaban dimuat dari {self.path}")
+        except Exception as e:
+            print(f"[Cache] ⚠️ Gagal memuat response cache: {e}")
+
+    @staticmethod
+    def _dump(entry: Dict[str, Any]) -> str:
+        row = dict(entry)
+        if row.get("vec") is not None:
+            row["vec"] = base64.b64encode(np.asarray(row["vec"], dtype="float32").tobytes()).decode("ascii")
+        return json.dumps(row, ensure_ascii=False) + "\n"
+
+    def _get_exact(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._data.get(key)
+        if entry is not None and self._expired(entry):
+            self._drop(key)
+            return None
+        return entry
+
+    def _get_similar(self, scope: str, vec: np.ndarray) -> Optional[Dict[str, Any]]:
+        entries = [self._data[k] for k in self._scopes.get(scope, ()) if self._data[k].get("vec") is not None]
+        entries = [e for e in entries if not self._expired(e)]
+        if not entries:
+            return None
+        scores = np.vstack([e["vec"] for e in entries]) @ vec
+        best = int(np.argmax(scores))
+        return entries[best] if scores[best] >= self.similarity else None
+
+    async def lookup(
+        self, prompt: str, message: Optional[str] = None, scope: Optional[str] = None, model: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Cari jawaban; hasil 'probe' dipakai lagi oleh put() agar pesan tidak di-embed dua kali."""
+        probe: Dict[str, Any] = {"key": self.digest(prompt, model), "scope": None, "vec": None, "text": None}
+        if self.max_size <= 0:
+            return probe
+        with self._lock:
+            entry = self._get_exact(probe["key"])
+        semantic = False
+        if entry is None and self.similarity > 0 and message and scope is not None and embeddings_model is not None:
+            probe["scope"] = self.digest(scope, model)
+            try:
+                probe["vec"] = (await run_in_threadpool(embed_queries, [message]))[0]
+                with self._lock:
+                    entry = self._get_similar(probe["scope"], probe["vec"])
+                semantic = entry is not None
+            except Exception as e:
+                log(f"[Cache] ⚠️ Gagal embed pesan untuk cache semantik: {e}")
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return probe
+            self.hits += 1
+            self.semantic_hits += int(semantic)
+            self._data.move_to_end(entry["key"])
+        probe["text"] = entry["text"]
+        return probe
+
+    async def put(self, probe: Dict[str, Any], text: str):
+        """Simpan jawaban baru; jawaban error tidak pernah di-cache. Penulisan file di threadpool."""
+        if self.max_size <= 0 or not text or text.startswith("[Error"):
+            return
+        entry = {"key": probe["key"], "scope": probe["scope"], "vec": probe["vec"], "text": text, "created": time.time()}
+        with self._lock:
+            self._insert(entry)
+        await run_in_threadpool(self._append, entry)
+
+    def _append(self, entry: Dict[str, Any]):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with file_lock(self.path + ".lock"), open(self.path, "a", encoding="utf-8") as f:
+                f.write(self._dump(entry))
+        except Exception as e:
+            log(f"[Cache] ⚠️ Gagal menulis response cache: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "similarity_threshold": self.similarity or None,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIMILARITY)
+
+
+async def cached_query_ollama(
+    label: str, prompt: str, ctx: Dict[str, Any], message: Optional[str] = None, scope: Optional[str] = None
+) -> str:
+    """query_ollama lewat response cache; ctx["from_cache"][label] mencatat asal jawaban."""
+    generation_label_var.set(label)
+    overrides = GENERATION_OVERRIDES.get(label)
+    probe = await response_cache.lookup(prompt, message, scope, (overrides or {}).get("model"))
+    ctx["from_cache"][label] = probe["text"] is not None
+    if probe["text"] is not None:
+        return probe["text"]
+    text = await query_ollama(
+        prompt,
+        priority=ctx.get("priority", GENERATION_PRIORITIES.get(label, PRIORITY_NORMAL)),
+        session_id=ctx.get("queue_key", ctx.get("session_id")),
+        thread=ctx.get("thread") if label == "main" else None,
+        overrides=overrides,
+    )
+    await response_cache.put(probe, text)
+    return text
 
-def get_session_history(session_id: str):
-    if ChatMessageHistory is None:
-        return None
-    if session_id not in session_histories:
-        session_histories[session_id] = ChatMessageHistory()
-    return session_histories[session_id]
 
+def ndjson_event(event: str, **fields: Any) -> str:
+    return json.dumps({"event": event, **fields}, ensure_ascii=False) + "\n"
 
-def format_history_as_text(history, max_chars: int = MAX_HISTORY_CHARS) -> str:
-    if history is None or not getattr(history, "messages", None):
-        return "Tidak ada riwayat sebelumnya."
-    lines = []
-    for msg in history.messages:
-        role = getattr(msg, "type", "unknown")
-        content = getattr(msg, "content", "")
-        if role == "human":
-            prefix = "[Siswa]"
-        elif role == "ai":
-            prefix = "[Tutor]"
-        else:
-            prefix = "[Riwayat]"
-        lines.append(f"{prefix} {content}")
-    text = "\n".join(lines)
-    if len(text) <= max_chars:
-        return text
-    return "...\n" + text[-max_chars:]
 
-# data models
-class ChatRequest(BaseModel):
-    message: str
-    cognitive: Optional[str] = "par"  # "par" atau "tar"
-    cq1: Optional[str] = "t"          # "p", "t", "a"
-    cq2: Optional[str] = "a"          # "p", "t", "a"
-    session_id: Optional[str] = "default"
+class JsonFieldStream:
+    """
+    Isi satu field string dari output JSON yang datang bertahap, sehingga umpan balik
+    berformat JSON tetap bisa di-stream sebagai teks biasa. Output yang ternyata
+    bukan JSON (fallback LangChain, pesan error) diteruskan apa adanya.
+    """
 
+    _ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+    _UNICODE_RE = re.compile(r"\\u([0-9a-fA-F]{4})")
+    _UNICODE_PREFIX_RE = re.compile(r"(?:\\(?:u[0-9a-fA-F]{0,3})?)?")   # awal \uXXXX yang masih terpotong
 
-class EvalRequest(BaseModel):
-    answer: str
-    correct_answer: str
-    wrong_count: Optional[int] = 0
-    session_id: Optional[str] = "default"
+    def __init__(self, field: str):
+        self.pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buffer = ""
+        self.pos: Optional[int] = None   # posisi berikutnya di dalam string field
+        self.plain = False
+        self.done = False
 
-# ollama wrapper
-def _query_ollama_http(prompt: str, retries: int = 3, delay: int = 5) -> str:
-    payload = {
-        "model": MODEL_NAME,
-        "prompt": prompt,
-        "stream": False,
-    }
-    for attempt in range(retries):
-        try:
-            print(f"[OllamaHTTP] 🚀 Kirim prompt (attempt {attempt + 1}/{retries})")
-            r = requests.post(OLLAMA_API_URL, json=payload, timeout=1500)
-            if r.status_code == 200:
-                try:
-                    data = r.json()
-                    text = (data.get("response") or "").strip()
-                    return text or "[Error] Model tidak mengembalikan jawaban."
-                except json.JSONDecodeError:
-                    return "[Error] Respons JSON tidak valid."
-            elif r.status_code == 500:
-                print("[OllamaHTTP] ⚠️ Model belum siap, retry...")
-                time.sleep(delay)
+    def feed(self, piece: str) -> str:
+        """Tambahkan potongan output; kembalikan teks field yang baru bisa dikirim."""
+        self.buffer += piece
+        if self.plain:
+            return piece
+        if self.done:
+            return ""
+        if self.pos is None:
+            head = self.buffer.lstrip()
+            if head and not head.startswith("{"):
+                self.plain = True
+                return self.buffer
+            match = self.pattern.search(self.buffer)
+            if match is None:
+                return ""
+            self.pos = match.end()
+        out: List[str] = []
+        i, buf = self.pos, self.buffer
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
                 continue
+            if i + 1 >= len(buf):
+                break   # escape terpotong, tunggu potongan berikutnya
+            if buf[i + 1] != "u":
+                out.append(self._ESCAPES.get(buf[i + 1], buf[i + 1]))
+                i += 2
+                continue
+            # \uXXXX, termasuk pasangan surrogate (emoji)
+            first = self._UNICODE_RE.match(buf, i)
+            if first is None:
+                break
+            code = int(first.group(1), 16)
+            if 0xD800 <= code < 0xDC00:
+                second = self._UNICODE_RE.match(buf, i + 6)
+                if second is None and self._UNICODE_PREFIX_RE.fullmatch(buf, i + 6):
+                    break   # low surrogate mungkin masih di potongan berikutnya
+                low = int(second.group(1), 16) if second is not None else 0
+                if 0xDC00 <= low < 0xE000:
+                    code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                    i += 6
+            out.append(chr(code) if not 0xD800 <= code < 0xE000 else "\ufffd")
+            i += 6
+        self.pos = i
+        return "".join(out)
+
+
+async def pump_ollama_stream(
+    label: str,
+    prompt: str,
+    events: "asyncio.Queue[Dict[str, Any]]",
+    ctx: Dict[str, Any],
+    message: Optional[str] = None,
+    scope: Optional[str] = None,
+    field: Optional[str] = None,
+) -> str:
+    """
+    Teruskan token ke antrean event dengan label tertentu; kembalikan teks lengkap.
+    Jawaban dari response cache dikirim sebagai satu token dengan cached=true.
+    field: output berupa JSON, hanya isi field string ini yang dikirim sebagai token.
+    """
+    pieces: List[str] = []
+    failed = False
+    generation_label_var.set(label)
+    overrides = GENERATION_OVERRIDES.get(label)
+    view = JsonFieldStream(field) if field else None
+    try:
+        probe = await response_cache.lookup(prompt, message, scope, (overrides or {}).get("model"))
+        ctx["from_cache"][label] = probe["text"] is not None
+        if probe["text"] is not None:
+            shown = view.feed(probe["text"]) if view is not None else probe["text"]
+            await events.put({"event": "token", "label": label, "text": shown, "cached": True})
+            return probe["text"]
+        priority = GENERATION_PRIORITIES.get(label, PRIORITY_NORMAL)
+        thread = ctx.get("thread") if label == "main" else None
+        async for piece in stream_ollama(prompt, priority, ctx.get("session_id"), thread, overrides):
+            pieces.append(piece)
+            if isinstance(piece, StreamError):
+                failed = True
+                shown = piece   # tetap terlihat walau output JSON
             else:
-                print(f"[OllamaHTTP] ⚠️ HTTP {r.status_code}: {r.text[:200]}")
-                return f"[Error Ollama API] {r.text[:200]}"
-        except requests.exceptions.ConnectionError:
-            print("[OllamaHTTP] ❌ Tidak dapat terhubung ke Ollama, retry...")
-            time.sleep(delay)
-        except requests.exceptions.ReadTimeout:
-            print("[OllamaHTTP] ⏱️ Timeout (300 detik).")
-            return "[Error Ollama API] Timeout."
-        except Exception as e:
-            print(f"[OllamaHTTP] ❌ Exception: {e}")
-            time.sleep(delay)
-    return "[Error Ollama API] Gagal menghubungi Ollama setelah beberapa percobaan."
+                shown = view.feed(piece) if view is not None else piece
+            if shown:
+                await events.put({"event": "token", "label": label, "text": shown})
+    finally:
+        await events.put({"event": "end", "label": label})
+    text = "".join(pieces).strip() or "[Error] Model tidak mengembalikan jawaban."
+    if not failed:
+        # jawaban gagal/terpotong tidak pernah di-cache
+        await response_cache.put(probe, text)
+    return text
 
 
-def query_ollama(prompt: str, retries: int = 3, delay: int = 5) -> str:
-    if llm is None:
-        return _query_ollama_http(prompt, retries=retries, delay=delay)
+async def drain_events(events: "asyncio.Queue[Dict[str, Any]]", tasks: List["asyncio.Task[Any]"]) -> AsyncIterator[str]:
+    """Keluarkan event dari antrean sampai semua task selesai dan antrean kosong."""
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(events.get(), timeout=0.1)
+            except asyncio.TimeoutError:
+                if all(t.done() for t in tasks):
+                    break
+                continue
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+    finally:
+        # klien memutus stream: hentikan generasi yang masih berjalan
+        for t in tasks:
+            if not t.done():
+                t.cancel()
 
-    last_error: Optional[Exception] = None
-    for attempt in range(retries):
-        try:
-            print(f"[OllamaLC] 🚀 Kirim prompt (attempt {attempt + 1}/{retries})")
-            result = llm.invoke(prompt)
-            text = getattr(result, "content", None)
-            if not text:
-                text = str(result)
-            text = (text or "").strip()
-            return text or "[Error] Model tidak mengembalikan jawaban."
-        except Exception as e:
-            last_error = e
-            print(f"[OllamaLC] ❌ Exception: {e}")
-            time.sleep(delay)
 
-    print("[OllamaLC] ⚠️ Gagal lewat LangChain, fallback HTTP.")
-    if last_error:
-        print(f"[OllamaLC] Last error: {last_error}")
-    return _query_ollama_http(prompt, retries=retries, delay=delay)
+def task_results(tasks: List["asyncio.Task[Any]"]) -> List[Any]:
+    """Hasil task yang sudah selesai; semua exception diambil dulu, lalu yang pertama dilempar ulang."""
+    errors = [t.exception() for t in tasks if not t.cancelled()]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [t.result() for t in tasks]
 
 # utility for code detection
 CODE_REGEX = re.compile(r"```[\s\S]*?```|(\bfor\b|\bwhile\b|\bif\b|\bdef\b|\bprint\b|\breturn\b|;|=)")
@@ -434,22 +3441,172 @@ def balanced_cq_compare(cq1: str, cq2: str):
     cq_comp2 = cq1 or remaining[0]
     return cq_comp1, cq_comp2
 
+# prompt assembly (budget token)
+PROMPT_BUDGET_DEFAULTS = {
+    "chat_main": 1500,
+    "chat_turn": 900,
+    "chat_compare": 1000,
+    "chat_followup": 600,
+    "eval": 1400,
+    "eval_followup": 500,
+}
+PROMPT_BUDGETS = {
+    kind: int(os.getenv(f"PROMPT_BUDGET_{kind.upper()}", str(default))) for kind, default in PROMPT_BUDGET_DEFAULTS.items()
+}
+PROMPT_MIN_SECTION_TOKENS = 24   # sisa budget lebih kecil dari ini: section opsional dilewati
+
+# awal prompt yang identik untuk semua panggilan, agar prefix KV/prompt cache Ollama terpakai ulang
+TUTOR_SYSTEM_PREFIX = (
+    "Kamu adalah tutor Computational Thinking yang adaptif untuk siswa.\n"
+    "Gunakan Bahasa Indonesia yang jelas. Bimbing siswa menemukan jawabannya sendiri: "
+    "jangan berikan jawaban final atau kode lengkap secara langsung."
+)
+
+
+def prompt_section(
+    name: str, text: str, title: Optional[str] = None, priority: int = 0, trim: Optional[str] = None,
+    items: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    Satu bagian prompt. priority 0 = wajib (tidak dipangkas); angka lebih besar diisi belakangan.
+    trim: "tail" (simpan bagian akhir, mis. riwayat), "head" (simpan awal), "items" (buang item terakhir).
+    """
+    return {"name": name, "text": text, "title": title, "priority": priority, "trim": trim, "items": items}
+
+
+def _render_section(section: Dict[str, Any], body: str) -> str:
+    return f"=== {section['title']} ===\n{body}" if section["title"] else body
+
+
+def _fit_text(text: str, budget: int, keep: str) -> str:
+    """Potong teks per baris (lalu per kata) agar muat budget token; keep = "head" atau "tail"."""
+    lines = text.split("\n")
+    if keep == "tail":
+        lines.reverse()
+    kept: List[str] = []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            words = line.split()
+            if keep == "tail":
+                words.reverse()
+            partial: List[str] = []
+            for word in words:
+                word_cost = count_tokens(word)
+                if used + word_cost > budget:
+                    break
+                partial.append(word)
+                used += word_cost
+            if partial:
+                if keep == "tail":
+                    partial.reverse()
+                kept.append(("… " if keep == "tail" else "") + " ".join(partial) + (" …" if keep == "head" else ""))
+            break
+        kept.append(line)
+        used += cost
+    if keep == "tail":
+        kept.reverse()
+    return "\n".join(kept)
+
+
+def assemble_prompt(kind: str, sections: List[Dict[str, Any]]) -> Tuple[str, Dict[str, int]]:
+    """
+    Susun prompt dalam budget token PROMPT_BUDGETS[kind]. Urutan section = layout tetap
+    (dari yang paling stabil ke yang paling bervariasi); section wajib selalu masuk, section lain
+    diisi menurut prioritas dan dipangkas bila sisa budget tidak cukup.
+    Mengembalikan (prompt, jumlah token per section + "total").
+    """
+    budget = PROMPT_BUDGETS.get(kind, 1500)
+    bodies: Dict[str, str] = {}
+    counts: Dict[str, int] = {}
+    for section in sections:
+        if section["priority"] == 0:
+            bodies[section["name"]] = section["text"]
+            counts[section["name"]] = count_tokens(_render_section(section, section["text"]))
+    used = sum(counts.values())
+
+    for section in sorted((s for s in sections if s["priority"] > 0), key=lambda s: s["priority"]):
+        remaining = budget - used - count_tokens(_render_section(section, ""))
+        if remaining < PROMPT_MIN_SECTION_TOKENS:
+            continue
+        if section["trim"] == "items":
+            picked: List[str] = []
+            for item in section["items"] or []:
+                cost = count_tokens(item) + 1
+                if cost > remaining:
+                    break
+                picked.append(item)
+                remaining -= cost
+            body = "\n\n".join(picked)
+        elif count_tokens(section["text"]) <= remaining:
+            body = section["text"]
+        else:
+            body = _fit_text(section["text"], remaining, section["trim"] or "head")
+        if not body.strip():
+            continue
+        bodies[section["name"]] = body
+        counts[section["name"]] = count_tokens(_render_section(section, body))
+        used += counts[section["name"]]
+
+    prompt = "\n\n".join(_render_section(s, bodies[s["name"]]) for s in sections if s["name"] in bodies)
+    counts["total"] = used
+    for name, tokens in counts.items():
+        PROMPT_TOKENS.observe(tokens, kind=kind, section=name)
+    dropped = [s["name"] for s in sections if s["name"] not in bodies]
+    log(
+        f"[Prompt] 📏 {kind}: ~{used}/{budget} token ("
+        + ", ".join(f"{n} {t}" for n, t in counts.items() if n != "total")
+        + (f"; dilewati: {', '.join(dropped)}" if dropped else "")
+        + ")"
+    )
+    return prompt, counts
+
+
+def rag_prompt_section(rag_chunks: List[Dict], priority: int = 1) -> Dict[str, Any]:
+    """
+    Materi RAG sebagai item berurutan peringkat, sehingga yang terbuang duluan adalah yang paling
+    tidak relevan. Chunk yang isinya sama (hanya beda baris heading) cukup disisipkan sekali.
+    """
+    items: List[str] = []
+    seen = set()
+    for ch in rag_chunks:
+        header = ch.get("header") or ""
+        body = ch["text"][len(header):].strip() if header and ch["text"].startswith(header) else ch["text"].strip()
+        if body in seen:
+            continue
+        seen.add(body)
+        items.append(f"[Sumber {len(items) + 1} - {ch['source']}]\n{ch['text']}")
+    if not items:
+        return prompt_section("materi", "Tidak ada konteks materi relevan ditemukan.", "KONTEN MATERI TERKAIT (RAG)")
+    return prompt_section("materi", "", "KONTEN MATERI TERKAIT (RAG)", priority, "items", items)
+
 # chat endpoint
-@app.post("/chat")
-def chat_endpoint(req: ChatRequest):
+def fetch_rag_chunks(query: str, k: int = 4) -> List[Dict]:
+    """Ambil chunk RAG untuk query (urut relevansi); kosong selama index belum siap."""
+    if materials_loaded:
+        maybe_reload_index()
+        return retrieve_relevant_chunks(query, k=k)
+    # index belum siap: jawab tanpa RAG, pembangunan index tetap berjalan di background
+    start_index_warmup()
+    return []
+
+
+def prepare_chat(
+    req: ChatRequest, rag: Optional[List[Dict]] = None, with_history: bool = True
+) -> Dict[str, Any]:
     """
-    Chat utama:
-    - Profil utama: cognitive_main (par/tar) + cq1_main + cq2_main
-    - Profil perbandingan: kebalikan cognitive + CQ seimbang
-    - Menggunakan RAG + memory + follow-up question
+    Siapkan semua bahan untuk satu giliran /chat:
+    profil utama & perbandingan, konteks RAG, ringkasan riwayat, dan prompt.
+    rag = chunk RAG yang sudah diambil sebelumnya (mode batch).
     """
     session_id = req.session_id or "default"
-    history = get_session_history(session_id)
+    history = get_session_history(session_id) if with_history else None
 
     print("\n==============================")
-    print(f"[CHAT] Pertanyaan: {req.message}")
-    print(f"[CHAT] Cognitive: {req.cognitive}, CQ1={req.cq1}, CQ2={req.cq2}")
-    print(f"[CHAT] Session ID: {session_id}")
+    log(f"[CHAT] Pertanyaan: {req.message}")
+    log(f"[CHAT] Cognitive: {req.cognitive}, CQ1={req.cq1}, CQ2={req.cq2}")
+    log(f"[CHAT] Session ID: {session_id}")
     print("==============================")
 
     # profil utama
@@ -473,14 +3630,8 @@ def chat_endpoint(req: ChatRequest):
     cq2_compare_label = cq_label(cq2_compare)
 
     # rag
-    load_materials_and_build_index()
-    rag_chunks = retrieve_relevant_chunks(req.message, k=4)
-    context_parts = []
-    for i, ch in enumerate(rag_chunks, start=1):
-        chunk_text = ch["text"][:RAG_CHUNK_MAX_CHARS]
-        context_parts.append(f"[Sumber {i} - {ch['source']}]\n{chunk_text}\n")
-    context_text = "\n\n".join(context_parts) if context_parts else "Tidak ada konteks materi relevan ditemukan."
-    used_rag = bool(rag_chunks)
+    rag_chunks = rag if rag is not None else fetch_rag_chunks(req.message, k=4)
+    prompt_started = time.perf_counter()
 
     # history ringkas
     history_text = format_history_as_text(history)
@@ -488,114 +3639,272 @@ def chat_endpoint(req: ChatRequest):
     # deteksi code question
     code_question = is_code_like(req.message)
 
-    # prompt utama
+    # layout tetap: sistem > profil > riwayat > materi > pertanyaan > tugas
     if code_question:
-        prompt_main = (
-            f"Kamu adalah tutor Computational Thinking dengan profil kognitif utama "
-            f"'{cognitive_main_label}' dan preferensi '{cq1_main_label}' serta '{cq2_main_label}'.\n\n"
-            f"=== RINGKASAN RIWAYAT SEBELUMNYA ===\n{history_text}\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Analisis pertanyaan/logika/kode berikut:\n\n"
-            f"{req.message}\n\n"
-            f"Berikan penjelasan yang menekankan pemahaman konsep, logika, dan langkah berpikir "
-            f"sesuai profil kognitif ini. JANGAN memberikan jawaban final atau kode lengkap secara eksplisit. "
-            f"Bimbing siswa agar dapat menemukan jawabannya sendiri."
+        task_main = (
+            "Analisis pertanyaan/logika/kode siswa. Berikan penjelasan yang menekankan pemahaman konsep, "
+            "logika, dan langkah berpikir sesuai profil kognitif ini. JANGAN memberikan jawaban final atau "
+            "kode lengkap secara eksplisit. Bimbing siswa agar dapat menemukan jawabannya sendiri."
         )
-        prompt_compare = (
-            f"Kamu adalah tutor Computational Thinking VERSI PERBANDINGAN, dengan profil kognitif "
-            f"'{cognitive_compare_label}' dan preferensi '{cq1_compare_label}' serta '{cq2_compare_label}'.\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Pertanyaan/logika/kode siswa:\n{req.message}\n\n"
-            f"Buat versi penjelasan alternatif yang tetap benar namun menonjolkan cara berpikir "
-            f"sesuai profil perbandingan ini. Jangan membocorkan jawaban final; fokus pada pendekatan berpikir."
+        task_compare = (
+            "Buat versi penjelasan alternatif yang tetap benar namun menonjolkan cara berpikir sesuai "
+            "profil perbandingan ini. Jangan membocorkan jawaban final; fokus pada pendekatan berpikir."
         )
     else:
-        prompt_main = (
-            f"Kamu adalah tutor dengan profil kognitif utama '{cognitive_main_label}' dan preferensi "
-            f"'{cq1_main_label}' serta '{cq2_main_label}'.\n\n"
-            f"=== RINGKASAN RIWAYAT SEBELUMNYA ===\n{history_text}\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Berikan penjelasan yang mudah dipahami, terstruktur, dan sesuai dengan profil kognitif tersebut "
-            f"untuk pertanyaan berikut:\n\n"
-            f"{req.message}\n\n"
-            f"Jangan berikan jawaban final langsung. Fokuslah pada pemahaman konsep, ilustrasi, dan ajakan "
-            f"agar siswa menyimpulkan sendiri."
+        task_main = (
+            "Berikan penjelasan yang mudah dipahami, terstruktur, dan sesuai dengan profil kognitif tersebut "
+            "untuk pertanyaan siswa. Jangan berikan jawaban final langsung. Fokuslah pada pemahaman konsep, "
+            "ilustrasi, dan ajakan agar siswa menyimpulkan sendiri."
         )
-        prompt_compare = (
-            f"Kamu adalah tutor VERSI PERBANDINGAN, dengan profil kognitif '{cognitive_compare_label}' dan "
-            f"preferensi '{cq1_compare_label}' serta '{cq2_compare_label}'.\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Buat versi penjelasan lain untuk pertanyaan yang sama:\n\n{req.message}\n\n"
-            f"Penjelasan ini harus benar namun menonjolkan cara berpikir yang kontras namun saling melengkapi "
-            f"dengan profil utama. Jangan bocorkan jawaban final."
+        task_compare = (
+            "Buat versi penjelasan lain untuk pertanyaan yang sama. Penjelasan ini harus benar namun menonjolkan "
+            "cara berpikir yang kontras namun saling melengkapi dengan profil utama. Jangan bocorkan jawaban final."
         )
-
-    reply_main = query_ollama(prompt_main)
-    reply_compare = query_ollama(prompt_compare)
-
-    # follow-up
-    followup_prompt = (
-        f"Kamu adalah tutor interaktif.\n\n"
-        f"=== RINGKASAN RIWAYAT SEBELUMNYA ===\n{history_text}\n\n"
-        f"Jawaban penjelasan yang baru saja kamu berikan:\n\n"
-        f"{reply_main}\n\n"
-        f"Buat SATU pertanyaan lanjutan (tepat 1 kalimat) untuk mengajak siswa berpikir lebih dalam. "
-        f"Hindari memberi jawaban; fokus pada konsep atau aplikasinya."
+    profile_main = (
+        f"Profil kognitif utama '{cognitive_main_label}', preferensi '{cq1_main_label}' serta '{cq2_main_label}'."
+    )
+    profile_compare = (
+        f"VERSI PERBANDINGAN: profil kognitif '{cognitive_compare_label}', "
+        f"preferensi '{cq1_compare_label}' serta '{cq2_compare_label}'."
     )
-    followup_question = query_ollama(followup_prompt).strip()
+    prompt_main, tokens_main = assemble_prompt(
+        "chat_main",
+        [
+            prompt_section("sistem", TUTOR_SYSTEM_PREFIX),
+            prompt_section("profil", profile_main, "PROFIL"),
+            prompt_section("riwayat", history_text, "RINGKASAN RIWAYAT SEBELUMNYA", priority=2, trim="tail"),
+            rag_prompt_section(rag_chunks),
+            prompt_section("pertanyaan", req.message, "PERTANYAAN SISWA"),
+            prompt_section("tugas", task_main, "TUGAS"),
+        ],
+    )
+    prompt_tokens = {"chat_main": tokens_main}
 
-    # update memory
-    if history is not None:
-        history.add_user_message(req.message)
-        history.add_ai_message(reply_main)
+    # giliran lanjutan thread utama: context Ollama sudah memuat sistem, profil & percakapan sebelumnya
+    thread = None
+    if history is not None and SESSION_CONTEXT_REUSE:
+        session_context = session_contexts.get(session_id)
+        turn_prompt = None
+        if session_context.usable(profile_main, history):
+            turn_prompt, prompt_tokens["chat_turn"] = assemble_prompt(
+                "chat_turn",
+                [
+                    rag_prompt_section(rag_chunks),
+                    prompt_section("pertanyaan", req.message, "PERTANYAAN SISWA BERIKUTNYA"),
+                    prompt_section("tugas", task_main, "TUGAS"),
+                ],
+            )
+        thread = ContextTurn(session_context, profile_main, turn_prompt)
+        session_contexts.count(reused=turn_prompt is not None)
 
-    # simpan log global
-    conversation_entry = {
-        "user_message": req.message,
+    prompt_compare, prompt_tokens["chat_compare"] = assemble_prompt(
+        "chat_compare",
+        [
+            prompt_section("sistem", TUTOR_SYSTEM_PREFIX),
+            prompt_section("profil", profile_compare, "PROFIL"),
+            rag_prompt_section(rag_chunks),
+            prompt_section("pertanyaan", req.message, "PERTANYAAN SISWA"),
+            prompt_section("tugas", task_compare, "TUGAS"),
+        ],
+    )
+
+    observe_stage("prompt_build", time.perf_counter() - prompt_started)
+    return {
+        "message": req.message,
+        "session_id": session_id,
+        "history": history,
+        "history_text": history_text,
         "cognitive_main": cognitive_main_label,
         "cq1_main": cq1_main_label,
         "cq2_main": cq2_main_label,
         "cognitive_compare": cognitive_compare_label,
         "cq1_compare": cq1_compare_label,
         "cq2_compare": cq2_compare_label,
-        "reply_main": reply_main,
-        "reply_compare": reply_compare,
-        "followup_question": followup_question,
         "is_code_question": code_question,
-        "used_rag": used_rag,
-        "rag_sources": [
-            {"source": ch["source"], "score": ch["score"]}
-            for ch in rag_chunks
-        ],
-        "session_id": session_id,
+        "rag_chunks": rag_chunks,
+        "used_rag": bool(rag_chunks),
+        "profile_main": profile_main,
+        "prompt_main": prompt_main,
+        "prompt_compare": prompt_compare,
+        "prompt_tokens": prompt_tokens,
+        "thread": thread,
+        # scope cache semantik: semua isi prompt selain pesan & konteks RAG
+        "scope_main": "\n".join(
+            ["chat_main", cognitive_main_label, cq1_main_label, cq2_main_label, str(code_question), history_text]
+        ),
+        "scope_compare": "\n".join(
+            ["chat_compare", cognitive_compare_label, cq1_compare_label, cq2_compare_label, str(code_question)]
+        ),
+        "from_cache": {},
     }
-    conversation_history.append(conversation_entry)
-    print(f"[CHAT] 💾 Riwayat disimpan (total {len(conversation_history)} percakapan).")
 
+
+def build_chat_followup_prompt(ctx: Dict[str, Any], reply_main: str) -> str:
+    # riwayat tidak diulang: jawaban barusan sudah memuat konteks yang dibutuhkan
+    prompt, tokens = assemble_prompt(
+        "chat_followup",
+        [
+            prompt_section("sistem", TUTOR_SYSTEM_PREFIX),
+            prompt_section("profil", ctx["profile_main"], "PROFIL"),
+            prompt_section("pertanyaan", ctx["message"], "PERTANYAAN SISWA", priority=2, trim="head"),
+            prompt_section("jawaban", reply_main, "JAWABAN PENJELASAN YANG BARU SAJA KAMU BERIKAN", priority=1, trim="head"),
+            prompt_section(
+                "tugas",
+                "Buat SATU pertanyaan lanjutan (tepat 1 kalimat) untuk mengajak siswa berpikir lebih dalam. "
+                "Hindari memberi jawaban; fokus pada konsep atau aplikasinya.",
+                "TUGAS",
+            ),
+        ],
+    )
+    ctx["prompt_tokens"]["chat_followup"] = tokens
+    return prompt
+
+
+def chat_profile(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Field profil & RAG yang dikirim ke frontend (sebelum jawaban tersedia)."""
     return {
-        "cognitive_main": cognitive_main_label,
-        "cq1_main": cq1_main_label,
-        "cq2_main": cq2_main_label,
-        "cognitive_compare": cognitive_compare_label,
-        "cq1_compare": cq1_compare_label,
-        "cq2_compare": cq2_compare_label,
+        "cognitive_main": ctx["cognitive_main"],
+        "cq1_main": ctx["cq1_main"],
+        "cq2_main": ctx["cq2_main"],
+        "cognitive_compare": ctx["cognitive_compare"],
+        "cq1_compare": ctx["cq1_compare"],
+        "cq2_compare": ctx["cq2_compare"],
+        "is_code_question": ctx["is_code_question"],
+        "used_rag": ctx["used_rag"],
+        "session_id": ctx["session_id"],
+    }
+
+
+async def finish_chat(
+    ctx: Dict[str, Any], reply_main: str, reply_compare: str, followup_question: str
+) -> Dict[str, Any]:
+    """Simpan giliran chat ke memory & log global, lalu susun respons."""
+    # update memory (SQLite, bisa menunggu lock worker lain: jangan di event loop)
+    history = ctx["history"]
+    if history is not None:
+        await run_in_threadpool(history.add_exchange, ctx["message"], reply_main)
+    if ctx["thread"] is not None:
+        ctx["thread"].commit(history)
+
+    # simpan log global
+    conversation_entry = {
+        "user_message": ctx["message"],
+        "cognitive_main": ctx["cognitive_main"],
+        "cq1_main": ctx["cq1_main"],
+        "cq2_main": ctx["cq2_main"],
+        "cognitive_compare": ctx["cognitive_compare"],
+        "cq1_compare": ctx["cq1_compare"],
+        "cq2_compare": ctx["cq2_compare"],
         "reply_main": reply_main,
         "reply_compare": reply_compare,
         "followup_question": followup_question,
-        "is_code_question": code_question,
-        "used_rag": used_rag,
-        "session_id": session_id,
+        "is_code_question": ctx["is_code_question"],
+        "used_rag": ctx["used_rag"],
+        "rag_sources": [
+            {"source": ch["source"], "score": ch["score"], **{key: ch[key] for key in ("bm25", "rrf") if key in ch}}
+            for ch in ctx["rag_chunks"]
+        ],
+        "session_id": ctx["session_id"],
     }
+    entry_id = await run_in_threadpool(conversation_log.append, conversation_entry)
+    log(f"[CHAT] 💾 Riwayat disimpan (percakapan #{entry_id}).")
+
+    response = chat_profile(ctx)
+    response.update(
+        {
+            "reply_main": reply_main,
+            "reply_compare": reply_compare,
+            "followup_question": followup_question,
+            "from_cache": ctx["from_cache"],
+        }
+    )
+    return response
+
+
+async def chat_event_stream(ctx: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Stream NDJSON untuk /chat: token main, compare dan followup dimultipleks
+    dalam satu stream dengan label, diakhiri event "done" berisi respons lengkap.
+    """
+    events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+
+    async def run_main_then_followup():
+        reply_main = await pump_ollama_stream(
+            "main", ctx["prompt_main"], events, ctx, ctx["message"], ctx["scope_main"]
+        )
+        followup = await pump_ollama_stream("followup", build_chat_followup_prompt(ctx, reply_main), events, ctx)
+        return reply_main, followup.strip()
+
+    task_main = asyncio.create_task(run_main_then_followup())
+    task_compare = asyncio.create_task(
+        pump_ollama_stream("compare", ctx["prompt_compare"], events, ctx, ctx["message"], ctx["scope_compare"])
+    )
+
+    yield ndjson_event("meta", **chat_profile(ctx))
+    async for line in drain_events(events, [task_main, task_compare]):
+        yield line
+
+    try:
+        (reply_main, followup_question), reply_compare = task_results([task_main, task_compare])
+    except Exception as e:
+        # respons 200 sudah terkirim: laporkan lewat event agar klien tidak menunggu "done"
+        log(f"[CHAT] ❌ Generasi gagal: {e!r}")
+        yield ndjson_event("error", message=f"Generasi gagal: {e}")
+        return
+    yield ndjson_event("done", **(await finish_chat(ctx, reply_main, reply_compare, followup_question)))
+
+
+@app.post("/chat")
+async def chat_endpoint(req: ChatRequest):
+    """
+    Chat utama:
+    - Profil utama: cognitive_main (par/tar) + cq1_main + cq2_main
+    - Profil perbandingan: kebalikan cognitive + CQ seimbang
+    - Menggunakan RAG + memory + follow-up question
+    - stream=true: token dikirim bertahap sebagai NDJSON
+    """
+    rejected = admission_rejection()
+    if rejected is not None:
+        return rejected
+
+    # RAG & embedding masih sinkron, jadi dijalankan di threadpool
+    ctx = await run_in_threadpool(prepare_chat, req)
+
+    if req.stream:
+        return StreamingResponse(chat_event_stream(ctx), media_type="application/x-ndjson")
+    return await run_chat(ctx)
+
+
+async def run_chat(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Jalankan generasi satu giliran chat (non-streaming) dan simpan hasilnya."""
+    # main & compare jalan paralel; follow-up menunggu reply_main saja
+    async def run_main_then_followup():
+        reply_main = await cached_query_ollama("main", ctx["prompt_main"], ctx, ctx["message"], ctx["scope_main"])
+        followup = await cached_query_ollama("followup", build_chat_followup_prompt(ctx, reply_main), ctx)
+        return reply_main, followup.strip()
+
+    (reply_main, followup_question), reply_compare = await asyncio.gather(
+        run_main_then_followup(),
+        cached_query_ollama("compare", ctx["prompt_compare"], ctx, ctx["message"], ctx["scope_compare"]),
+    )
+
+    return await finish_chat(ctx, reply_main, reply_compare, followup_question)
 
 # eval endpoint
-@app.post("/evaluate")
-def evaluate_answer(req: EvalRequest):
-    print("[EVALUASI] 🧠 Mode evaluasi adaptif aktif")
+def evaluation_rag_query(req: EvalRequest) -> str:
+    return f"{req.correct_answer}\n\nJawaban siswa:\n{req.answer}"
+
+
+def prepare_evaluation(
+    req: EvalRequest, rag: Optional[List[Dict]] = None, with_history: bool = True
+) -> Dict[str, Any]:
+    """Siapkan tahap bantuan, konteks RAG dan prompt untuk satu evaluasi."""
+    log("[EVALUASI] 🧠 Mode evaluasi adaptif aktif")
     wrong_count = req.wrong_count or 0
     answer = (req.answer or "").strip()
     is_code = is_code_like(answer)
     session_id = req.session_id or "default"
-    history = get_session_history(session_id)
+    history = get_session_history(session_id) if with_history else None
 
     if wrong_count == 0:
         hint_level = "Evaluasi awal."
@@ -610,95 +3919,501 @@ def evaluate_answer(req: EvalRequest):
         hint_level = "Facilitative Step-by-Step Guide: panduan terstruktur namun tetap tidak membocorkan jawaban."
         followup_role = "ajakan refleksi agar siswa menyusun kembali pemahamannya."
 
-    load_materials_and_build_index()
-    rag_query = f"{req.correct_answer}\n\nJawaban siswa:\n{req.answer}"
-    rag_chunks = retrieve_relevant_chunks(rag_query, k=4)
-    context_parts = []
-    for i, ch in enumerate(rag_chunks, start=1):
-        chunk_text = ch["text"][:RAG_CHUNK_MAX_CHARS]
-        context_parts.append(f"[Sumber {i} - {ch['source']}]\n{chunk_text}\n")
-    context_text = "\n\n".join(context_parts) if context_parts else "Tidak ada konteks materi relevan ditemukan."
-    used_rag = bool(rag_chunks)
+    rag_chunks = rag if rag is not None else fetch_rag_chunks(evaluation_rag_query(req), k=4)
+    prompt_started = time.perf_counter()
 
     history_text = format_history_as_text(history)
 
     if is_code:
-        prompt_eval = (
-            f"Kamu adalah tutor Computational Thinking.\n\n"
-            f"=== RIWAYAT EVALUASI SEBELUMNYA (ringkas) ===\n{history_text}\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Evaluasi logika, struktur, dan kejelasan kode/pseudocode berikut.\n\n"
-            f"Jawaban siswa:\n{req.answer}\n\n"
-            f"Kunci jawaban (rujukan konsep):\n{req.correct_answer}\n\n"
+        task_eval = (
+            f"Evaluasi logika, struktur, dan kejelasan kode/pseudocode siswa terhadap kunci jawaban.\n"
             f"Tahap bantuan: {hint_level}\n"
             f"Berikan umpan balik ringkas, fokus ke algoritma & urutan langkah, bukan sekadar sintaks. "
             f"Jika salah, JANGAN memberikan jawaban final — beri petunjuk bertahap."
         )
     else:
-        prompt_eval = (
-            f"Kamu adalah tutor adaptif.\n\n"
-            f"=== RIWAYAT EVALUASI SEBELUMNYA (ringkas) ===\n{history_text}\n\n"
-            f"=== KONTEN MATERI TERKAIT (RAG) ===\n{context_text}\n\n"
-            f"Evaluasi jawaban siswa berdasarkan kunci jawaban berikut.\n\n"
-            f"Jawaban siswa:\n{req.answer}\n\n"
-            f"Kunci jawaban:\n{req.correct_answer}\n\n"
+        task_eval = (
+            f"Evaluasi jawaban siswa berdasarkan kunci jawaban.\n"
             f"Tahap bantuan: {hint_level}\n"
             f"Berikan umpan balik mendidik dan petunjuk bertahap. Jangan bocorkan jawaban final jika salah."
         )
+    task_eval += (
+        '\nJawab HANYA dengan JSON: {"umpan_balik": "<umpan balik untuk siswa>", "benar": true/false}. '
+        '"benar" bernilai true hanya jika jawaban siswa benar secara konsep.'
+    )
+    # layout tetap: sistem > riwayat > materi > jawaban > kunci > tugas
+    prompt_eval, tokens_eval = assemble_prompt(
+        "eval",
+        [
+            prompt_section("sistem", TUTOR_SYSTEM_PREFIX),
+            prompt_section("riwayat", history_text, "RIWAYAT EVALUASI SEBELUMNYA (ringkas)", priority=2, trim="tail"),
+            rag_prompt_section(rag_chunks),
+            prompt_section("jawaban", req.answer, "JAWABAN SISWA"),
+            prompt_section("kunci", req.correct_answer, "KUNCI JAWABAN"),
+            prompt_section("tugas", task_eval, "TUGAS"),
+        ],
+    )
+    followup_prompt, tokens_followup = assemble_prompt(
+        "eval_followup",
+        [
+            prompt_section("sistem", TUTOR_SYSTEM_PREFIX),
+            prompt_section("riwayat", history_text, "RIWAYAT EVALUASI SEBELUMNYA (ringkas)", priority=1, trim="tail"),
+            prompt_section("jawaban", req.answer, "JAWABAN SISWA"),
+            prompt_section("kunci", req.correct_answer, "KUNCI KONSEP"),
+            prompt_section(
+                "tugas",
+                f"Pada tahap: {hint_level}, {followup_role} Tepat 1 kalimat. Jangan berikan jawaban langsung.",
+                "TUGAS",
+            ),
+        ],
+    )
+
+    observe_stage("prompt_build", time.perf_counter() - prompt_started)
+    return {
+        "answer": req.answer,
+        "session_id": session_id,
+        "history": history,
+        "hint_level": hint_level,
+        "is_code": is_code,
+        "used_rag": bool(rag_chunks),
+        "prompt_eval": prompt_eval,
+        "followup_prompt": followup_prompt,
+        "prompt_tokens": {"eval": tokens_eval, "eval_followup": tokens_followup},
+        # scope cache semantik: semua isi prompt selain jawaban siswa & konteks RAG.
+        # Verdict "feedback" hanya exact-match: jawaban yang mirip (i < 10 vs i <= 10) bisa berbeda benar/salahnya.
+        "scope_followup": "\n".join(["eval_followup", followup_role, req.correct_answer or "", history_text]),
+        "from_cache": {},
+    }
 
-    feedback = query_ollama(prompt_eval)
-    is_correct_flag = "benar" in feedback.lower() and "salah" not in feedback.lower()
 
-    followup_prompt = (
-        f"Kamu adalah tutor interaktif.\n\n"
-        f"=== RIWAYAT EVALUASI SEBELUMNYA (ringkas) ===\n{history_text}\n\n"
-        f"Jawaban siswa:\n{req.answer}\n\n"
-        f"Kunci konsep:\n{req.correct_answer}\n\n"
-        f"Pada tahap: {hint_level}, {followup_role} "
-        f"Tepat 1 kalimat. Jangan berikan jawaban langsung."
-    )
-    followup_question = query_ollama(followup_prompt).strip()
+def parse_evaluation_output(raw: str) -> Tuple[Optional[bool], str]:
+    """(benar, umpan_balik) dari output JSON evaluasi; output yang bukan JSON menjadi umpan balik apa adanya."""
+    text = (raw or "").strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict) and isinstance(data.get("umpan_balik"), str):
+            verdict = data.get("benar")
+            return (verdict if isinstance(verdict, bool) else None), data["umpan_balik"].strip()
+    return None, text
+
 
+async def finish_evaluation(ctx: Dict[str, Any], raw_feedback: str, followup_question: str) -> Dict[str, Any]:
+    """Ambil verdict dari output JSON, simpan ke memory, lalu susun respons evaluasi."""
+    verdict, feedback = parse_evaluation_output(raw_feedback)
+    if verdict is None:
+        log("[EVALUASI] ⚠️ Output evaluasi bukan JSON yang valid, jawaban dianggap belum benar.")
+    is_correct_flag = bool(verdict)
+
+    history = ctx["history"]
     if history is not None:
-        history.add_user_message(f"[EVALUASI] Jawaban: {req.answer}")
-        history.add_ai_message(f"[UMPAN BALIK] {feedback.strip()}")
+        await run_in_threadpool(
+            history.add_exchange, f"[EVALUASI] Jawaban: {ctx['answer']}", f"[UMPAN BALIK] {feedback}"
+        )
 
     return {
         "is_correct": is_correct_flag,
-        "feedback": feedback.strip(),
-        "hint_level": hint_level,
-        "is_code": is_code,
+        "feedback": feedback,
+        "hint_level": ctx["hint_level"],
+        "is_code": ctx["is_code"],
         "followup_question": followup_question,
-        "used_rag": used_rag,
-        "session_id": session_id,
+        "used_rag": ctx["used_rag"],
+        "session_id": ctx["session_id"],
+        "from_cache": ctx["from_cache"],
     }
 
+
+async def evaluation_event_stream(ctx: Dict[str, Any]) -> AsyncIterator[str]:
+    """Stream NDJSON untuk /evaluate: token feedback & followup berlabel, lalu event "done"."""
+    events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    task_feedback = asyncio.create_task(
+        pump_ollama_stream(
+            "feedback", ctx["prompt_eval"], events, ctx, field="umpan_balik"
+        )
+    )
+    task_followup = asyncio.create_task(
+        pump_ollama_stream("followup", ctx["followup_prompt"], events, ctx, ctx["answer"], ctx["scope_followup"])
+    )
+
+    yield ndjson_event(
+        "meta",
+        hint_level=ctx["hint_level"],
+        is_code=ctx["is_code"],
+        used_rag=ctx["used_rag"],
+        session_id=ctx["session_id"],
+    )
+    async for line in drain_events(events, [task_feedback, task_followup]):
+        yield line
+
+    try:
+        feedback, followup_question = task_results([task_feedback, task_followup])
+        followup_question = followup_question.strip()
+    except Exception as e:
+        log(f"[EVALUASI] ❌ Generasi gagal: {e!r}")
+        yield ndjson_event("error", message=f"Generasi gagal: {e}")
+        return
+    yield ndjson_event("done", **(await finish_evaluation(ctx, feedback, followup_question)))
+
+
+@app.post("/evaluate")
+async def evaluate_answer(req: EvalRequest):
+    rejected = admission_rejection()
+    if rejected is not None:
+        return rejected
+
+    ctx = await run_in_threadpool(prepare_evaluation, req)
+
+    if req.stream:
+        return StreamingResponse(evaluation_event_stream(ctx), media_type="application/x-ndjson")
+    return await run_evaluation(ctx)
+
+
+async def run_evaluation(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    """Jalankan generasi satu evaluasi (non-streaming) dan simpan hasilnya."""
+    # follow-up tidak bergantung pada feedback, jadi keduanya dikirim bersamaan
+    feedback, followup_question = await asyncio.gather(
+        cached_query_ollama("feedback", ctx["prompt_eval"], ctx),
+        cached_query_ollama("followup", ctx["followup_prompt"], ctx, ctx["answer"], ctx["scope_followup"]),
+    )
+    followup_question = followup_question.strip()
+
+    return await finish_evaluation(ctx, feedback, followup_question)
+
+# batch endpoint (JSONL)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0"))            # job paralel; 0 = kapasitas scheduler
+BATCH_RETRIEVAL_SIZE = int(os.getenv("BATCH_RETRIEVAL_SIZE", "256"))    # query per pass retrieval vektor
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(BASE_DIR, "cache", "batches"))
+BATCH_ID_REGEX = re.compile(r"[\w.-]{1,64}")
+BATCH_GENERATED_FIELDS = {
+    "chat": ("reply_main", "reply_compare", "followup_question"),
+    "evaluate": ("feedback", "followup_question"),
+}
+
+
+def parse_batch_jobs(lines) -> List[Dict[str, Any]]:
+    """
+    Satu job per baris JSON, berbentuk ChatRequest atau EvalRequest plus "id" (opsional,
+    default nomor baris) dan "type" ("chat"/"evaluate", default ditebak dari field).
+    Job tanpa session_id tidak memakai & tidak mengubah riwayat sesi.
+    """
+    jobs: List[Dict[str, Any]] = []
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        job: Dict[str, Any] = {"id": f"line-{line_no}", "type": None, "request": None, "error": None}
+        try:
+            data = json.loads(line)
+            job["id"] = str(data.pop("id", job["id"]))
+            kind = data.pop("type", None) or ("evaluate" if "answer" in data else "chat")
+            if kind not in ("chat", "evaluate"):
+                raise ValueError(f"type tidak dikenal: {kind}")
+            job["type"] = kind
+            job["with_history"] = bool(data.get("session_id"))
+            data["session_id"] = data.get("session_id") or "batch"
+            data["stream"] = False
+            job["request"] = ChatRequest(**data) if kind == "chat" else EvalRequest(**data)
+        except Exception as e:
+            job["error"] = f"baris {line_no} tidak valid: {e}"
+        jobs.append(job)
+    return jobs
+
+
+def load_batch_checkpoint(path: str) -> Dict[str, Dict[str, Any]]:
+    """Hasil job yang sudah sukses dari file checkpoint (JSONL hasil); baris terakhir per id menang."""
+    done: Dict[str, Dict[str, Any]] = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # baris terakhir terpotong saat proses berhenti
+                if result.get("id") is None:
+                    continue
+                if result.get("status") == "ok":
+                    done[str(result["id"])] = result
+                else:
+                    done.pop(str(result["id"]), None)
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def retrieve_batch_contexts(jobs: List[Dict[str, Any]]) -> List[List[Dict]]:
+    """Retrieval untuk banyak job sekaligus: satu batch embedding + satu pencarian matriks."""
+    queries = [
+        job["request"].message if job["type"] == "chat" else evaluation_rag_query(job["request"])
+        for job in jobs
+    ]
+    # batch tidak dikejar latensi: tunggu embedding selesai daripada turun ke BM25 saja
+    return retrieve_relevant_chunks_batch(queries, k=4, embed_timeout=0)
+
+
+async def run_batch_job(job: Dict[str, Any], rag: List[Dict], queue_key: str) -> Dict[str, Any]:
+    req = job["request"]
+    prepare, run = (prepare_chat, run_chat) if job["type"] == "chat" else (prepare_evaluation, run_evaluation)
+    ctx = await run_in_threadpool(prepare, req, rag, job["with_history"])
+    # semua generasi batch prioritas rendah dalam satu jalur round-robin, agar siswa interaktif didahulukan
+    ctx["priority"] = PRIORITY_LOW
+    ctx["queue_key"] = queue_key
+    result = await run(ctx)
+    # satu field saja yang gagal sudah membuat job harus diulang saat batch dilanjutkan
+    failed = [
+        field for field in BATCH_GENERATED_FIELDS[job["type"]]
+        if (result.get(field) or "").lstrip().startswith("[Error")
+    ]
+    if failed:
+        return {
+            "id": job["id"], "type": job["type"], "status": "error",
+            "error": f"generasi gagal: {', '.join(failed)}", "result": result,
+        }
+    return {"id": job["id"], "type": job["type"], "status": "ok", "result": result}
+
+
+async def batch_results(
+    jobs: List[Dict[str, Any]],
+    checkpoint_path: Optional[str] = None,
+    replay_done: bool = True,
+    concurrency: int = 0,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Jalankan job batch dan hasilkan hasilnya sesuai urutan selesai.
+    - Retrieval per jendela BATCH_RETRIEVAL_SIZE job (tervektorisasi), tumpang tindih dengan generasi.
+    - `concurrency` job berjalan bersamaan; job dengan session_id yang sama tetap berurutan.
+    - Setiap hasil ditambahkan ke checkpoint_path; job yang sudah "ok" di sana dilewati saat dijalankan ulang.
+    """
+    started = time.perf_counter()
+    done = load_batch_checkpoint(checkpoint_path) if checkpoint_path else {}
+    pending = [job for job in jobs if job["error"] is None and job["id"] not in done]
+    concurrency = max(1, concurrency or BATCH_CONCURRENCY or generation_scheduler.capacity)
+    counts = {"ok": 0, "error": 0, "skipped": len(jobs) - len(pending) - sum(1 for j in jobs if j["error"])}
+    log(f"[BATCH] 📦 {len(jobs)} job: {len(pending)} dijalankan, {counts['skipped']} sudah selesai, concurrency {concurrency}.")
+
+    checkpoint = None
+    if checkpoint_path:
+        os.makedirs(os.path.dirname(os.path.abspath(checkpoint_path)), exist_ok=True)
+        checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+
+    def record(result: Dict[str, Any]):
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+        if checkpoint is not None:
+            checkpoint.write(json.dumps(result, ensure_ascii=False) + "\n")
+            checkpoint.flush()
+
+    if replay_done:
+        for job in jobs:
+            if job["id"] in done:
+                yield done[job["id"]]
+    for job in jobs:
+        if job["error"] is not None:
+            result = {"id": job["id"], "type": job["type"], "status": "error", "error": job["error"]}
+            record(result)
+            yield result
+
+    if pending and not materials_loaded:
+        await run_in_threadpool(load_materials_and_build_index)
+
+    queue_key = f"batch-{uuid.uuid4().hex[:8]}"
+    work: "asyncio.Queue[Optional[tuple]]" = asyncio.Queue(maxsize=concurrency * 2)
+    results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    session_tail: Dict[str, asyncio.Event] = {}
+
+    async def produce():
+        for start in range(0, len(pending), BATCH_RETRIEVAL_SIZE):
+            window = pending[start:start + BATCH_RETRIEVAL_SIZE]
+            contexts = await run_in_threadpool(retrieve_batch_contexts, window)
+            for job, rag in zip(window, contexts):
+                previous = None
+                finished = asyncio.Event()
+                if job["with_history"]:
+                    previous = session_tail.get(job["request"].session_id)
+                    session_tail[job["request"].session_id] = finished
+                await work.put((job, rag, previous, finished))
+        for _ in range(concurrency):
+            await work.put(None)
+
+    async def worker():
+        while True:
+            item = await work.get()
+            if item is None:
+                return
+            job, rag, previous, finished = item
+            try:
+                if previous is not None:
+                    await previous.wait()  # giliran sebelumnya di sesi yang sama
+                result = await run_batch_job(job, rag, queue_key)
+            except Exception as e:
+                result = {"id": job["id"], "type": job["type"], "status": "error", "error": str(e)}
+            finally:
+                finished.set()
+            await results.put(result)
+
+    producer = asyncio.create_task(produce())
+    tasks = [producer] + [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    async def next_result() -> Dict[str, Any]:
+        """results.get(), tetapi jika produce() gagal (mis. retrieval error) exception-nya dilempar, bukan menggantung."""
+        getter = asyncio.ensure_future(results.get())
+        try:
+            if not producer.done():
+                await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done() and producer.exception() is not None:
+                log(f"[BATCH] ❌ Penyiapan job gagal: {producer.exception()!r}")
+                raise producer.exception()
+            return await getter
+        finally:
+            getter.cancel()
+
+    try:
+        for _ in range(len(pending)):
+            result = await next_result()
+            record(result)
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        if checkpoint is not None:
+            checkpoint.close()
+        log(
+            f"[BATCH] ✅ Selesai dalam {time.perf_counter() - started:.1f} detik: "
+            f"{counts['ok']} ok, {counts['error']} error, {counts['skipped']} dilewati."
+        )
+
+
+@app.post("/batch")
+async def batch_endpoint(request: Request, batch_id: Optional[str] = None, concurrency: int = Query(0, ge=0)):
+    """
+    Batch chat/evaluate: body = JSONL job (bentuk ChatRequest/EvalRequest + "id", "type"),
+    respons = JSONL hasil per job sesuai urutan selesai. Dengan batch_id, progres disimpan
+    di BATCH_DIR/<batch_id>.jsonl; mengirim ulang batch_id yang sama hanya menjalankan job yang belum ok.
+    """
+    checkpoint_path = None
+    if batch_id is not None:
+        if not BATCH_ID_REGEX.fullmatch(batch_id):
+            raise HTTPException(status_code=400, detail="batch_id hanya boleh huruf, angka, '_', '-', '.' (maks. 64)")
+        checkpoint_path = os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+    body = (await request.body()).decode("utf-8")
+    jobs = parse_batch_jobs(body.splitlines())
+
+    async def stream():
+        async for result in batch_results(jobs, checkpoint_path, concurrency=concurrency):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def batch_cli(argv: List[str]):
+    """python ollamaapi.py batch jobs.jsonl -o hasil.jsonl (jalankan ulang perintah yang sama untuk melanjutkan)."""
+    parser = argparse.ArgumentParser(prog="python ollamaapi.py batch", description="Batch chat/evaluate dari file JSONL")
+    parser.add_argument("input", help="file JSONL berisi job")
+    parser.add_argument("-o", "--output", required=True, help="file JSONL hasil, sekaligus checkpoint")
+    parser.add_argument("--concurrency", type=int, default=0, help="job paralel (default kapasitas backend)")
+    args = parser.parse_args(argv)
+    if args.concurrency < 0:
+        parser.error("--concurrency tidak boleh negatif")
+
+    with open(args.input, "r", encoding="utf-8") as f:
+        jobs = parse_batch_jobs(f)
+
+    async def main():
+        await asyncio.gather(discover_ollama(), run_in_threadpool(response_cache.load))
+        await run_in_threadpool(init_langchain_clients)
+        await run_in_threadpool(load_materials_and_build_index)
+        health_task = asyncio.create_task(backend_pool.health_loop())
+        n_done = 0
+        try:
+            async for result in batch_results(jobs, args.output, replay_done=False, concurrency=args.concurrency):
+                n_done += 1
+                print(f"[BATCH] {n_done}/{len(jobs)} {result['id']}: {result['status']}", flush=True)
+        finally:
+            health_task.cancel()
+            await close_ollama_clients()
+
+    asyncio.run(main())
+
 # history endpoint
+def format_conversation_txt(conv: Dict[str, Any]) -> str:
+    lines = [
+        f"[Percakapan {conv['id']}]",
+        f"Pertanyaan: {conv['user_message']}",
+        f"Cognitive utama: {conv['cognitive_main']} (CQ: {conv['cq1_main']}, {conv['cq2_main']})",
+        f"Perbandingan: {conv['cognitive_compare']} (CQ: {conv['cq1_compare']}, {conv['cq2_compare']})",
+        f"Jawaban utama:\n{conv['reply_main']}",
+        f"Jawaban perbandingan:\n{conv['reply_compare']}",
+    ]
+    if conv.get("followup_question"):
+        lines.append(f"Pertanyaan Lanjutan: {conv['followup_question']}")
+    lines.append("-" * 60)
+    return "\n".join(lines) + "\n"
+
+
+def export_history_stream(format: str, **filters: Any):
+    """Generator export penuh; dibaca per batch dari SQLite sehingga tidak ditampung di memori."""
+    if format == "txt":
+        empty = True
+        for conv in conversation_log.iter_all(**filters):
+            empty = False
+            yield format_conversation_txt(conv)
+        if empty:
+            yield "Belum ada percakapan.\n"
+    elif format == "jsonl":
+        for conv in conversation_log.iter_all(**filters):
+            yield json.dumps(conv, ensure_ascii=False) + "\n"
+    else:
+        yield '{"history": ['
+        for i, conv in enumerate(conversation_log.iter_all(**filters)):
+            yield ("," if i else "") + "\n" + json.dumps(conv, ensure_ascii=False)
+        yield "\n]}\n"
+
+
 @app.get("/history")
-def get_history(format: str = "json"):
-    if not conversation_history:
-        if format == "json":
-            return {"history": []}
-        return {"data": "Belum ada percakapan."}
+def get_history(
+    format: str = "json",
+    session_id: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    cursor: int = 0,
+    limit: int = HISTORY_PAGE_SIZE,
+    export: bool = False,
+):
+    """
+    Riwayat percakapan dari log persisten.
+    - Per halaman: ?cursor=<next_cursor>&limit=..., filter session_id dan since/until (unix detik)
+    - export=true: seluruh log (sesuai filter) dikirim sebagai stream (json, jsonl atau txt)
+    """
+    filters = {"session_id": session_id, "since": since, "until": until}
+    if export:
+        media_types = {"txt": "text/plain", "jsonl": "application/x-ndjson"}
+        extension = format if format in media_types else "json"
+        return StreamingResponse(
+            export_history_stream(format, **filters),
+            media_type=media_types.get(format, "application/json") + "; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="history.{extension}"'},
+        )
+
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    rows = conversation_log.page(after_id=cursor, limit=limit, **filters)
+    next_cursor = rows[-1]["id"] if len(rows) == limit else None
 
     if format == "json":
-        return {"history": conversation_history}
-
-    text_data = ""
-    for i, conv in enumerate(conversation_history, start=1):
-        text_data += f"[Percakapan {i}]\n"
-        text_data += f"Pertanyaan: {conv['user_message']}\n"
-        text_data += f"Cognitive utama: {conv['cognitive_main']} (CQ: {conv['cq1_main']}, {conv['cq2_main']})\n"
-        text_data += f"Perbandingan: {conv['cognitive_compare']} (CQ: {conv['cq1_compare']}, {conv['cq2_compare']})\n"
-        text_data += f"Jawaban utama:\n{conv['reply_main']}\n"
-        text_data += f"Jawaban perbandingan:\n{conv['reply_compare']}\n"
-        if conv.get("followup_question"):
-            text_data += f"Pertanyaan Lanjutan: {conv['followup_question']}\n"
-        text_data += "-" * 60 + "\n"
-    return {"data": text_data}
+        return {"history": rows, "next_cursor": next_cursor}
+
+    if not rows:
+        return {"data": "Belum ada percakapan.", "next_cursor": None}
+    return {"data": "".join(format_conversation_txt(conv) for conv in rows), "next_cursor": next_cursor}
 
 # main dev server
 if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch_cli(sys.argv[2:])
+        sys.exit(0)
+
     import uvicorn
 
     print("\n🚀 Menjalankan server di http://127.0.0.1:8000")
@@ -706,4 +4421,9 @@ if __name__ == "__main__":
     print(f"🧠 Model utama: {MODEL_NAME}")
     print(f"📚 Folder materi (RAG): {MATERIALS_DIR}")
     print(f"🧠 Embedding model: {EMBEDDING_MODEL_NAME}")
-    uvicorn.run("ollamaapi:app", host="127.0.0.1", port=8000, reload=True)
+    if WORKERS > 1:
+        # reload tidak bisa digabung dengan beberapa worker
+        print(f"👥 Worker: {WORKERS} (index mmap & sesi SQLite dibagi)")
+        uvicorn.run("ollamaapi:app", host="127.0.0.1", port=8000, workers=WORKERS)
+    else:
+        uvicorn.run("ollamaapi:app", host="127.0.0.1", port=8000, reload=True)
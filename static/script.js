@@ -114,6 +114,55 @@ document.addEventListener("DOMContentLoaded", () => {
     return `(usia ${age}) ${msg}`;
   };
 
+  // Baca respons NDJSON baris demi baris dan panggil onEvent untuk tiap event
+  const readNdjsonStream = async (res, onEvent) => {
+    if (res.status === 429) {
+      const data = await res.json().catch(() => ({}));
+      throw new Error(
+        `Server sedang sibuk (antrean ke-${data.queue_position ?? "?"}), ` +
+          `coba lagi dalam ${data.retry_after ?? res.headers.get("Retry-After") ?? "beberapa"} detik.`
+      );
+    }
+    if (!res.ok || !res.body) {
+      throw new Error(`HTTP ${res.status}`);
+    }
+    // Event "error" dikirim server jika generasi gagal setelah stream dimulai
+    const dispatch = (event) => {
+      if (event.event === "error") {
+        throw new Error(event.message || "Generasi gagal");
+      }
+      onEvent(event);
+    };
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+      let newline;
+      while ((newline = buffer.indexOf("\n")) >= 0) {
+        const line = buffer.slice(0, newline).trim();
+        buffer = buffer.slice(newline + 1);
+        if (line) dispatch(JSON.parse(line));
+      }
+      if (done) break;
+    }
+    if (buffer.trim()) dispatch(JSON.parse(buffer));
+  };
+
+  // Render ulang paling banyak sekali per frame agar token cepat tidak membuat UI tersendat
+  const scheduleRender = (fn) => {
+    let pending = false;
+    return () => {
+      if (pending) return;
+      pending = true;
+      requestAnimationFrame(() => {
+        pending = false;
+        fn();
+      });
+    };
+  };
+
   const renderFollowupQuestion = (followup) => {
     if (!followupSection || !followupText || !followupStage) return;
     if (!followup || !followup.text) {
@@ -162,40 +211,68 @@ document.addEventListener("DOMContentLoaded", () => {
           cq1,
           cq2,
           mode,
+          stream: true, // token dikirim bertahap (NDJSON)
           // session_id bisa ditambah kalau mau multi-user
         }),
       });
 
-      const data = await res.json();
+      // Bubble dibuat saat event "meta" tiba, lalu diisi token demi token
+      let mainBubble = null;
+      let compareBubble = null;
+      let mainHeader = "";
+      let compareHeader = "";
+      let ragInfo = "";
+      const texts = { main: "", compare: "", followup: "" };
+
+      const renderMain = () => {
+        if (!mainBubble) return;
+        mainBubble.innerHTML =
+          `<div class="rag-meta">${escapeHtml(ragInfo)}</div>` +
+          `<b>${escapeHtml(mainHeader)}:</b><br>${renderMarkdown(texts.main)}`;
+      };
+      const renderCompare = () => {
+        if (!compareBubble) return;
+        compareBubble.innerHTML =
+          `<b>${escapeHtml(compareHeader)}:</b><br>${renderMarkdown(texts.compare)}`;
+      };
+      const render = {
+        main: scheduleRender(renderMain),
+        compare: scheduleRender(renderCompare),
+        followup: scheduleRender(() =>
+          renderFollowupQuestion({ text: texts.followup })
+        ),
+      };
+
+      await readNdjsonStream(res, (event) => {
+        if (event.event === "meta") {
+          if (loading) loading.remove();
+          // Backend kognitif mengirim:
+          // cognitive_main, cq1_main, cq2_main, cognitive_compare, cq1_compare, cq2_compare
+          mainHeader = `GPT-OSS (${event.cognitive_main} | CQ: ${event.cq1_main}, ${event.cq2_main})`;
+          compareHeader = `Perbandingan (${event.cognitive_compare} | CQ: ${event.cq1_compare}, ${event.cq2_compare})`;
+          ragInfo = event.used_rag
+            ? "RAG aktif (konteks materi digunakan)"
+            : "RAG tidak digunakan (jawaban dari pengetahuan model)";
+          mainBubble = appendBubble("bot", "");
+          compareBubble = appendBubble("compare", "");
+          renderMain();
+          renderCompare();
+        } else if (event.event === "token" && event.label in texts) {
+          texts[event.label] += event.text || "";
+          render[event.label]();
+        } else if (event.event === "done") {
+          texts.main = event.reply_main || texts.main;
+          texts.compare = event.reply_compare || texts.compare;
+          texts.followup = event.followup_question || texts.followup;
+          renderMain();
+          renderCompare();
+          renderFollowupQuestion({ text: texts.followup });
+        }
+      });
       if (loading) loading.remove();
 
-      // Backend kognitif mengirim:
-      // cognitive_main, cq1_main, cq2_main, cognitive_compare, cq1_compare, cq2_compare
-      const mainHeader = `GPT-OSS (${data.cognitive_main} | CQ: ${data.cq1_main}, ${data.cq2_main})`;
-      const compareHeader = `Perbandingan (${data.cognitive_compare} | CQ: ${data.cq1_compare}, ${data.cq2_compare})`;
-      const ragInfo = data.use_rag
-        ? `RAG ${data.rag_mode || "simple"}`
-        : "RAG tidak digunakan (jawaban dari pengetahuan model)";
-
-      appendBubble(
-        "bot",
-        `<div class ="rag-meta">${escapeHtml(ragInfo)}</div>`
-        `<b>${escapeHtml(mainHeader)}:</b><br>${renderMarkdown(
-          data.reply_main || ""
-        )}`
-      );
-
-      appendBubble(
-        "compare",
-        `<b>${escapeHtml(compareHeader)}:</b><br>${renderMarkdown(
-          data.reply_compare || ""
-        )}`
-      );
-
-      renderFollowupQuestion({ text: data.followup_question || "" });
-
       // simpan sebagai "jawaban referensi" untuk /evaluate
-      correctAnswer = data.reply_main || "";
+      correctAnswer = texts.main;
       if (answerSection) answerSection.style.display = "block";
       if (historySection) historySection.style.display = "block";
     } catch (err) {
@@ -247,35 +324,55 @@ document.addEventListener("DOMContentLoaded", () => {
           answer,
           correct_answer: correctAnswer,
           wrong_count: wrongAttempts,
+          stream: true,
           // session_id kalau mau dihubungkan ke user tertentu
         }),
       });
 
-      const data = await res.json();
-      if (!data.is_correct) wrongAttempts += 1;
-
-      const statusText = data.is_correct
-        ? "✅ Jawabanmu dianggap BENAR oleh sistem."
-        : "❌ Jawabanmu BELUM tepat.";
-
-      evalResult.classList.remove("correct", "incorrect");
-      if (data.is_correct) {
-        evalResult.classList.add("correct");
-        if (historyButtons) historyButtons.style.display = "block";
-      } else {
-        evalResult.classList.add("incorrect");
-      }
-
-      evalResult.innerHTML = `
-        <p><b>${escapeHtml(statusText)}</b></p>
-        <p><b>Feedback:</b><br>${renderMarkdown(data.feedback || "")}</p>
-        <p><b>Tahap Bantuan:</b> ${escapeHtml(
-          data.hint_level || "Evaluasi awal"
-        )}</p>
-        <p><b>Pertanyaan Lanjutan:</b><br>${escapeHtml(
-          data.followup_question || "-"
-        )}</p>
-      `;
+      const texts = { feedback: "", followup: "" };
+      let hintLevel = "Evaluasi awal";
+      let statusText = "⏳ Sedang menilai...";
+
+      const renderEval = () => {
+        evalResult.innerHTML = `
+          <p><b>${escapeHtml(statusText)}</b></p>
+          <p><b>Feedback:</b><br>${renderMarkdown(texts.feedback)}</p>
+          <p><b>Tahap Bantuan:</b> ${escapeHtml(hintLevel)}</p>
+          <p><b>Pertanyaan Lanjutan:</b><br>${escapeHtml(
+            texts.followup || "-"
+          )}</p>
+        `;
+      };
+      const renderLater = scheduleRender(renderEval);
+
+      await readNdjsonStream(res, (event) => {
+        if (event.event === "meta") {
+          hintLevel = event.hint_level || hintLevel;
+          renderEval();
+        } else if (event.event === "token" && event.label in texts) {
+          texts[event.label] += event.text || "";
+          renderLater();
+        } else if (event.event === "done") {
+          if (!event.is_correct) wrongAttempts += 1;
+
+          statusText = event.is_correct
+            ? "✅ Jawabanmu dianggap BENAR oleh sistem."
+            : "❌ Jawabanmu BELUM tepat.";
+
+          evalResult.classList.remove("correct", "incorrect");
+          if (event.is_correct) {
+            evalResult.classList.add("correct");
+            if (historyButtons) historyButtons.style.display = "block";
+          } else {
+            evalResult.classList.add("incorrect");
+          }
+
+          texts.feedback = event.feedback || texts.feedback;
+          texts.followup = event.followup_question || texts.followup;
+          hintLevel = event.hint_level || hintLevel;
+          renderEval();
+        }
+      });
     } catch (err) {
       evalResult.classList.remove("correct", "incorrect");
       evalResult.textContent = `❌ Gagal evaluasi: ${String(err)}`;
@@ -303,9 +400,8 @@ document.addEventListener("DOMContentLoaded", () => {
   if (downloadTxt) {
     downloadTxt.addEventListener("click", async () => {
       try {
-        const res = await fetch("/history?format=txt");
-        const data = await res.json();
-        const blob = new Blob([data.data || ""], { type: "text/plain" });
+        const res = await fetch("/history?format=txt&export=true");
+        const blob = await res.blob();
         triggerDownload(blob, "history.txt");
       } catch (err) {
         appendBubble(
@@ -319,11 +415,8 @@ document.addEventListener("DOMContentLoaded", () => {
   if (downloadJson) {
     downloadJson.addEventListener("click", async () => {
       try {
-        const res = await fetch("/history?format=json");
-        const data = await res.json();
-        const blob = new Blob([JSON.stringify(data, null, 2)], {
-          type: "application/json",
-        });
+        const res = await fetch("/history?format=json&export=true");
+        const blob = await res.blob();
         triggerDownload(blob, "history.json");
       } catch (err) {
         appendBubble(
@@ -0,0 +1,113 @@
+#  CSIPBLLM — FIXTURE BERSAMA UNTUK TEST
+#
+#  Aplikasi di-import dengan semua path data di direktori sementara, lalu diuji
+#  terhadap bench/fake_ollama.py (create_app) yang dijalankan di thread terpisah.
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "bench"))
+
+# harus diset sebelum ollamaapi di-import: path & konfigurasi dibaca saat import
+_WORK_DIR = tempfile.mkdtemp(prefix="csipb-test-")
+os.environ.update(
+    {
+        "MATERIALS_DIR": os.path.join(_WORK_DIR, "materials"),
+        "INDEX_DIR": os.path.join(_WORK_DIR, "materials_index"),
+        "RESPONSE_CACHE_PATH": os.path.join(_WORK_DIR, "cache", "responses.jsonl"),
+        "SESSION_DB_PATH": os.path.join(_WORK_DIR, "cache", "sessions.sqlite3"),
+        "CONVERSATION_DB_PATH": os.path.join(_WORK_DIR, "cache", "conversations.sqlite3"),
+        "BATCH_DIR": os.path.join(_WORK_DIR, "cache", "batches"),
+        "OLLAMA_BACKENDS": "http://127.0.0.1:9",
+        "OLLAMA_PREWARM": "0",
+    }
+)
+
+import uvicorn
+
+import ollamaapi
+from fake_ollama import create_app
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class FakeOllamaServer:
+    """Satu fake Ollama (uvicorn) di thread background; stats = dict statistik milik create_app."""
+
+    def __init__(self, **options):
+        self.app = create_app(**options)
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self) -> "FakeOllamaServer":
+        self.thread.start()
+        deadline = time.time() + 10
+        while not self.server.started:
+            if time.time() > deadline:
+                raise RuntimeError("fake Ollama tidak start")
+            time.sleep(0.01)
+        return self
+
+    @property
+    def stats(self):
+        return self.app.state.stats
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+@pytest.fixture
+def fake_ollama():
+    """Pabrik fake Ollama: fake_ollama(latency=0.1, ...) -> FakeOllamaServer yang sudah berjalan."""
+    servers = []
+
+    def start(**options):
+        options.setdefault("latency", 0.05)
+        server = FakeOllamaServer(**options).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    """Ganti pool backend & scheduler global dengan yang menunjuk ke URL tertentu."""
+
+    def use(*urls, capacity=None, max_queue=0):
+        pool = ollamaapi.OllamaBackendPool(list(urls))
+        scheduler = ollamaapi.GenerationScheduler(capacity or ollamaapi.OLLAMA_MAX_CONCURRENCY * len(urls), max_queue)
+        monkeypatch.setattr(ollamaapi, "backend_pool", pool)
+        monkeypatch.setattr(ollamaapi, "generation_scheduler", scheduler)
+        return pool
+
+    return use
+
+
+@pytest.fixture(autouse=True)
+def fresh_generation_state(monkeypatch):
+    """Statistik coalescing & response cache bersih per test (cache nonaktif kecuali diaktifkan test)."""
+    monkeypatch.setattr(ollamaapi, "coalescing_stats", {k: 0 for k in ollamaapi.coalescing_stats})
+    monkeypatch.setattr(ollamaapi, "inflight_generations", {})
+    monkeypatch.setattr(ollamaapi, "inflight_streams", {})
+    monkeypatch.setattr(
+        ollamaapi, "response_cache",
+        ollamaapi.ResponseCache(os.path.join(_WORK_DIR, "cache", "unused.jsonl"), 0, 0, 0),
+    )
@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import ollamaapi
+from conftest import free_port
+from ollamaapi import OLLAMA_CB_FAILURES, OllamaBackend, OllamaBackendPool
+
+
+def dead_url() -> str:
+    return f"http://127.0.0.1:{free_port()}"   # port bebas: tidak ada yang mendengarkan
+
+
+def test_pick_prefers_least_outstanding_backend():
+    pool = OllamaBackendPool(["http://a", "http://b", "http://c"])
+    a, b, c = pool.backends
+    a.active, b.active, c.queued = 2, 1, 3
+    assert pool.pick() is b
+    b.queued = 2
+    assert pool.pick() is a
+    # backend yang baru gagal disisihkan walau antreannya kosong
+    a.active, b.queued, c.queued = 0, 0, 0
+    a.consecutive_failures = 1
+    assert pool.pick() in (b, c)
+    assert pool.pick(exclude={"http://b"}) is c
+
+
+def test_concurrent_generations_are_spread_over_both_backends(fake_ollama, backends):
+    first, second = fake_ollama(latency=0.2), fake_ollama(latency=0.2)
+    pool = backends(first.url, second.url)
+
+    async def main():
+        return await asyncio.gather(*(ollamaapi.query_ollama(f"prompt {i}") for i in range(8)))
+
+    replies = asyncio.run(main())
+    assert all(reply.startswith("Jawaban fake") for reply in replies)
+    assert first.stats["generate"] == 4 and second.stats["generate"] == 4
+    assert all(b.outstanding == 0 and b.consecutive_failures == 0 for b in pool.backends)
+
+
+def test_circuit_opens_half_opens_and_closes():
+    backend = OllamaBackend("http://a")
+    for _ in range(OLLAMA_CB_FAILURES - 1):
+        backend.record_failure()
+    assert backend.circuit_state() == "closed" and backend.available()
+
+    backend.record_failure()
+    assert backend.circuit_state() == "open" and not backend.available()
+
+    backend.circuit_open_until = time.monotonic() - 1   # waktu reset lewat
+    assert backend.circuit_state() == "half-open" and backend.available()
+
+    backend.record_failure()   # percobaan half-open gagal: terbuka lagi
+    assert backend.circuit_state() == "open"
+
+    backend.circuit_open_until = time.monotonic() - 1
+    backend.record_success(0.1)
+    assert backend.circuit_state() == "closed" and backend.consecutive_failures == 0
+
+
+def test_open_circuit_is_skipped_by_pick():
+    pool = OllamaBackendPool(["http://a", "http://b"])
+    a, b = pool.backends
+    b.active = 5
+    for _ in range(OLLAMA_CB_FAILURES):
+        a.record_failure()
+    assert pool.pick() is b
+
+
+def test_failover_to_healthy_backend(fake_ollama, backends):
+    healthy = fake_ollama(latency=0.05)
+    pool = backends(dead_url(), healthy.url)
+    dead = pool.backends[0]
+    dead.latency_ewma, pool.backends[1].latency_ewma = 0.0, 1.0   # backend mati dipilih duluan
+
+    async def main():
+        replies = [await ollamaapi.query_ollama(f"prompt {i}", delay=0) for i in range(3)]
+        stream = "".join([piece async for piece in ollamaapi.stream_ollama("prompt stream")])
+        return replies, stream
+
+    replies, stream = asyncio.run(main())
+    assert all(reply.startswith("Jawaban fake") for reply in replies)
+    assert stream.startswith("Jawaban fake")
+    assert dead.failures_total == 1   # setelah gagal, trafik diarahkan ke backend sehat
+    assert healthy.stats["generate"] == len(replies) + 1
+
+
+def test_repeated_failures_open_the_circuit_and_success_closes_it(fake_ollama, backends):
+    dead = backends(dead_url()).backends[0]
+    reply = asyncio.run(ollamaapi.query_ollama("prompt", retries=OLLAMA_CB_FAILURES, delay=0))
+    assert reply.startswith("[Error Ollama API]")
+    assert dead.circuit_state() == "open"
+
+    # backend yang pulih: setelah waktu reset lewat, satu percobaan (half-open) menutup circuit
+    server = fake_ollama()
+    backend = backends(server.url).backends[0]
+    backend.consecutive_failures = OLLAMA_CB_FAILURES
+    backend.circuit_open_until = time.monotonic() - 1
+    assert backend.circuit_state() == "half-open"
+    assert asyncio.run(ollamaapi.query_ollama("prompt lain")).startswith("Jawaban fake")
+    assert backend.circuit_state() == "closed"
+
+
+def test_health_check_marks_backends(fake_ollama, backends):
+    healthy = fake_ollama()
+    pool = backends(dead_url(), healthy.url)
+    dead, alive = pool.backends
+    dead.active, alive.active = 0, 3
+
+    async def main():
+        await asyncio.gather(*(pool.check_health(b) for b in pool.backends))
+
+    asyncio.run(main())
+    assert dead.healthy is False and alive.healthy is True
+    assert pool.pick() is alive   # tidak sehat dilewati walau antreannya lebih pendek
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import ollamaapi
+from ollamaapi import batch_results, parse_batch_jobs
+
+
+async def collect(jobs, **options):
+    return [result async for result in batch_results(jobs, **options)]
+
+
+@pytest.fixture
+def no_materials(monkeypatch):
+    monkeypatch.setattr(ollamaapi, "materials_loaded", True)
+    monkeypatch.setattr(ollamaapi, "retrieve_batch_contexts", lambda jobs: [[] for _ in jobs])
+
+
+def test_retrieval_failure_is_raised_instead_of_hanging(no_materials, monkeypatch):
+    def broken(jobs):
+        raise RuntimeError("index rusak")
+
+    monkeypatch.setattr(ollamaapi, "retrieve_batch_contexts", broken)
+    jobs = parse_batch_jobs(['{"message": "halo"}', '{"message": "apa itu list?"}'])
+    with pytest.raises(RuntimeError, match="index rusak"):
+        asyncio.run(asyncio.wait_for(collect(jobs), timeout=5))
+
+
+def test_job_is_error_when_any_generated_field_failed(no_materials, monkeypatch, tmp_path):
+    replies = {
+        "halo": ("Jawaban", "[Error Ollama API] Timeout.", "Lanjut?"),
+        "apa itu list?": ("Jawaban", "Perbandingan", "[Error Ollama API] Gagal menghubungi Ollama."),
+        "apa itu dict?": ("Jawaban", "Perbandingan", "Lanjut?"),
+    }
+
+    async def run_chat(ctx):
+        reply_main, reply_compare, followup_question = replies[ctx["message"]]
+        return {"reply_main": reply_main, "reply_compare": reply_compare, "followup_question": followup_question}
+
+    monkeypatch.setattr(ollamaapi, "prepare_chat", lambda req, rag, with_history: {"message": req.message})
+    monkeypatch.setattr(ollamaapi, "run_chat", run_chat)
+    jobs = parse_batch_jobs(f'{{"id": "{i}", "message": "{m}"}}' for i, m in enumerate(replies))
+    checkpoint = str(tmp_path / "hasil.jsonl")
+
+    results = {r["id"]: r for r in asyncio.run(collect(jobs, checkpoint_path=checkpoint))}
+    assert results["0"]["status"] == "error" and "reply_compare" in results["0"]["error"]
+    assert results["1"]["status"] == "error" and "followup_question" in results["1"]["error"]
+    assert results["2"]["status"] == "ok"
+    # job yang gagal diulang saat batch dilanjutkan
+    assert set(ollamaapi.load_batch_checkpoint(checkpoint)) == {"2"}
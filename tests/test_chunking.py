@@ -0,0 +1,39 @@
+import numpy as np
+
+from ollamaapi import RAG_CHUNK_TOKENS, MaterialStore, chunk_material_text, count_tokens, rag_prompt_section
+
+
+def test_oversized_word_is_split_to_the_chunk_budget():
+    blob = "aGVsbG8" * 300   # base64 panjang tanpa spasi (~525 token)
+    chunks = chunk_material_text(f"# Data\nIsi file:\n{blob}\nSelesai.", "data.md", "data.md")
+    assert all(count_tokens(ch["text"]) <= RAG_CHUNK_TOKENS for ch in chunks)
+    assert blob in "".join(ch["text"].split("\n", 1)[1].replace(" ", "") for ch in chunks)
+
+
+def test_oversized_code_line_is_split_inside_its_fence():
+    line = "x=" + "+".join(["1"] * 400)   # kode minified: satu baris ~800 token
+    chunks = chunk_material_text(f"```python\n{line}\n```", "kode.md", "kode.md")
+    assert len(chunks) > 1
+    for ch in chunks:
+        assert count_tokens(ch["text"]) <= RAG_CHUNK_TOKENS
+        assert ch["text"].startswith("```python\n") and ch["text"].endswith("\n```")
+
+
+def test_chunk_header_survives_the_store():
+    chunks = chunk_material_text("# List\nList menyimpan nilai.\n\nTanpa heading? Tidak.", "list.md", "list.md")
+    store = MaterialStore.from_items([{"embedding": np.ones(4), **ch} for ch in chunks])
+    assert store.header(0) == "List" and store[0]["text"].startswith("List\n")
+    plain = MaterialStore.from_items([{"embedding": np.ones(4), **ch} for ch in chunk_material_text("a\nb", "x.md", "x.md")])
+    assert plain.header(0) == ""
+
+
+def test_rag_dedup_strips_only_the_heading():
+    section = rag_prompt_section([
+        {"text": "Bab 1\nIsi yang sama.", "header": "Bab 1", "source": "a.md"},
+        {"text": "Bab 2\nIsi yang sama.", "header": "Bab 2", "source": "b.md"},
+        # tanpa heading: baris pertama adalah isi, bukan heading
+        {"text": "Baris pertama A\nBaris kedua.", "header": "", "source": "c.md"},
+        {"text": "Baris pertama B\nBaris kedua.", "header": "", "source": "d.md"},
+    ])
+    sources = [item.split("\n", 1)[0] for item in section["items"]]
+    assert sources == ["[Sumber 1 - a.md]", "[Sumber 2 - c.md]", "[Sumber 3 - d.md]"]
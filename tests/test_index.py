@@ -0,0 +1,110 @@
+import os
+import shutil
+import zlib
+
+import numpy as np
+import pytest
+
+import ollamaapi
+
+
+class FakeEmbeddings:
+    """Embedding deterministik kecil; menghitung berapa teks yang di-embed."""
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_query(self, text):
+        rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+        return rng.standard_normal(8).tolist()
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [self.embed_query(text) for text in texts]
+
+
+@pytest.fixture
+def index_dirs(tmp_path, monkeypatch):
+    materials, index = tmp_path / "materials", tmp_path / "materials_index"
+    materials.mkdir()
+    (materials / "list.md").write_text("# List\nList menyimpan banyak nilai berurutan.", encoding="utf-8")
+    (materials / "dict.md").write_text("# Dict\nDict memetakan kunci ke nilai.", encoding="utf-8")
+    for name, value in {
+        "MATERIALS_DIR": str(materials),
+        "INDEX_DIR": str(index),
+        "MANIFEST_PATH": str(index / "manifest.json"),
+        "INDEX_LOCK_PATH": str(index / ".lock"),
+        "FAISS_INDEX_PATH": str(index / "faiss.index"),
+        "FAISS_META_PATH": str(index / "faiss_meta.json"),
+        "materials_index": ollamaapi.MaterialStore.empty(),
+        "index_generation": None,
+        "bm25_index": None,
+        "faiss_index": None,
+        "embeddings_model": FakeEmbeddings(),
+    }.items():
+        monkeypatch.setattr(ollamaapi, name, value)
+    return materials, index
+
+
+def generation_dirs(index):
+    return sorted(name for name in os.listdir(index) if name.startswith("gen-"))
+
+
+def test_each_save_writes_a_new_generation_and_removes_the_old(index_dirs):
+    materials, index = index_dirs
+    ollamaapi.sync_materials_index()
+    first = generation_dirs(index)
+    assert first == [f"gen-{ollamaapi.index_generation}"]
+    assert ollamaapi.bm25_index.store is ollamaapi.materials_index
+
+    (materials / "dict.md").write_text("# Dict\nDict memetakan kunci unik ke nilai.", encoding="utf-8")
+    ollamaapi.sync_materials_index()
+    second = generation_dirs(index)
+    assert second == [f"gen-{ollamaapi.index_generation}"] and second != first
+    # store & BM25 yang dipakai di-mmap dari generasi baru
+    assert os.path.dirname(ollamaapi.materials_index.vectors.filename) == str(index / second[0])
+    assert ollamaapi.bm25_index.store is ollamaapi.materials_index
+    assert len(ollamaapi.materials_index) == 2
+
+
+def test_generation_still_in_use_is_removed_later(index_dirs, monkeypatch):
+    materials, index = index_dirs
+    ollamaapi.sync_materials_index()
+    first = generation_dirs(index)
+
+    def locked(path):
+        raise PermissionError(f"file dipakai proses lain: {path}")
+
+    # seperti Windows: file yang masih di-mmap tidak bisa dihapus, sinkronisasi tetap berhasil
+    with monkeypatch.context() as patch:
+        patch.setattr(shutil, "rmtree", locked)
+        (materials / "list.md").write_text("# List\nList bisa diubah.", encoding="utf-8")
+        ollamaapi.sync_materials_index()
+    assert len(generation_dirs(index)) == 2
+    assert ollamaapi.load_manifest()["generation"] == ollamaapi.index_generation
+
+    os.utime(materials / "list.md", (1, 1))   # hanya mtime berubah: disimpan ulang tanpa embed
+    embedded = ollamaapi.embeddings_model.embedded
+    ollamaapi.sync_materials_index()
+    assert generation_dirs(index) == [f"gen-{ollamaapi.index_generation}"]
+    assert first[0] not in generation_dirs(index)
+    assert ollamaapi.embeddings_model.embedded == embedded
+
+
+def test_legacy_layout_is_migrated_without_reembedding(index_dirs, monkeypatch):
+    _, index = index_dirs
+    ollamaapi.sync_materials_index()
+    generation = ollamaapi.index_generation
+    for name in os.listdir(index / f"gen-{generation}"):
+        shutil.move(str(index / f"gen-{generation}" / name), str(index / name))
+    os.rmdir(index / f"gen-{generation}")
+
+    # proses baru: index lama (langsung di INDEX_DIR) dimuat lalu dipindah ke direktori generasi
+    monkeypatch.setattr(ollamaapi, "index_generation", None)
+    monkeypatch.setattr(ollamaapi, "materials_index", ollamaapi.MaterialStore.empty())
+    embedded = ollamaapi.embeddings_model.embedded
+    ollamaapi.sync_materials_index()
+    assert ollamaapi.embeddings_model.embedded == embedded
+    assert generation_dirs(index) == [f"gen-{ollamaapi.index_generation}"]
+    assert not any(os.path.exists(index / name) for name in ollamaapi.LEGACY_INDEX_FILES)
+    assert len(ollamaapi.materials_index) == 2
@@ -0,0 +1,60 @@
+import json
+
+from ollamaapi import JsonFieldStream, parse_evaluation_output
+
+
+def feed_all(pieces, field="umpan_balik"):
+    view = JsonFieldStream(field)
+    return "".join(view.feed(piece) for piece in pieces)
+
+
+def test_json_field_is_streamed_with_escapes():
+    raw = json.dumps({"umpan_balik": 'baris "satu"\nbaris\tdua \\ / é', "benar": True})
+    assert feed_all([raw]) == 'baris "satu"\nbaris\tdua \\ / é'
+    # dipotong per karakter: escape yang terpotong menunggu potongan berikutnya
+    assert feed_all(list(raw)) == 'baris "satu"\nbaris\tdua \\ / é'
+
+
+def test_json_field_handles_unicode_escapes_and_surrogate_pairs():
+    raw = json.dumps({"umpan_balik": "bagus 😀 café"}, ensure_ascii=True)
+    assert "\\ud83d\\ude00" in raw
+    assert feed_all([raw]) == "bagus 😀 café"
+    for cut in range(len(raw)):
+        assert feed_all([raw[:cut], raw[cut:]]) == "bagus 😀 café"
+
+
+def test_json_field_replaces_lone_surrogates():
+    assert feed_all(['{"umpan_balik": "a\\ud83d b"}']) == "a� b"
+
+
+def test_json_field_stops_at_closing_quote():
+    view = JsonFieldStream("umpan_balik")
+    assert view.feed('{"umpan_balik": "selesai", ') == "selesai"
+    assert view.feed('"benar": false}') == ""
+    assert view.done
+
+
+def test_non_json_output_is_passed_through():
+    view = JsonFieldStream("umpan_balik")
+    assert view.feed("  [Error Ollama API] ") == "  [Error Ollama API] "
+    assert view.feed("Timeout.") == "Timeout."
+    assert view.plain
+
+
+def test_parse_evaluation_output_reads_the_verdict():
+    raw = json.dumps({"umpan_balik": " Sudah tepat. ", "benar": True})
+    assert parse_evaluation_output(raw) == (True, "Sudah tepat.")
+    assert parse_evaluation_output(f"Berikut hasilnya:\n{raw}\nSelesai.") == (True, "Sudah tepat.")
+
+
+def test_parse_evaluation_output_fallbacks():
+    # bukan JSON: teks utuh menjadi umpan balik, verdict tidak diketahui
+    assert parse_evaluation_output("  Jawabanmu benar!  ") == (None, "Jawabanmu benar!")
+    # JSON rusak
+    assert parse_evaluation_output('{"umpan_balik": "x", "benar": tru') == (None, '{"umpan_balik": "x", "benar": tru')
+    # field umpan_balik hilang
+    assert parse_evaluation_output('{"benar": true}') == (None, '{"benar": true}')
+    # verdict bukan boolean
+    assert parse_evaluation_output('{"umpan_balik": "x", "benar": "ya"}') == (None, "x")
+    assert parse_evaluation_output("") == (None, "")
+    assert parse_evaluation_output(None) == (None, "")
@@ -0,0 +1,175 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import ollamaapi
+from ollamaapi import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, GenerationScheduler, SchedulerQueueFull
+
+
+async def acquire_order(scheduler: GenerationScheduler, requests):
+    """Pegang satu-satunya slot, antrekan requests (priority, session), lalu catat urutan dilayani."""
+    order = []
+    holder = asyncio.Event()
+    release = asyncio.Event()
+
+    async def hold():
+        async with scheduler.slot():
+            holder.set()
+            await release.wait()
+
+    async def wait_turn(name, priority, session_id):
+        async with scheduler.slot(priority, session_id):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    first = asyncio.create_task(hold())
+    await holder.wait()
+    waiters = []
+    for name, priority, session_id in requests:
+        waiters.append(asyncio.create_task(wait_turn(name, priority, session_id)))
+        await asyncio.sleep(0)
+    assert scheduler.waiting == len(requests)
+    release.set()
+    await asyncio.gather(first, *waiters)
+    return order
+
+
+def test_higher_priority_is_served_first():
+    scheduler = GenerationScheduler(capacity=1, max_queue=0)
+    order = asyncio.run(
+        acquire_order(
+            scheduler,
+            [("low", PRIORITY_LOW, "a"), ("normal", PRIORITY_NORMAL, "b"), ("high", PRIORITY_HIGH, "c")],
+        )
+    )
+    assert order == ["high", "normal", "low"]
+    assert scheduler.active == 0 and scheduler.waiting == 0
+
+
+def test_sessions_take_turns_within_a_priority():
+    scheduler = GenerationScheduler(capacity=1, max_queue=0)
+    order = asyncio.run(
+        acquire_order(
+            scheduler,
+            [("a1", PRIORITY_NORMAL, "a"), ("a2", PRIORITY_NORMAL, "a"), ("a3", PRIORITY_NORMAL, "a"),
+             ("b1", PRIORITY_NORMAL, "b"), ("c1", PRIORITY_NORMAL, "c")],
+        )
+    )
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+
+
+def test_queue_limit_rejects_with_retry_after(monkeypatch):
+    scheduler = GenerationScheduler(capacity=1, max_queue=1)
+    scheduler.waiting = 1   # antrean sudah penuh
+    monkeypatch.setattr(ollamaapi, "generation_scheduler", scheduler)
+
+    try:
+        scheduler.check_admission()
+    except SchedulerQueueFull as e:
+        assert e.position == 2 and e.retry_after >= 1
+    else:
+        raise AssertionError("admission seharusnya ditolak")
+
+    r = TestClient(ollamaapi.app).post("/chat", json={"message": "halo"})
+    assert r.status_code == 429
+    assert int(r.headers["Retry-After"]) >= 1
+    assert r.json()["queue_position"] == 2
+    assert scheduler.rejected == 2
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        scheduler = GenerationScheduler(capacity=1, max_queue=0)
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot():
+                await release.wait()
+
+        async def wait():
+            async with scheduler.slot():
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(wait())
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.waiting == 0
+        release.set()
+        await holder
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_holder_releases_its_slot():
+    async def main():
+        scheduler = GenerationScheduler(capacity=1, max_queue=0)
+
+        async def hold():
+            async with scheduler.slot():
+                await asyncio.sleep(60)
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        assert scheduler.active == 1
+        holder.cancel()
+        await asyncio.gather(holder, return_exceptions=True)
+        assert scheduler.active == 0
+        async with scheduler.slot() as waited:
+            assert waited < 1
+
+    asyncio.run(main())
+
+
+def test_client_disconnect_releases_stream_slot(fake_ollama, backends):
+    server = fake_ollama(latency=0.05, token_rate=20, tokens=200)
+    backends(server.url)
+
+    async def main():
+        stream = ollamaapi.stream_ollama("prompt panjang")
+        assert await stream.__anext__()
+        assert ollamaapi.generation_scheduler.active == 1
+        await stream.aclose()   # klien memutus stream
+        for _ in range(100):
+            if ollamaapi.generation_scheduler.active == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert ollamaapi.generation_scheduler.active == 0
+        assert not ollamaapi.inflight_streams
+
+    asyncio.run(main())
+
+
+def test_identical_generations_are_coalesced(fake_ollama, backends):
+    server = fake_ollama(latency=0.2)
+    backends(server.url)
+
+    async def main():
+        return await asyncio.gather(*(ollamaapi.query_ollama("prompt sama") for _ in range(3)))
+
+    replies = asyncio.run(main())
+    assert len(set(replies)) == 1 and replies[0].startswith("Jawaban fake")
+    assert ollamaapi.coalescing_stats["generations"] == 1
+    assert ollamaapi.coalescing_stats["joined"] == 2
+    assert server.stats["generate"] == 1
+
+
+def test_identical_streams_share_one_upstream(fake_ollama, backends):
+    server = fake_ollama(latency=0.2)
+    backends(server.url)
+
+    async def collect():
+        return "".join([piece async for piece in ollamaapi.stream_ollama("prompt stream")])
+
+    async def main():
+        return await asyncio.gather(collect(), collect())
+
+    first, second = asyncio.run(main())
+    assert first == second and first.startswith("Jawaban fake")
+    assert ollamaapi.coalescing_stats["streams"] == 1
+    assert ollamaapi.coalescing_stats["stream_joined"] == 1
+    assert server.stats["generate"] == 1
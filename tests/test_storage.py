@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+from conftest import ROOT_DIR
+from ollamaapi import ConversationLog, SessionStore
+
+
+def test_import_does_not_touch_the_data_dir(tmp_path):
+    cache_dir = tmp_path / "cache"
+    env = dict(
+        os.environ,
+        SESSION_DB_PATH=str(cache_dir / "sessions.sqlite3"),
+        CONVERSATION_DB_PATH=str(cache_dir / "conversations.sqlite3"),
+        RESPONSE_CACHE_PATH=str(cache_dir / "responses.jsonl"),
+    )
+    subprocess.run([sys.executable, "-c", "import ollamaapi"], cwd=ROOT_DIR, env=env, check=True)
+    assert not cache_dir.exists()
+
+
+def test_stores_open_their_database_on_first_use(tmp_path):
+    sessions = SessionStore(str(tmp_path / "a" / "sessions.sqlite3"), 10, 60)
+    log = ConversationLog(str(tmp_path / "b" / "conversations.sqlite3"))
+    assert not (tmp_path / "a").exists() and not (tmp_path / "b").exists()
+
+    history = sessions.get("s1")
+    with sessions.updating(history):
+        history.message_count += 1
+    assert sessions.stats()["stored"] == 1
+    assert log.append({"session_id": "s1", "user_message": "halo"}) == 1
+    assert [row["user_message"] for row in log.page()] == ["halo"]
+    assert os.path.exists(sessions.db_path) and os.path.exists(log.db_path)
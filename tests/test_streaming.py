@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+import pytest
+
+import ollamaapi
+from ollamaapi import ResponseCache, SharedStream, StreamError
+
+
+@pytest.fixture
+def response_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(os.path.join(tmp_path, "responses.jsonl"), 100, 0, 0)
+    monkeypatch.setattr(ollamaapi, "response_cache", cache)
+    return cache
+
+
+async def pump(prompt: str):
+    events: "asyncio.Queue" = asyncio.Queue()
+    ctx = {"from_cache": {}, "session_id": "s"}
+    text = await ollamaapi.pump_ollama_stream("main", prompt, events, ctx)
+    tokens = []
+    while not events.empty():
+        event = events.get_nowait()
+        if event["event"] == "token":
+            tokens.append(event["text"])
+    return text, tokens
+
+
+def test_complete_stream_is_cached(fake_ollama, backends, response_cache):
+    backends(fake_ollama(latency=0.05).url)
+    text, _ = asyncio.run(pump("prompt utuh"))
+    assert text.startswith("Jawaban fake")
+    assert response_cache.stats()["size"] == 1
+
+
+def test_stream_dropped_midway_is_not_cached(fake_ollama, backends, response_cache):
+    backends(fake_ollama(latency=0.05, drop_after=3).url)
+    text, tokens = asyncio.run(pump("prompt terputus"))
+    assert text.startswith("Jawaban fake")   # potongan sebelum putus tetap dikirim
+    assert "Stream terputus" in tokens[-1]
+    assert response_cache.stats()["size"] == 0
+    assert not os.path.exists(response_cache.path)
+
+
+def test_late_subscriber_of_cancelled_stream_sees_the_error(fake_ollama, backends):
+    backends(fake_ollama(latency=0.05, token_rate=20, tokens=200).url)
+
+    async def main():
+        shared = SharedStream("kunci", "prompt panjang")
+        first = shared.subscribe()
+        await first.__anext__()
+        await first.aclose()   # pelanggan terakhir pergi: generasi dibatalkan
+        assert shared.cancelled
+        pieces = [piece async for piece in shared.subscribe()]
+        return shared, pieces
+
+    shared, pieces = asyncio.run(main())
+    assert shared.failed
+    assert isinstance(pieces[-1], StreamError)
+
+
+def test_new_request_does_not_join_a_cancelled_stream(fake_ollama, backends):
+    backends(fake_ollama(latency=0.05, token_rate=50, tokens=20).url)
+
+    async def main():
+        first = ollamaapi.stream_ollama("prompt sama")
+        await first.__anext__()
+        await first.aclose()
+        return "".join([piece async for piece in ollamaapi.stream_ollama("prompt sama")])
+
+    text = asyncio.run(main())
+    assert text.startswith("Jawaban fake") and "[Error" not in text
+    assert ollamaapi.coalescing_stats["streams"] == 2
+    assert ollamaapi.coalescing_stats["stream_joined"] == 0